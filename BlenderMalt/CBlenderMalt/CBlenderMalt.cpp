@@ -1,6 +1,9 @@
 #include "stdio.h"
 #include "string.h"
 
+#include <vector>
+#include <unordered_map>
+
 #ifdef _WIN32
 #define EXPORT extern "C" __declspec( dllexport )
 #else
@@ -118,6 +121,185 @@ EXPORT void retrieve_mesh_data(void* in_mesh, void* in_loop_tris, int loop_tri_c
     }
 }
 
+// Mesh optimization
+
+struct LoopAttributes
+{
+    const unsigned char** attributes;
+    const int* element_sizes;
+    int attribute_count;
+
+    size_t hash(unsigned int loop) const
+    {
+        // FNV-1a
+        size_t result = 14695981039346656037ULL;
+        for(int a = 0; a < attribute_count; a++)
+        {
+            const unsigned char* data = attributes[a] + (size_t)loop * element_sizes[a];
+            for(int i = 0; i < element_sizes[a]; i++)
+            {
+                result ^= data[i];
+                result *= 1099511628211ULL;
+            }
+        }
+        return result;
+    }
+
+    bool equal(unsigned int a, unsigned int b) const
+    {
+        for(int i = 0; i < attribute_count; i++)
+        {
+            int size = element_sizes[i];
+            if(memcmp(attributes[i] + (size_t)a * size, attributes[i] + (size_t)b * size, size) != 0)
+            {
+                return false;
+            }
+        }
+        return true;
+    }
+};
+
+// Merges the loops with identical attributes (position, normal, uvs, tangents, colors...).
+// The attributes are compacted in place, so the unique vertices are stored at the start of each buffer.
+// out_remap receives the vertex index of each loop.
+// Returns the unique vertex count.
+EXPORT int weld_vertices(unsigned char** attributes, int* element_sizes, int attribute_count, int loop_count,
+    unsigned int* out_remap)
+{
+    LoopAttributes loop_attributes = { (const unsigned char**)attributes, element_sizes, attribute_count };
+    auto hash = [&](unsigned int loop) { return loop_attributes.hash(loop); };
+    auto equal = [&](unsigned int a, unsigned int b) { return loop_attributes.equal(a, b); };
+    std::unordered_map<unsigned int, unsigned int, decltype(hash), decltype(equal)> vertices(loop_count, hash, equal);
+
+    std::vector<unsigned int> unique_loops;
+    unique_loops.reserve(loop_count);
+
+    for(int i = 0; i < loop_count; i++)
+    {
+        auto inserted = vertices.emplace(i, (unsigned int)unique_loops.size());
+        if(inserted.second)
+        {
+            unique_loops.push_back(i);
+        }
+        out_remap[i] = inserted.first->second;
+    }
+
+    // unique_loops[i] >= i, so the compaction never overwrites a loop that hasn't been copied yet
+    for(int a = 0; a < attribute_count; a++)
+    {
+        int size = element_sizes[a];
+        for(size_t i = 0; i < unique_loops.size(); i++)
+        {
+            if(unique_loops[i] != i)
+            {
+                memcpy(attributes[a] + i * size, attributes[a] + (size_t)unique_loops[i] * size, size);
+            }
+        }
+    }
+
+    return (int)unique_loops.size();
+}
+
+EXPORT void remap_indices(unsigned int* indices, int index_count, unsigned int* remap)
+{
+    for(int i = 0; i < index_count; i++)
+    {
+        indices[i] = remap[indices[i]];
+    }
+}
+
+// Reorders the triangles for the post-transform vertex cache (in place).
+// Tipsify, from "Fast Triangle Reordering for Vertex Locality and Reduced Overdraw" (Sander, Nehab, Barczak 2007)
+EXPORT void optimize_vertex_cache(unsigned int* indices, int index_count, int vertex_count, int cache_size)
+{
+    int triangle_count = index_count / 3;
+    if(triangle_count == 0) return;
+
+    std::vector<int> live(vertex_count, 0);
+    for(int i = 0; i < triangle_count * 3; i++)
+    {
+        live[indices[i]]++;
+    }
+    std::vector<int> offsets(vertex_count + 1, 0);
+    for(int v = 0; v < vertex_count; v++)
+    {
+        offsets[v+1] = offsets[v] + live[v];
+    }
+    std::vector<int> adjacency(triangle_count * 3);
+    std::vector<int> fill(offsets.begin(), offsets.end() - 1);
+    for(int i = 0; i < triangle_count * 3; i++)
+    {
+        adjacency[fill[indices[i]]++] = i / 3;
+    }
+
+    std::vector<int> cache_time(vertex_count, 0);
+    std::vector<bool> emitted(triangle_count, false);
+    std::vector<unsigned int> dead_end;
+    std::vector<unsigned int> candidates;
+    std::vector<unsigned int> result;
+    result.reserve(triangle_count * 3);
+
+    int time = cache_size + 1;
+    int cursor = 0;
+    int fanning = indices[0];
+
+    while(fanning >= 0)
+    {
+        candidates.clear();
+        for(int a = offsets[fanning]; a < offsets[fanning+1]; a++)
+        {
+            int triangle = adjacency[a];
+            if(emitted[triangle]) continue;
+            emitted[triangle] = true;
+            for(int i = 0; i < 3; i++)
+            {
+                unsigned int v = indices[triangle*3+i];
+                result.push_back(v);
+                dead_end.push_back(v);
+                candidates.push_back(v);
+                live[v]--;
+                if(time - cache_time[v] > cache_size)
+                {
+                    cache_time[v] = time++;
+                }
+            }
+        }
+
+        // Pick the candidate that will still be in the cache after emitting all its triangles, and has been in it the longest
+        int next = -1;
+        int best_priority = -1;
+        for(unsigned int v : candidates)
+        {
+            if(live[v] <= 0) continue;
+            int priority = 0;
+            if(time - cache_time[v] + 2 * live[v] <= cache_size)
+            {
+                priority = time - cache_time[v];
+            }
+            if(priority > best_priority)
+            {
+                best_priority = priority;
+                next = v;
+            }
+        }
+        // Dead end, go back to a recently used vertex, or to the next unprocessed one
+        while(next == -1 && dead_end.size() > 0)
+        {
+            unsigned int v = dead_end.back();
+            dead_end.pop_back();
+            if(live[v] > 0) next = v;
+        }
+        while(next == -1 && cursor < vertex_count)
+        {
+            if(live[cursor] > 0) next = cursor;
+            cursor++;
+        }
+        fanning = next;
+    }
+
+    memcpy(indices, result.data(), result.size() * sizeof(unsigned int));
+}
+
 EXPORT float* mesh_tangents_ptr(void* in_mesh)
 {
 	Mesh* mesh = (Mesh*)in_mesh;
@@ -20,6 +20,21 @@ retrieve_mesh_data.argtypes = [
 ]
 retrieve_mesh_data.restype = None
 
+weld_vertices = CBlenderMalt['weld_vertices']
+weld_vertices.argtypes = [
+    ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.c_int,
+    ctypes.POINTER(ctypes.c_uint32)
+]
+weld_vertices.restype = ctypes.c_int
+
+remap_indices = CBlenderMalt['remap_indices']
+remap_indices.argtypes = [ctypes.POINTER(ctypes.c_uint32), ctypes.c_int, ctypes.POINTER(ctypes.c_uint32)]
+remap_indices.restype = None
+
+optimize_vertex_cache = CBlenderMalt['optimize_vertex_cache']
+optimize_vertex_cache.argtypes = [ctypes.POINTER(ctypes.c_uint32), ctypes.c_int, ctypes.c_int, ctypes.c_int]
+optimize_vertex_cache.restype = None
+
 mesh_tangents_ptr = CBlenderMalt['mesh_tangents_ptr']
 mesh_tangents_ptr.argtypes = [ctypes.c_void_p]
 mesh_tangents_ptr.restype = ctypes.POINTER(ctypes.c_float)
@@ -217,8 +217,8 @@ def track_shader_changes(force_update=False, async_compilation=True):
         from . import MaltPipeline
         if len(needs_update) > 0:
             compiled_materials = MaltPipeline.get_bridge().compile_materials(needs_update, async_compilation=async_compilation)
-        else:
-            compiled_materials = MaltPipeline.get_bridge().receive_async_compilation_materials()
+        # The server streams the materials back as they finish, in any order
+        compiled_materials.update(MaltPipeline.get_bridge().receive_async_compilation_materials() or {})
         
         if len(compiled_materials) > 0:
             for key, value in compiled_materials.items():
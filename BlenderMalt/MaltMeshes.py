@@ -3,18 +3,86 @@ import bpy
 
 MESHES = {}
 
+# Vertex cache size the triangle order is optimized for
+VERTEX_CACHE_SIZE = 16
+
+# Meshes waiting to be loaded in the background, by mesh name
+LOAD_QUEUE = {}
+# Only checked between meshes, each mesh is still loaded in a single step
+LOAD_TIME_BUDGET = 1.0 / 120.0
+LOAD_PROGRESS = [0, 0] # loaded, total
+# Incremented each time a background mesh finishes loading, so render engines know they need a scene update
+LOAD_VERSION = 0
+# Stored in MESHES for the background loads that failed, so they're not retried on every redraw.
+# unload_mesh clears it, so the mesh is loaded again after its next edit.
+LOAD_FAILED = object()
+
 def get_mesh_name(object):
     name = object.name_full
     if len(object.modifiers) == 0 and object.data:
         name = object.type + '_' + object.data.name_full
     return name
 
-def get_mesh(object):
+def get_mesh(object, background=False):
     key = get_mesh_name(object)
+    if MESHES.get(key) is LOAD_FAILED:
+        return None
+    if key not in MESHES.keys() and background:
+        # Reloads of already loaded meshes (edits) are not queued, so they update without delay
+        queue_mesh(object, key)
+        return None
     if key not in MESHES.keys() or MESHES[key] is None:
         MESHES[key] = load_mesh(object, key)
     return MESHES[key]
 
+def queue_mesh(object, name):
+    if name in LOAD_QUEUE:
+        return
+    if len(LOAD_QUEUE) == 0:
+        LOAD_PROGRESS[:] = [0, 0]
+    # Evaluated objects are only valid during the current depsgraph evaluation
+    LOAD_QUEUE[name] = object.original
+    LOAD_PROGRESS[1] += 1
+    if bpy.app.timers.is_registered(load_queued_meshes) == False:
+        bpy.app.timers.register(load_queued_meshes, first_interval=0)
+
+def load_queued_meshes():
+    import time
+    global LOAD_VERSION
+    start = time.perf_counter()
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    while len(LOAD_QUEUE) > 0 and time.perf_counter() - start < LOAD_TIME_BUDGET:
+        name = next(iter(LOAD_QUEUE))
+        object = LOAD_QUEUE.pop(name)
+        LOAD_PROGRESS[0] += 1
+        if name in MESHES:
+            continue
+        try:
+            MESHES[name] = load_mesh(object.evaluated_get(depsgraph), name)
+        except ReferenceError:
+            # The object was removed
+            continue
+        except:
+            import traceback
+            traceback.print_exc()
+            MESHES[name] = LOAD_FAILED
+        LOAD_VERSION += 1
+    
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
+    
+    if len(LOAD_QUEUE) > 0:
+        return 0.0
+    return None
+
+def get_load_stats():
+    if len(LOAD_QUEUE) == 0:
+        return ''
+    loaded, total = LOAD_PROGRESS
+    return f'Loading Meshes : {loaded} / {total}'
+
 def load_mesh(object, name):
     from . import CBlenderMalt
 
@@ -49,7 +117,7 @@ def load_mesh(object, name):
         positions.buffer(), normals.buffer(), indices_ptrs, indices_lengths)
     
     for i in range(material_count):
-        indices[i]._size = indices_lengths[i]
+        indices[i].truncate(indices_lengths[i])
 
     uvs_list = []
     tangents_buffer = None
@@ -86,6 +154,22 @@ def load_mesh(object, name):
                 ctypes.memmove(color_buffer.buffer(), color, color_buffer.size_in_bytes())
                 colors_list[i] = color_buffer
 
+    # Blender data is per loop, merge the loops that share all their attributes
+    # and reorder the triangles for the post-transform vertex cache
+    attributes = [e for e in [positions, normals, *uvs_list, tangents_buffer, *colors_list] if e is not None]
+    attribute_ptrs = (ctypes.c_void_p * len(attributes))(*[ctypes.addressof(e.buffer()) for e in attributes])
+    element_sizes = (ctypes.c_int * len(attributes))(*[e.size_in_bytes() // loop_count for e in attributes])
+    remap = (ctypes.c_uint32 * loop_count)()
+    vertex_count = CBlenderMalt.weld_vertices(attribute_ptrs, element_sizes, len(attributes), loop_count, remap)
+    for attribute in attributes:
+        attribute.truncate((len(attribute) // loop_count) * vertex_count)
+    for index in indices:
+        CBlenderMalt.remap_indices(index.buffer(), len(index), remap)
+        CBlenderMalt.optimize_vertex_cache(index.buffer(), len(index), vertex_count, VERTEX_CACHE_SIZE)
+
+    compact_vertex_format = object.original.data.malt_parameters.bools.get('compact_vertex_format')
+    compact_vertex_format = compact_vertex_format.boolean if compact_vertex_format else False
+
     #TODO: Optimize. Create load buffers from bytearrays and retrieve them later
     mesh_data = {
         'positions': positions,
@@ -94,6 +178,7 @@ def load_mesh(object, name):
         'uvs': uvs_list,
         'tangents': tangents_buffer,
         'colors': colors_list,
+        'compact': compact_vertex_format,
     }
 
     from . import MaltPipeline
@@ -112,6 +197,7 @@ def unload_mesh(object):
 def reset_meshes():
     global MESHES
     MESHES = {}
+    LOAD_QUEUE.clear()
 
 def draw_vertex_color_overrides(self, context):
     if context.scene.render.engine != 'MALT':
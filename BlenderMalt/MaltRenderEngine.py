@@ -41,6 +41,8 @@ class MaltRenderEngine(bpy.types.RenderEngine):
         self.bridge = MaltPipeline.get_bridge()
         self.bridge_id = self.bridge.get_viewport_id() if self.bridge else None
         self.last_frame_time = 0
+        self.mesh_load_version = MaltMeshes.LOAD_VERSION
+        self.display_texture = DisplayTexture()
 
     def __del__(self):
         try:
@@ -97,9 +99,10 @@ class MaltRenderEngine(bpy.types.RenderEngine):
             return scene
         
         meshes = {}
+        background_loading = bpy.context.preferences.addons['BlenderMalt'].preferences.background_mesh_loading
 
         #Objects
-        def add_object(obj, matrix, id):
+        def add_object(obj, matrix, id, key):
             if obj.display_type in ['TEXTURED','SOLID'] and obj.type in ('MESH','CURVE','SURFACE','META', 'FONT'):
                 name = MaltMeshes.get_mesh_name(obj)
                 if depsgraph.mode == 'RENDER':
@@ -111,7 +114,7 @@ class MaltRenderEngine(bpy.types.RenderEngine):
                     malt_mesh = None
                     
                     if depsgraph.mode == 'VIEWPORT':
-                        malt_mesh = MaltMeshes.get_mesh(obj)
+                        malt_mesh = MaltMeshes.get_mesh(obj, background_loading)
                     else: #always load the mesh for final renders
                         malt_mesh = MaltMeshes.load_mesh(obj, name)
                     
@@ -149,12 +152,12 @@ class MaltRenderEngine(bpy.types.RenderEngine):
                                 scene.proxys[material_key]  = MaterialProxy(path, shader_parameters, material_parameters)
                             material = scene.proxys[material_key]
                         if override_material: material = override_material
-                        result = Scene.Object(matrix, mesh[i], material, obj_parameters, mirror_scale, tags)
+                        result = Scene.Object(matrix, mesh[i], material, obj_parameters, mirror_scale, tags, (key, i))
                         scene.objects.append(result)
                 else:
                     material = default_material
                     if override_material: material = override_material
-                    result = Scene.Object(matrix, mesh[0], material, obj_parameters, mirror_scale, tags)
+                    result = Scene.Object(matrix, mesh[0], material, obj_parameters, mirror_scale, tags, (key, 0))
                     scene.objects.append(result)
            
             elif obj.type == 'LIGHT':
@@ -164,6 +167,7 @@ class MaltRenderEngine(bpy.types.RenderEngine):
                 malt_light = obj.data.malt
 
                 light = Scene.Light()
+                light.key = key
                 light.color = tuple(obj.data.color * malt_light.strength)
                 light.position = tuple(obj.matrix_world.translation)
                 light.direction = tuple(obj.matrix_world.to_quaternion() @ Vector((0.0,0.0,-1.0)))
@@ -194,13 +198,14 @@ class MaltRenderEngine(bpy.types.RenderEngine):
         for obj in depsgraph.objects:
             if is_f12 or obj.visible_in_viewport_get(context.space_data):
                 id = xxhash.xxh3_64_intdigest(obj.name_full.encode()) % (2**16)
-                add_object(obj, obj.matrix_world, id)
+                add_object(obj, obj.matrix_world, id, obj.name_full)
 
         for instance in depsgraph.object_instances:
             if instance.instance_object:
                 if is_f12 or instance.parent.visible_in_viewport_get(context.space_data):
                     id = abs(instance.random_id) % (2**16)
-                    add_object(instance.instance_object, instance.matrix_world, id)
+                    key = ('INSTANCE', instance.parent.name_full, tuple(instance.persistent_id))
+                    add_object(instance.instance_object, instance.matrix_world, id, key)
         
         return scene
     
@@ -304,6 +309,15 @@ class MaltRenderEngine(bpy.types.RenderEngine):
         if CAPTURE:
             self.request_new_frame = True
         
+        if self.bridge.needs_resync(self.bridge_id):
+            self.request_new_frame = True
+            self.request_scene_update = True
+        
+        if self.mesh_load_version != MaltMeshes.LOAD_VERSION:
+            self.mesh_load_version = MaltMeshes.LOAD_VERSION
+            self.request_new_frame = True
+            self.request_scene_update = True
+        
         overrides = []
         if context.space_data.shading.type == 'MATERIAL':
             overrides.append('Preview')
@@ -364,13 +378,7 @@ class MaltRenderEngine(bpy.types.RenderEngine):
             data_format = GL.GL_HALF_FLOAT
             texture_format = GL.GL_RGBA16F
         
-        try:
-            render_texture = Texture(resolution, texture_format, data_format, pixels.buffer(),
-                mag_filter=mag_filter, pixel_format=GL.GL_RGBA)
-        except:
-            # Fallback to unsigned byte, just in case (matches Server behavior)
-            render_texture = Texture(resolution, GL.GL_RGBA8, GL.GL_UNSIGNED_BYTE, pixels.buffer(),
-                mag_filter=mag_filter)
+        render_texture = self.display_texture.update(resolution, texture_format, data_format, mag_filter, pixels, buffers.get('__TILES'))
         
         global DISPLAY_DRAW
         if DISPLAY_DRAW is None:
@@ -379,6 +387,123 @@ class MaltRenderEngine(bpy.types.RenderEngine):
 
 DISPLAY_DRAW = None
 
+class DisplayTexture():
+    # The viewport render result, reused while the resolution and format don't change.
+    # Pixels are uploaded through 2 alternating pixel unpack buffers, so the copy doesn't wait for the previous upload.
+    # With a tiles buffer (See Bridge.Client_API.TILE_SIZE), it's only updated when the server frame counter changes,
+    # and only on the tiles that changed.
+
+    def __init__(self):
+        self.texture = None
+        self.key = None
+        self.tiles = None
+        self.frame = None
+        self.tile_versions = None
+        self.pbos = []
+        self.pbo_size = 0
+        self.pbo_index = 0
+    
+    def __del__(self):
+        for pbo in self.pbos:
+            GL.glDeleteBuffers(1, pbo)
+
+    def update(self, resolution, texture_format, data_format, mag_filter, pixels, tiles):
+        key = (resolution, texture_format, data_format)
+        if key != self.key or tiles is not self.tiles:
+            try:
+                self.texture = Texture(resolution, texture_format, data_format, pixel_format=GL.GL_RGBA)
+            except:
+                # Fallback to unsigned byte, just in case (matches Server behavior)
+                self.texture = Texture(resolution, GL.GL_RGBA8, GL.GL_UNSIGNED_BYTE)
+            self.key = key
+            self.tiles = tiles
+            self.frame = None
+            self.tile_versions = None
+        
+        self.texture.bind()
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, mag_filter)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        w,h = resolution
+        regions = [(0, 0, w, h)]
+        if tiles:
+            frame = tiles.buffer()[1]
+            if frame == self.frame:
+                return self.texture
+            self.frame = frame
+            versions = tiles.as_np_array()[2:].copy()
+            if self.tile_versions is not None:
+                regions = self.get_changed_regions(resolution, tiles.buffer()[0], versions != self.tile_versions)
+            self.tile_versions = versions
+        
+        if len(regions) > 0:
+            self.upload(resolution, pixels, regions)
+        return self.texture
+    
+    def get_changed_regions(self, resolution, tile_size, changed):
+        # Horizontal runs of changed tiles, as (x, y, width, height)
+        w,h = resolution
+        tiles_x = -(-w // tile_size)
+        regions = []
+        for tile_y, row in enumerate(changed.reshape(-1, tiles_x).tolist()):
+            y = tile_y * tile_size
+            height = min(h - y, tile_size)
+            tile_x = 0
+            while tile_x < tiles_x:
+                if row[tile_x] == False:
+                    tile_x += 1
+                    continue
+                start = tile_x
+                while tile_x < tiles_x and row[tile_x]:
+                    tile_x += 1
+                x = start * tile_size
+                regions.append((x, y, min(w, tile_x * tile_size) - x, height))
+        return regions
+    
+    def upload(self, resolution, pixels, regions):
+        import numpy as np
+        w,h = resolution
+        size = pixels.size_in_bytes()
+        if size > self.pbo_size:
+            for pbo in self.pbos:
+                GL.glDeleteBuffers(1, pbo)
+            self.pbos = []
+            for i in range(2):
+                pbo = GL.gl_buffer(GL.GL_INT, 1)
+                GL.glGenBuffers(1, pbo)
+                GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, pbo[0])
+                GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, size, None, GL.GL_STREAM_DRAW)
+                self.pbos.append(pbo)
+            self.pbo_size = size
+        
+        pbo = self.pbos[self.pbo_index]
+        self.pbo_index = (self.pbo_index + 1) % len(self.pbos)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, pbo[0])
+        address = GL.glMapBufferRange(GL.GL_PIXEL_UNPACK_BUFFER, 0, size, GL.GL_MAP_WRITE_BIT | GL.GL_MAP_INVALIDATE_BUFFER_BIT)
+        address = ctypes.cast(address, ctypes.c_void_p).value
+        pixel_size = size // (w * h)
+        if regions == [(0, 0, w, h)]:
+            ctypes.memmove(address, pixels.buffer(), size)
+        else:
+            # Only the changed regions are written, the rest of the buffer is left undefined
+            source = np.ctypeslib.as_array((ctypes.c_ubyte * size).from_buffer(pixels.buffer())).reshape(h, w * pixel_size)
+            destination = np.ctypeslib.as_array((ctypes.c_ubyte * size).from_address(address)).reshape(h, w * pixel_size)
+            for x, y, width, height in regions:
+                x0, x1 = x * pixel_size, (x + width) * pixel_size
+                destination[y:y+height, x0:x1] = source[y:y+height, x0:x1]
+        GL.glUnmapBuffer(GL.GL_PIXEL_UNPACK_BUFFER)
+
+        self.texture.bind()
+        GL.glPixelStorei(GL.GL_UNPACK_ROW_LENGTH, w)
+        for x, y, width, height in regions:
+            offset = (y * w + x) * pixel_size
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, x, y, width, height, self.texture.format, self.texture.data_format, 
+                ctypes.c_void_p(offset))
+        GL.glPixelStorei(GL.GL_UNPACK_ROW_LENGTH, 0)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+
 class DisplayDraw():
     def __init__(self):
         positions=[
@@ -430,6 +555,9 @@ class VIEW3D_PT_Malt_Stats(bpy.types.Panel):
         from . import MaltPipeline
         self.layout.operator("wm.malt_renderdoc_capture")
         stats = MaltPipeline.get_bridge().get_stats()
+        mesh_stats = MaltMeshes.get_load_stats()
+        if mesh_stats:
+            stats = mesh_stats + '\n' + stats
         for line in stats.splitlines():
             self.layout.label(text=line)
 
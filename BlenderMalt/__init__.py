@@ -47,6 +47,8 @@ class Preferences(bpy.types.AddonPreferences):
         set=malt_path_setter('docs_path'), get=malt_path_getter('docs_path'))
     
     render_fps_cap : bpy.props.IntProperty(name="Max Viewport Render Framerate", default=30)
+    background_mesh_loading : bpy.props.BoolProperty(name="Background Mesh Loading", default=True,
+        description="Load new meshes in small time slices between viewport redraws.\nMeshes are not rendered until they finish loading")
     
     def update_debug_mode(self, context):
         if context.scene.render.engine == 'MALT':
@@ -76,6 +78,7 @@ class Preferences(bpy.types.AddonPreferences):
 
         layout.prop(self, "plugins_dir")
         layout.prop(self, "render_fps_cap")
+        layout.prop(self, "background_mesh_loading")
         layout.prop(self, "setup_vs_code")
         layout.prop(self, "renderdoc_path")
         layout.label(text='Developer Settings :')
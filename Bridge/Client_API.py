@@ -1,5 +1,5 @@
 import ctypes, logging as LOG, io, sys
-from Bridge.ipc import SharedBuffer
+from Bridge.ipc import SharedMemoryPool, ControlBlock
 
 def bridge_method(function):
     def result(*args, **kwargs):
@@ -26,6 +26,9 @@ class IOCapture(io.StringIO):
         LOG.log(self.log_level, s)
         return super().write(s)
 
+# Viewport readback tile size, see the __TILES render buffer
+TILE_SIZE = 64
+
 class Bridge():
 
     def __init__(self, pipeline_path, viewport_bit_depth=8, debug_mode=False, renderdoc_path=None, plugins_paths=[], docs_path=None):
@@ -46,10 +49,7 @@ class Bridge():
 
         self.viewport_bit_depth = viewport_bit_depth
 
-        self.manager = mp.Manager()
-        self.shared_dict = self.manager.dict()
         self.lock = None
-        #SharedBuffer.setup_class(self.manager)
         self.connections = {}
         self.process = None
         self.lost_connection = True
@@ -57,10 +57,12 @@ class Bridge():
         self.graphs = {}
         self.render_outputs = {}
         self.render_buffers = {}
-        self.shared_buffers = []
+        self.shared_memory = SharedMemoryPool()
+        self.control = ControlBlock(self.shared_memory, mp)
         self.id = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
 
         self.viewport_ids = []
+        self.scene_syncs = {}
 
         listeners = {}
         bridge_to_malt = {}
@@ -81,7 +83,7 @@ class Bridge():
             'pipeline_path': pipeline_path, 
             'viewport_bit_depth': viewport_bit_depth, 
             'connection_addresses': malt_to_bridge, 
-            'shared_dic': self.shared_dict,
+            'control': self.control,
             'lock': self.lock,
             'log_path': sys.stdout.log_path,
             'debug_mode': debug_mode,
@@ -115,10 +117,11 @@ class Bridge():
     
     @bridge_method
     def get_stats(self):
-        if 'STATS' in self.shared_dict and self.shared_dict['STATS']:
-            return self.shared_dict['STATS']
-        else:
-            return ''
+        stats = self.shared_memory.get_stats()
+        server_stats = self.control.get_stats()
+        if server_stats:
+            stats = server_stats + '\n' + stats
+        return stats
 
     @bridge_method
     def compile_material(self, path, search_paths=[], custom_passes=[]):
@@ -185,28 +188,7 @@ class Bridge():
     
     @bridge_method
     def get_shared_buffer(self, ctype, size):
-        from . import ipc
-        #return ipc.SharedBuffer(ctype, size)
-        requested_size = ctypes.sizeof(ctype) * size
-        reuse_buffer = None
-        for buffer in self.shared_buffers:
-            release_flag = ctypes.c_bool.from_address(buffer._release_flag.data)
-            min_ref_count = 3 # shared_buffers + local buffer var + getrefcount ref
-            if release_flag.value == True and sys.getrefcount(buffer) == min_ref_count:
-                if buffer._buffer.size >= requested_size:
-                    if reuse_buffer is None or buffer._buffer.size < reuse_buffer._buffer.size:
-                        reuse_buffer = buffer
-        
-        if reuse_buffer is None:
-            min_size = 1024*1024
-            new_size = max(requested_size * 2, min_size)
-            reuse_buffer = ipc.SharedBuffer(ctypes.c_byte, new_size)
-            self.shared_buffers.append(reuse_buffer)
-        
-        ctypes.c_bool.from_address(reuse_buffer._release_flag.data).value = True
-        reuse_buffer._ctype = ctype
-        reuse_buffer._size = size
-        return reuse_buffer
+        return self.shared_memory.allocate(ctype, size)
 
     @bridge_method
     def load_mesh(self, name, mesh_data):
@@ -248,6 +230,11 @@ class Bridge():
     @bridge_method
     def free_viewport_id(self, viewport_id):
         self.viewport_ids.remove(viewport_id)
+        self.scene_syncs.pop(viewport_id, None)
+
+    @bridge_method
+    def needs_resync(self, viewport_id):
+        return self.control.needs_resync(viewport_id)
 
     @bridge_method
     def render(self, viewport_id, resolution, scene, scene_update, renderdoc_capture=False, AOVs={}):
@@ -273,42 +260,49 @@ class Bridge():
                 if viewport_id != 0: #viewport render
                     #we only need the color buffer
                     break
+            if viewport_id != 0:
+                # Tile size + a frame counter + a version counter per tile, incremented by the server after each copy.
+                # So the display texture is only updated when there's a new frame, and only on the tiles that changed.
+                w,h = resolution
+                tile_count = -(-w // TILE_SIZE) * -(-h // TILE_SIZE)
+                tiles = self.get_shared_buffer(ctypes.c_uint32, 2 + tile_count)
+                ctypes.memset(tiles.buffer(), 0, tiles.size_in_bytes())
+                tiles.buffer()[0] = TILE_SIZE
+                self.render_buffers[viewport_id]['__TILES'] = tiles
             new_buffers = self.render_buffers[viewport_id]
 
-        if (viewport_id, 'SETUP') in self.shared_dict:
-            import time
-            start = time.perf_counter()
-            while self.shared_dict[(viewport_id, 'SETUP')] == False:
-                # Don't stack multiple render workloads for the same viewport
-                if time.perf_counter() - start > 1:
-                    #But don't stall Blender forever
-                    if new_buffers is None and scene_update == False:
-                        #Never skip new_buffers setup or scene update
-                        return
-                    else:
-                        break
+        # Don't stack multiple render workloads for the same viewport
+        # But don't stall Blender forever
+        if self.control.wait_setup(viewport_id, timeout=1) == False:
+            if new_buffers is None and scene_update == False:
+                #Never skip new_buffers setup or scene update
+                return
                 
-        self.shared_dict[(viewport_id, 'FINISHED')] = None
+        from Bridge.SceneSync import ClientSceneSync
+        if viewport_id not in self.scene_syncs:
+            self.scene_syncs[viewport_id] = ClientSceneSync()
+        scene_sync = self.scene_syncs[viewport_id]
+        if self.needs_resync(viewport_id):
+            self.control.resync_handled(viewport_id)
+            scene_sync.reset()
+        # Send only the changes since the last scene update
+        delta = scene_sync.get_delta(scene, scene_update)
+        
+        self.control.request_render(viewport_id)
         self.connections['MAIN'].send({
             'msg_type': 'RENDER',
             'viewport_id': viewport_id,
             'resolution': resolution,
-            'scene': scene,
-            'scene_update': scene_update,
+            'scene': delta,
             'new_buffers': new_buffers,
             'renderdoc_capture' : renderdoc_capture,
         })
-        self.shared_dict[(viewport_id, 'SETUP')] = False
 
     @bridge_method
     def render_result(self, viewport_id):
-        finished = False
-        if (viewport_id, 'FINISHED') in self.shared_dict:
-            finished = self.shared_dict[(viewport_id, 'FINISHED')] == True
-        
-        read_resolution = None
-        if (viewport_id, 'READ_RESOLUTION') in self.shared_dict:
-            read_resolution = self.shared_dict[viewport_id, 'READ_RESOLUTION']
+        finished = self.control.is_finished(viewport_id)
+        read_resolution = self.control.get_read_resolution(viewport_id)
+        self.control.set_read(viewport_id)
         
         if viewport_id in self.render_buffers.keys():
             return self.render_buffers[viewport_id], finished, read_resolution
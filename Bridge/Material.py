@@ -4,12 +4,13 @@ MATERIAL_SHADERS = {}
 
 class Material():
 
-    def __init__(self, path, pipeline, search_paths=[], custom_passes={}):
+    def __init__(self, path, pipeline, search_paths=[], custom_passes={}, compiled_material=None):
         self.path = path
         self.parameters = {}
         self.compiler_error = ''
         
-        compiled_material = pipeline.compile_material(path, search_paths)#, custom_passes)
+        if compiled_material is None:
+            compiled_material = pipeline.compile_material(path, search_paths)#, custom_passes)
         
         if isinstance(compiled_material, str):
             self.compiler_error = compiled_material
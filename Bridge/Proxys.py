@@ -15,6 +15,11 @@ class MeshProxy(Mesh):
         self.mesh = Bridge.Mesh.MESHES[self.name][self.submesh_index]
         self.__dict__.update(self.mesh.__dict__)
     
+    def needs_resolve(self):
+        import Bridge.Mesh
+        meshes = Bridge.Mesh.MESHES.get(self.name)
+        return meshes is not None and self.mesh is not meshes[self.submesh_index]
+    
     def __del__(self):
         pass
 
@@ -29,6 +34,11 @@ class TextureProxy(Texture):
         self.texture = Bridge.Texture.TEXTURES[self.name]
         self.__dict__.update(self.texture.__dict__)
     
+    def needs_resolve(self):
+        import Bridge.Texture
+        texture = Bridge.Texture.TEXTURES.get(self.name)
+        return texture is not None and self.texture is not texture
+    
     def __del__(self):
         pass
 
@@ -43,6 +53,11 @@ class GradientProxy(Gradient):
         self.gradient = Bridge.Texture.GRADIENTS[self.name]
         self.__dict__.update(self.gradient.__dict__)
     
+    def needs_resolve(self):
+        import Bridge.Texture
+        gradient = Bridge.Texture.GRADIENTS.get(self.name)
+        return gradient is not None and self.gradient is not gradient
+    
     def __del__(self):
         pass
 
@@ -56,3 +71,8 @@ class MaterialProxy(Material):
     def resolve(self):
         import Bridge.Material
         self.shader = Bridge.Material.get_shader(self.path, self.shader_parameters)
+        self.material_shaders = Bridge.Material.MATERIAL_SHADERS.get(self.path)
+    
+    def needs_resolve(self):
+        import Bridge.Material
+        return getattr(self, 'material_shaders', None) is not Bridge.Material.MATERIAL_SHADERS.get(self.path)
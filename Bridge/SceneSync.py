@@ -0,0 +1,317 @@
+
+from Malt import Scene
+
+# Incremental scene synchronization.
+# The client keeps the signature of the last scene sent to each viewport and only sends
+# the objects, lights and proxys (meshes, materials, textures) that have been added, removed or changed.
+# The server keeps the resolved scene of each viewport alive and patches it in place.
+# Objects and lights are identified by their key, proxys by their key in Scene.proxys.
+
+class SceneDelta():
+
+    def __init__(self, is_full, scene_update):
+        self.is_full = is_full
+        self.scene_update = scene_update
+        self.camera = None
+        self.parameters = {}
+        self.world_parameters = {}
+        self.frame = 0
+        self.time = 0
+        # Added or changed. key : value
+        self.objects = {}
+        self.lights = {}
+        self.proxys = {}
+        # Removed. [key]
+        self.removed_objects = []
+        self.removed_lights = []
+        self.removed_proxys = []
+        # Keys of all the scene lights, since their order is relevant for the pipeline
+        self.light_keys = []
+
+
+def sync_value(value, proxy_keys):
+    # Returns a representation of value that can be compared between scene updates
+    if isinstance(value, dict):
+        return tuple((k, sync_value(v, proxy_keys)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(sync_value(v, proxy_keys) for v in value)
+    key = proxy_keys.get(id(value))
+    if key is not None:
+        return ('proxy', key)
+    return value
+
+
+def _diff(previous_signatures, items, get_signature):
+    signatures = {}
+    changed = {}
+    for key, item in items.items():
+        signature = get_signature(item)
+        signatures[key] = signature
+        if key not in previous_signatures or previous_signatures[key] != signature:
+            changed[key] = item
+    removed = [key for key in previous_signatures.keys() if key not in signatures]
+    return signatures, changed, removed
+
+
+def _unique_keys(items, default_key):
+    result = {}
+    for i, item in enumerate(items):
+        key = getattr(item, 'key', None)
+        if key is None:
+            key = (default_key, i)
+        unique_key = key
+        n = 1
+        while unique_key in result:
+            unique_key = (key, n)
+            n += 1
+        result[unique_key] = item
+    return result
+
+
+class ClientSceneSync():
+
+    def __init__(self):
+        self.objects = None
+        self.lights = None
+        self.proxys = None
+
+    def reset(self):
+        self.objects = None
+        self.lights = None
+        self.proxys = None
+
+    def get_delta(self, scene, scene_update):
+        is_full = self.objects is None
+        delta = SceneDelta(is_full, scene_update or is_full)
+        delta.camera = scene.camera
+        delta.frame = scene.frame
+        delta.time = scene.time
+
+        if delta.scene_update == False:
+            return delta
+
+        delta.parameters = scene.parameters
+        delta.world_parameters = scene.world_parameters
+
+        proxys = getattr(scene, 'proxys', {})
+        proxy_keys = {}
+        for key, proxy in proxys.items():
+            proxy.sync_key = key
+            proxy_keys[id(proxy)] = key
+
+        def proxy_signature(proxy):
+            return sync_value({k:v for k,v in proxy.__dict__.items() if k != 'sync_key'}, proxy_keys)
+
+        def object_signature(obj):
+            return (
+                tuple(obj.matrix),
+                proxy_keys.get(id(obj.mesh.mesh)),
+                sync_value(obj.mesh.parameters, proxy_keys),
+                proxy_keys.get(id(obj.material)),
+                sync_value(obj.parameters, proxy_keys),
+                obj.mirror_scale,
+                tuple(sorted(obj.tags)),
+            )
+
+        def light_signature(light):
+            return sync_value({k:v for k,v in light.__dict__.items() if k != 'key'}, proxy_keys)
+
+        objects = _unique_keys(scene.objects, 'object')
+        lights = _unique_keys(scene.lights, 'light')
+
+        self.proxys, delta.proxys, delta.removed_proxys = _diff(self.proxys or {}, proxys, proxy_signature)
+        self.objects, delta.objects, delta.removed_objects = _diff(self.objects or {}, objects, object_signature)
+        self.lights, delta.lights, delta.removed_lights = _diff(self.lights or {}, lights, light_signature)
+        delta.light_keys = list(lights.keys())
+
+        return delta
+
+
+class ServerSceneSync():
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.proxys_version = 0
+        self.reset()
+
+    def reset(self):
+        self.objects = {}
+        self.lights = {}
+        self.proxys = {}
+        self.meshes = {}
+        # (material, mesh, scale_group) : { key : Scene.Object }
+        self.groups = {}
+        self.object_groups = {}
+        self.batches = {}
+        self.bvh = None
+
+    def intern(self, value):
+        # Replace the unpickled proxy copies with the ones already resolved in the server
+        if isinstance(value, dict):
+            for k, v in value.items():
+                value[k] = self.intern(v)
+            return value
+        if isinstance(value, list):
+            return [self.intern(v) for v in value]
+        key = getattr(value, 'sync_key', None)
+        if key is not None and key in self.proxys:
+            return self.proxys[key]
+        return value
+
+    def intern_mesh(self, mesh):
+        key = mesh.mesh.sync_key
+        if key in self.meshes:
+            retained = self.meshes[key]
+            retained.parameters = self.intern(mesh.parameters)
+            return retained
+        mesh.mesh = self.proxys[key]
+        mesh.parameters = self.intern(mesh.parameters)
+        self.meshes[key] = mesh
+        return mesh
+
+    def apply_proxys(self, delta):
+        # Returns the resolved proxys, both the updated ones and the ones reloaded since the last update
+        # (ie. a mesh replaced by a MESH message)
+        for key in delta.removed_proxys:
+            self.proxys.pop(key, None)
+            self.meshes.pop(key, None)
+
+        updated = []
+        for key, proxy in delta.proxys.items():
+            if key in self.proxys:
+                retained = self.proxys[key]
+                retained.__dict__.update(proxy.__dict__)
+                proxy = retained
+            self.proxys[key] = proxy
+            updated.append(proxy)
+
+        for proxy in updated:
+            self.intern(proxy.__dict__)
+        for proxy in updated:
+            proxy.resolve()
+
+        resolved = list(updated)
+        for proxy in self.proxys.values():
+            if proxy not in updated and proxy.needs_resolve():
+                proxy.resolve()
+                resolved.append(proxy)
+
+        return resolved
+
+    def remove_object(self, key, dirty):
+        self.objects.pop(key)
+        self.remove_from_group(key, dirty)
+
+    def remove_from_group(self, key, dirty):
+        group = self.object_groups.pop(key)
+        self.groups[group].pop(key)
+        dirty.add(group)
+
+    def add_object(self, key, obj, dirty):
+        obj.mesh = self.intern_mesh(obj.mesh)
+        obj.material = self.intern(obj.material)
+        obj.parameters = self.intern(obj.parameters)
+        scale_group = 'mirror_scale' if obj.mirror_scale else 'normal_scale'
+        group = (obj.material, obj.mesh, scale_group)
+        self.objects[key] = obj
+        self.object_groups[key] = group
+        if group not in self.groups:
+            self.groups[group] = {}
+        self.groups[group][key] = obj
+        dirty.add(group)
+
+    def update_batches(self, dirty):
+        objects = []
+        for group in dirty:
+            material, mesh, scale_group = group
+            group_objects = self.groups.get(group)
+            if group_objects:
+                objects.extend(group_objects.values())
+            else:
+                self.groups.pop(group, None)
+                meshes = self.batches.get(material, {})
+                scale_groups = meshes.get(mesh, {})
+                scale_groups.pop(scale_group, None)
+                if len(scale_groups) == 0:
+                    meshes.pop(mesh, None)
+                if len(meshes) == 0:
+                    self.batches.pop(material, None)
+
+        # Batch all the dirty groups at once, so the cost is proportional to the size of the edit
+        batches = self.pipeline.build_scene_batches(objects)
+        for material, meshes in batches.items():
+            if material not in self.batches:
+                self.batches[material] = {}
+            for mesh, scale_groups in meshes.items():
+                if mesh not in self.batches[material]:
+                    self.batches[material][mesh] = {}
+                self.batches[material][mesh].update(scale_groups)
+
+    def apply(self, delta):
+        if delta.is_full:
+            self.reset()
+
+        resolved = self.apply_proxys(delta)
+        if delta.is_full or len(resolved) > 0 or len(delta.removed_proxys) > 0:
+            self.proxys_version += 1
+
+        if len(delta.objects) > 0:
+            # Convert all the new matrices at once, the float32 rows are joined without copies by Pipeline.build_scene_batches
+            import numpy as np
+            objects = list(delta.objects.values())
+            matrices = np.array([obj.matrix for obj in objects], np.float32).reshape(len(objects), 16)
+            for obj, matrix in zip(objects, matrices):
+                obj.matrix = matrix
+
+        dirty = set()
+        for key in delta.removed_objects:
+            if key in self.objects:
+                self.remove_object(key, dirty)
+        added = False
+        for key, obj in delta.objects.items():
+            if key in self.objects:
+                # Replaced in place, so the objects keep their order
+                self.remove_from_group(key, dirty)
+            else:
+                added = True
+            self.add_object(key, obj, dirty)
+
+        for key in delta.removed_lights:
+            self.lights.pop(key, None)
+        for key, light in delta.lights.items():
+            light.parameters = self.intern(light.parameters)
+            self.lights[key] = light
+
+        self.update_batches(dirty)
+
+        objects = list(self.objects.values())
+        if self.pipeline.SCENE_BVH:
+            from Malt.Render.BVH import BVH
+            from Bridge.Proxys import MeshProxy
+            if self.bvh is None or added or len(delta.removed_objects) > 0:
+                self.bvh = BVH(objects)
+            elif len(delta.objects) > 0 or any(isinstance(proxy, MeshProxy) for proxy in resolved):
+                # Transform-only updates (or mesh edits and reloads) keep the same tree
+                self.bvh.refit(objects)
+            else:
+                # Same objects in the same order, the scene list is shared so it can be compared by identity
+                # (See Malt.Nodes.SceneFilter)
+                self.bvh.objects = objects
+
+        scene = Scene.Scene()
+        scene.camera = delta.camera
+        scene.parameters = self.intern(delta.parameters)
+        scene.world_parameters = self.intern(delta.world_parameters)
+        scene.frame = delta.frame
+        scene.time = delta.time
+        scene.objects = objects
+        scene.bvh = self.bvh
+        scene.lights = [self.lights[key] for key in delta.light_keys]
+        scene.proxys = self.proxys
+        scene.proxys_version = self.proxys_version
+        # Copy the dictionaries, so each scene update can be identified by its batches
+        scene.batches = {}
+        for material, meshes in self.batches.items():
+            scene.batches[material] = {mesh : dict(scale_groups) for mesh, scale_groups in meshes.items()}
+
+        return scene
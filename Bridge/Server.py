@@ -12,6 +12,7 @@ from Malt.GL.Texture import Texture
 from Malt.PipelinePlugin import load_plugins_from_dir
 
 import Bridge.Mesh, Bridge.Material, Bridge.Texture
+from Bridge.SceneSync import ServerSceneSync
 from . import ipc as ipc
 
 from Malt.Utils import LOG
@@ -66,28 +67,47 @@ def log_system_info():
     LOG.info('-'*80)
 
 class PBO():
+    # Persistently mapped pixel pack buffer, only reallocated when it needs to grow
 
     def __init__(self):
-        self.handle = gl_buffer(GL_INT, 1)
-        self.size = None
-        self.sync = None
+        self.handle = None
+        self.capacity = 0
+        self.size = 0
+        self.address = None
         self.buffer = None
+        self.resolution = None
+        # Checksums PBO, for tiled readback
+        self.checksums = None
     
     def __del__(self):
-        glDeleteBuffers(1, self.handle)
+        self.release()
+    
+    def release(self):
+        if self.handle:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, self.handle[0])
+            glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+            glDeleteBuffers(1, self.handle)
+            self.handle = None
+            self.address = None
     
     def setup(self, texture, buffer):
         self.buffer = buffer
         render_target = RenderTarget([texture])
         w,h = texture.resolution
         size = w * h * texture.channel_count * texture.channel_size
-        assert(buffer.size_in_bytes() >= size)
-        if self.size != size:
-            self.size = size
-            glDeleteBuffers(1, self.handle)
+        assert(buffer is None or buffer.size_in_bytes() >= size)
+        self.size = size
+        self.resolution = (w,h)
+        if size > self.capacity:
+            self.release()
+            self.capacity = size
+            flags = GL_MAP_READ_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+            self.handle = gl_buffer(GL_INT, 1)
             glGenBuffers(1, self.handle)
             glBindBuffer(GL_PIXEL_PACK_BUFFER, self.handle[0])
-            glBufferData(GL_PIXEL_PACK_BUFFER, size, None, GL_STREAM_READ)
+            glBufferStorage(GL_PIXEL_PACK_BUFFER, size, None, flags)
+            self.address = ctypes.cast(glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, size, flags), ctypes.c_void_p).value
             glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
         
         render_target.bind()
@@ -96,26 +116,232 @@ class PBO():
         glBindBuffer(GL_PIXEL_PACK_BUFFER, self.handle[0])
         GL.glReadPixels(0, 0, w, h, texture.format, texture.data_format, 0)
         glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+    
+    def copy(self, tiles=None):
+        # Called from the ReadbackCopyThread, no GL calls allowed
+        # Returns the copied bytes
+        if tiles:
+            return tiles.copy(self)
+        ctypes.memmove(self.buffer.buffer(), self.address, self.size)
+        return self.size
 
-        if self.sync:
-            glDeleteSync(self.sync)
+
+class TileReadback():
+    # Copies only the tiles that changed since the last copied frame, based on their GPU checksums (See TileChecksum.glsl).
+    # The client buffer stores the tile size, a frame counter and a version counter per tile.
+    # The counters are incremented after each copy (See Bridge.Client_API.TILE_SIZE).
+
+    def __init__(self, versions):
+        self.versions = versions
+        self.tile_size = versions.buffer()[0]
+        self.checksum_texture = None
+        self.checksum_target = None
+        self.checksums = None
+        self.destination = None
+    
+    def get_tile_count(self, resolution):
+        w,h = resolution
+        return -(-w // self.tile_size), -(-h // self.tile_size)
+    
+    def compute_checksums(self, pipeline, texture):
+        global TILE_CHECKSUM_SHADER
+        if TILE_CHECKSUM_SHADER is None:
+            TILE_CHECKSUM_SHADER = pipeline.compile_shader_from_source('#include "Passes/TileChecksum.glsl"')
+        tile_count = self.get_tile_count(texture.resolution)
+        if self.checksum_texture is None or self.checksum_texture.resolution != tile_count:
+            self.checksum_texture = Texture(tile_count, GL_RGBA32UI, min_filter=GL_NEAREST, mag_filter=GL_NEAREST)
+            self.checksum_texture.channel_count = 4 # GL_RGBA_INTEGER
+            self.checksum_target = RenderTarget([self.checksum_texture])
+        TILE_CHECKSUM_SHADER.uniforms['tile_size'].set_value(self.tile_size)
+        TILE_CHECKSUM_SHADER.textures['input_texture'] = texture
+        pipeline.draw_screen_pass(TILE_CHECKSUM_SHADER, self.checksum_target)
+        return self.checksum_texture
+
+    def copy(self, pbo):
+        # Called from the ReadbackCopyThread
+        # Returns the copied bytes
+        import numpy as np
+        tiles_x, tiles_y = self.get_tile_count(pbo.resolution)
+        w,h = pbo.resolution
+        checksums = (ctypes.c_uint32 * (tiles_x * tiles_y * 4)).from_address(pbo.checksums.address)
+        checksums = np.ctypeslib.as_array(checksums).reshape(tiles_y, tiles_x, 4).copy()
+        if self.checksums is None or self.checksums.shape != checksums.shape or self.destination is not pbo.buffer:
+            changed = np.ones((tiles_y, tiles_x), bool)
+        else:
+            changed = (checksums != self.checksums).any(axis=2)
+        self.checksums = checksums
+        self.destination = pbo.buffer
+
+        copied_bytes = 0
+        if changed.mean() > 0.5:
+            ctypes.memmove(pbo.buffer.buffer(), pbo.address, pbo.size)
+            copied_bytes = pbo.size
+        else:
+            row_size = pbo.size // h
+            pixel_size = row_size // w
+            source = np.ctypeslib.as_array((ctypes.c_ubyte * pbo.size).from_address(pbo.address)).reshape(h, row_size)
+            destination = np.ctypeslib.as_array((ctypes.c_ubyte * pbo.size).from_buffer(pbo.buffer.buffer())).reshape(h, row_size)
+            # Copy the horizontal runs of changed tiles
+            for tile_y, row in enumerate(changed.tolist()):
+                y0 = tile_y * self.tile_size
+                y1 = min(h, y0 + self.tile_size)
+                tile_x = 0
+                while tile_x < tiles_x:
+                    if row[tile_x] == False:
+                        tile_x += 1
+                        continue
+                    start = tile_x
+                    while tile_x < tiles_x and row[tile_x]:
+                        tile_x += 1
+                    x0 = start * self.tile_size * pixel_size
+                    x1 = min(w, tile_x * self.tile_size) * pixel_size
+                    destination[y0:y1, x0:x1] = source[y0:y1, x0:x1]
+                    copied_bytes += (y1 - y0) * (x1 - x0)
+        
+        counters = np.ctypeslib.as_array(self.versions.buffer())
+        versions = counters[2:2 + tiles_x * tiles_y].reshape(tiles_y, tiles_x)
+        versions[changed] += 1
+        counters[1] += 1
+        return copied_bytes
+
+TILE_CHECKSUM_SHADER = None
+
+
+class ReadbackFrame():
+    # The PBOs of a rendered frame. (FREE -> GPU -> COPY -> FREE)
+
+    def __init__(self):
+        self.pbos = {}
+        self.state = 'FREE'
+        self.sync = None
+        self.resolution = None
+        self.index = 0
+        self.copied = False
+        self.tiles = None
+
+    def submit(self, index, resolution):
+        self.index = index
+        self.resolution = resolution
         self.sync = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.state = 'GPU'
     
     def poll(self):
         wait = glClientWaitSync(self.sync, GL_SYNC_FLUSH_COMMANDS_BIT, 0)
-        return wait == GL_ALREADY_SIGNALED
+        return wait in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED)
     
-    def load(self):
-        wait = glClientWaitSync(self.sync, GL_SYNC_FLUSH_COMMANDS_BIT, 0)
-        if wait == GL_ALREADY_SIGNALED:
-            glBindBuffer(GL_PIXEL_PACK_BUFFER, self.handle[0])
-            result = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
-            if result:
-                ctypes.memmove(self.buffer.buffer(), result, self.size)
-                glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
-            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
-            return True
-        return False
+    def free(self):
+        if self.sync:
+            glDeleteSync(self.sync)
+            self.sync = None
+        self.state = 'FREE'
+
+
+class ReadbackCopyThread():
+    # Copies the mapped PBOs to the shared memory buffers, so the render thread doesn't have to.
+    # (ctypes.memmove releases the GIL)
+
+    def __init__(self):
+        import threading, queue
+        self.queue = queue.Queue()
+        self.copied_bytes = 0
+        self.copy_time = 0
+        self.thread = threading.Thread(target=self.run, daemon=True, name='Malt Readback Copy')
+        self.thread.start()
+    
+    def run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            start = time.perf_counter()
+            try:
+                for key, pbo in frame.pbos.items():
+                    self.copied_bytes += pbo.copy(frame.tiles if key == 'COLOR' else None)
+            except:
+                import traceback
+                LOG.error(traceback.format_exc())
+            self.copy_time += time.perf_counter() - start
+            frame.copied = True
+            get_wakeup().set()
+    
+    def add(self, frame):
+        frame.copied = False
+        frame.state = 'COPY'
+        self.queue.put(frame)
+    
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def get_bandwidth(self):
+        # GB/s since the last call
+        bandwidth = self.copied_bytes / self.copy_time / (1024**3) if self.copy_time > 0 else 0
+        self.copied_bytes = 0
+        self.copy_time = 0
+        return bandwidth
+    
+    def shutdown(self):
+        self.queue.put(None)
+
+READBACK_COPY_THREAD = None
+
+def get_readback_copy_thread():
+    global READBACK_COPY_THREAD
+    if READBACK_COPY_THREAD is None:
+        READBACK_COPY_THREAD = ReadbackCopyThread()
+    return READBACK_COPY_THREAD
+
+
+class Wakeup():
+    # Interrupts the main loop wait from other threads (See main)
+    # A socket pair, since multiprocessing.connection.wait accepts sockets on every platform.
+
+    def __init__(self):
+        import socket
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+    
+    def fileno(self):
+        return self.reader.fileno()
+    
+    def set(self):
+        try:
+            self.writer.send(b'\0')
+        except OSError:
+            # The socket buffer is full, so there's a wakeup pending already
+            pass
+    
+    def clear(self):
+        try:
+            while self.reader.recv(4096):
+                pass
+        except OSError:
+            pass
+
+WAKEUP = None
+
+def get_wakeup():
+    global WAKEUP
+    if WAKEUP is None:
+        WAKEUP = Wakeup()
+    return WAKEUP
+
+
+class Histogram():
+    # Power of 2 millisecond buckets
+
+    BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+    
+    def add(self, seconds):
+        import bisect
+        self.counts[bisect.bisect_right(self.BUCKETS, seconds * 1000)] += 1
+    
+    def __str__(self):
+        labels = ['<{}'.format(b) for b in self.BUCKETS] + ['>={}'.format(self.BUCKETS[-1])]
+        return ' '.join('{}:{}'.format(label, count) for label, count in zip(labels, self.counts) if count > 0)
 
 
 class Viewport():
@@ -130,17 +356,27 @@ class Viewport():
         self.target_format = None
         self.final_texture = None
         self.final_target = None
-        self.pbos_active = []
-        self.pbos_inactive = []
+        # Ring of readback frames, see Viewport.Readback Latency
+        self.readback_frames = []
+        self.readback_latency = 3
+        self.readback_index = 0
+        self.readback_copied = 0
+        self.tile_readback = None
         self.is_new_frame = True
         self.needs_more_samples = True
         self.is_final_render = is_final_render
         self.renderdoc_capture = False
+        self.scene_sync = ServerSceneSync(pipeline)
 
         self.stat_max_frame_latency = 0
         self.stat_cpu_frame_time = 0
         self.stat_time_start = 0
         self.stat_render_time = 0
+        self.stat_readback_bandwidth = 0
+        # Main loop time of each sample, and time from setup to the first frame copied to the client
+        self.stat_sample_times = Histogram()
+        self.stat_latencies = Histogram()
+        self.stat_setup_readback_index = None
     
     def get_print_stats(self):
         return '\n'.join((
@@ -148,15 +384,26 @@ class Viewport():
             'Sample : {} / {}'.format(self.pipeline.sample_count, len(self.pipeline.get_samples())),
             'Sample Time : {:.3f} ms'.format((self.stat_render_time * 1000) / self.pipeline.sample_count),
             'Total Time : {:.3f} s'.format(self.stat_render_time),
-            'Latency : {} frames'.format(len(self.pbos_active)),
+            'Latency : {} frames'.format(self.readback_in_flight()),
             'Max Latency : {} frames'.format(self.stat_max_frame_latency),
+            'Readback Queue : {} frames'.format(get_readback_copy_thread().queue_depth()),
+            'Readback Bandwidth : {:.2f} GB/s'.format(self.stat_readback_bandwidth),
+            'Sample Times (ms) : {}'.format(self.stat_sample_times),
+            'Setup Latencies (ms) : {}'.format(self.stat_latencies),
+            'Culled : {} / {} instances'.format(self.pipeline.culling.stat_culled, self.pipeline.culling.stat_total),
+            *('Occlusion {} : {} / {} instances visible'.format(name, *stats)
+                for name, stats in sorted(self.pipeline.occlusion_stats.items())),
         ))
     
-    def setup(self, new_buffers, resolution, scene, scene_update, renderdoc_capture):
+    def is_waiting_gpu(self):
+        return any(frame.state == 'GPU' for frame in self.readback_frames)
+
+    def readback_in_flight(self):
+        return len([f for f in self.readback_frames if f.state != 'FREE'])
+    
+    def setup(self, new_buffers, resolution, scene, renderdoc_capture):
         if self.resolution != resolution:
             self.resolution = resolution
-            self.pbos_inactive.extend(self.pbos_active)
-            self.pbos_active = []
             assert(new_buffers is not None)
             if self.bit_depth == 8:
                 self.target_format = GL_UNSIGNED_BYTE
@@ -188,20 +435,17 @@ class Viewport():
         self.renderdoc_capture = renderdoc_capture
 
         self.stat_time_start = time.perf_counter()
+        self.stat_setup_readback_index = self.readback_index
         
-        if scene_update or self.scene is None:
-            for key, proxy in scene.proxys.items():
-                proxy.resolve()
-            
-            for obj in scene.objects:
-                obj.matrix = (ctypes.c_float * 16)(*obj.matrix)
-            
-            scene.batches = self.pipeline.build_scene_batches(scene.objects)
-            self.scene = scene
+        if scene.scene_update or self.scene is None:
+            self.scene = self.scene_sync.apply(scene)
         else:
             self.scene.camera = scene.camera
             self.scene.time = scene.time
             self.scene.frame = scene.frame
+        
+        latency = self.scene.world_parameters.get('Viewport.Readback Latency', 3)
+        self.readback_latency = 1 if self.is_final_render else max(1, min(int(latency), 8))
     
     TO_SRGB_SHADER = None
     def to_srgb(self, texture, target):
@@ -230,51 +474,360 @@ class Viewport():
             renderdoc.capture_start()
 
         if self.needs_more_samples:
+            sample_start = time.perf_counter()
             result = self.pipeline.render(self.resolution, self.scene, self.is_final_render, self.is_new_frame)
             self.is_new_frame = False
             self.needs_more_samples = self.pipeline.needs_more_samples()
             if self.is_final_render == False or self.needs_more_samples == False:
-                pbos = None
-                if len(self.pbos_inactive) > 0:
-                    pbos = self.pbos_inactive.pop()
-                else:
-                    pbos = {}
-                for key, texture in result.items():
-                    if texture and key in self.buffers.keys():
-                        if key not in pbos.keys():
-                            pbos[key] = PBO()
-                        texture = self.ensure_correct_format(key, texture)
-                        pbos[key].setup(texture, self.buffers[key])
-                self.pbos_active.append(pbos)
-            
-        if len(self.pbos_active) > 0:
-            for i, pbos in reversed(list(enumerate(self.pbos_active))):
-                is_ready = True
-                for pbo in pbos.values():
-                    if pbo.poll() == False:
-                        is_ready = False
-                if is_ready:
-                    for pbo in pbos.values():
-                        pbo.load()
-                        self.pbos_inactive.extend(self.pbos_active[:i+1])
-                        self.pbos_active = self.pbos_active[i+1:]
-                        self.read_resolution = self.resolution
-                    break
-            
+                # Intermediate samples can be skipped if all the readback frames are busy, the last one can't
+                frame = self.acquire_readback_frame(wait = self.needs_more_samples == False)
+                if frame:
+                    frame.tiles = self.get_tile_readback()
+                    for key, texture in result.items():
+                        if texture and key in self.buffers.keys():
+                            if key not in frame.pbos.keys():
+                                frame.pbos[key] = PBO()
+                            texture = self.ensure_correct_format(key, texture)
+                            frame.pbos[key].setup(texture, self.buffers[key])
+                            if key == 'COLOR' and frame.tiles:
+                                pbo = frame.pbos[key]
+                                if pbo.checksums is None:
+                                    pbo.checksums = PBO()
+                                pbo.checksums.setup(frame.tiles.compute_checksums(self.pipeline, texture), None)
+                    self.readback_index += 1
+                    frame.submit(self.readback_index, self.resolution)
+            self.stat_sample_times.add(time.perf_counter() - sample_start)
+        
+        if self.readback_in_flight() > 0:
+            self.poll_readback_frames()
             self.stat_render_time = time.perf_counter() - self.stat_time_start
-            self.stat_max_frame_latency = max(len(self.pbos_active), self.stat_max_frame_latency)
+            self.stat_max_frame_latency = max(self.readback_in_flight(), self.stat_max_frame_latency)
+            self.stat_readback_bandwidth = get_readback_copy_thread().get_bandwidth() or self.stat_readback_bandwidth
         
         if self.renderdoc_capture:
             renderdoc.capture_end()
             self.renderdoc_capture = False
         
-        return self.needs_more_samples == False and len(self.pbos_active) == 0
+        return self.needs_more_samples == False and self.readback_in_flight() == 0
+    
+    def get_tile_readback(self):
+        tiles = self.buffers.get('__TILES')
+        if tiles is None or self.is_final_render:
+            self.tile_readback = None
+        elif self.tile_readback is None or self.tile_readback.versions is not tiles:
+            self.tile_readback = TileReadback(tiles)
+        return self.tile_readback
+
+    def poll_readback_frames(self):
+        copy_thread = get_readback_copy_thread()
+        in_flight = sorted([f for f in self.readback_frames if f.state == 'GPU'], key=lambda f: f.index)
+        # Only the newest finished frame is copied, older ones are dropped
+        for i, frame in reversed(list(enumerate(in_flight))):
+            if frame.poll():
+                for older in in_flight[:i]:
+                    older.free()
+                copy_thread.add(frame)
+                break
+        newest_copied = None
+        for frame in self.readback_frames:
+            if frame.state == 'COPY' and frame.copied:
+                if newest_copied is None or frame.index > newest_copied.index:
+                    newest_copied = frame
+                frame.free()
+        if newest_copied:
+            self.read_resolution = newest_copied.resolution
+            self.readback_copied += 1
+            if self.stat_setup_readback_index is not None and newest_copied.index > self.stat_setup_readback_index:
+                self.stat_latencies.add(time.perf_counter() - self.stat_time_start)
+                self.stat_setup_readback_index = None
+
+    def acquire_readback_frame(self, wait):
+        while len(self.readback_frames) > self.readback_latency:
+            frame = self.readback_frames.pop()
+            if frame.state == 'GPU':
+                frame.free()
+            elif frame.state == 'COPY':
+                # Still in use by the copy thread
+                self.readback_frames.insert(0, frame)
+                break
+        while True:
+            for frame in self.readback_frames:
+                if frame.state == 'FREE':
+                    return frame
+            if len(self.readback_frames) < self.readback_latency:
+                frame = ReadbackFrame()
+                self.readback_frames.append(frame)
+                return frame
+            if wait == False:
+                return None
+            oldest = min([f for f in self.readback_frames if f.state == 'GPU'], key=lambda f: f.index, default=None)
+            if oldest:
+                glClientWaitSync(oldest.sync, GL_SYNC_FLUSH_COMMANDS_BIT, 1000000)
+            else:
+                time.sleep(0.0005)
+            self.poll_readback_frames()
 
 
+# Main loop time split between the viewports that need more samples
+FRAME_BUDGET = 1/60
+# Samples are timed on the CPU side, so this keeps the GPU queue from growing too much
+MAX_SAMPLES_PER_FRAME = 8
+
+class FrameScheduler():
+    # Interleaves the samples of all the viewports, the final render included, on each main loop iteration.
+    # Each viewport renders samples until its share of FRAME_BUDGET runs out.
+    # Viewports whose last frame hasn't been read by the client yet get a minimal share and go last.
+
+    WEIGHT_FINAL_RENDER = 2
+    WEIGHT_VIEWPORT = 1
+    WEIGHT_UNREAD = 0.1
+
+    def __init__(self, control):
+        self.control = control
+    
+    def get_weight(self, viewport_id, viewport):
+        if viewport.is_final_render:
+            return self.WEIGHT_FINAL_RENDER
+        if self.control.is_unread(viewport_id):
+            return self.WEIGHT_UNREAD
+        return self.WEIGHT_VIEWPORT
+
+    def render(self, viewports):
+        # Returns the ids of the viewports that rendered samples, and the ones that have finished
+        weights = {v_id : self.get_weight(v_id, v) for v_id, v in viewports.items() if v.needs_more_samples}
+        total_weight = sum(weights.values())
+        rendered = []
+        finished = []
+        for v_id, v in sorted(viewports.items(), key=lambda item: weights.get(item[0], 0), reverse=True):
+            if v_id in weights:
+                rendered.append(v_id)
+                budget = FRAME_BUDGET * weights[v_id] / total_weight
+                start = time.perf_counter()
+                for i in range(MAX_SAMPLES_PER_FRAME):
+                    has_finished = v.render()
+                    if v.needs_more_samples == False or time.perf_counter() - start > budget:
+                        break
+            else:
+                # Poll the readbacks
+                has_finished = v.render()
+            if has_finished:
+                finished.append(v_id)
+        return rendered, finished
+
+
+# Resource updates received while the final render is in progress are applied once it finishes,
+# so all its samples are rendered with the same state
+DEFERRED_MESSAGES = ('MESH', 'TEXTURE', 'GRADIENT')
+
 PROFILE = False
 
+class MaterialCompiler():
+    # Materials are preprocessed in a pool of worker processes, one job per shader stage.
+    # The GL programs are linked by the shader_compiler thread (Malt.GL.Shader.AsyncShaderCompiler) if there's one,
+    # otherwise in the main thread.
+    # Results are sent to the client once all the material shaders are ready. Materials visible in a viewport go first.
+
+    def __init__(self, pipeline, connection, shader_compiler=None):
+        self.pipeline = pipeline
+        self.connection = connection
+        self.shader_compiler = shader_compiler
+        self.executor = None
+        # path : msg
+        self.pending = {}
+        # path : (msg, graph, cache_key, [futures])
+        self.jobs = {}
+        # path : (msg, graph, cache_key, dependencies, shaders)
+        self.linking = {}
+        self.stat_compiled = 0
+        self.stat_workers = 0
+    
+    def queue_depth(self):
+        return len(self.pending) + len(self.jobs) + len(self.linking)
+    
+    def has_ready_work(self):
+        # Work left over from an update that ran out of time, or finished in the background since then
+        if len(self.pending) > 0:
+            return True
+        if any(all(future.done() for future in job[3]) for job in self.jobs.values()):
+            return True
+        if self.shader_compiler and len(self.shader_compiler.finished) > 0:
+            return True
+        return any(not any(s.is_pending() for s in job[4].values()) for job in self.linking.values())
+    
+    def get_print_stats(self):
+        return '\n'.join((
+            'Queue : {} materials'.format(self.queue_depth()),
+            'Compiled : {} materials'.format(self.stat_compiled),
+            'Workers : {}'.format(self.stat_workers),
+        ))
+    
+    def get_executor(self):
+        if self.executor is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            self.stat_workers = max(1, (os.cpu_count() or 2) - 1)
+            self.executor = ProcessPoolExecutor(self.stat_workers, multiprocessing.get_context('spawn'))
+        return self.executor
+    
+    def restart_executor(self):
+        # A new worker pool is created by the next get_executor
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+    
+    def shutdown(self):
+        # Only on exit, the shader compiler can't be restarted
+        if self.shader_compiler:
+            self.shader_compiler.shutdown()
+        self.restart_executor()
+    
+    def add(self, msg):
+        path = msg['path']
+        job = self.jobs.pop(path, None)
+        if job:
+            for future in job[3]:
+                future.cancel()
+        self.linking.pop(path, None)
+        # A newer request replaces the queued one
+        self.pending[path] = msg
+    
+    def send(self, msg, compiled_material=None):
+        material = Bridge.Material.Material(msg['path'], self.pipeline, msg['search_paths'], msg['custom_passes'], 
+            compiled_material)
+        self.connection.send({
+            'msg_type': 'MATERIAL',
+            'material' : material
+        })
+        self.stat_compiled += 1
+    
+    def get_graph(self, material_type):
+        from Malt.Pipeline import Pipeline
+        from Malt.PipelineGraph import GLSLPipelineGraph
+        # Pipelines with custom material compilation can't be split in stages
+        if type(self.pipeline).compile_material_from_source is not Pipeline.compile_material_from_source:
+            return None
+        graph = self.pipeline.graphs.get(material_type)
+        if isinstance(graph, GLSLPipelineGraph):
+            return graph
+        return None
+    
+    def schedule(self, msg):
+        path = msg['path']
+        material_type, source, include_paths = self.pipeline.get_material_source(path, msg['search_paths'])
+        graph = self.get_graph(material_type)
+        if graph is None:
+            return self.send(msg)
+        cache_key = graph.get_material_cache_key(source, include_paths)
+        shaders = graph.load_cached_material(cache_key)
+        if shaders:
+            return self.send(msg, shaders)
+        from Malt.GL.GLSLPreprocessor import preprocess_stage
+        executor = self.get_executor()
+        futures = []
+        for include_directories, definitions in graph.get_material_stages(source, include_paths):
+            future = executor.submit(preprocess_stage, source, include_directories, definitions)
+            future.add_done_callback(lambda future: get_wakeup().set())
+            futures.append(future)
+        self.jobs[path] = (msg, graph, cache_key, futures)
+    
+    def link(self, path):
+        msg, graph, cache_key, futures = self.jobs.pop(path)
+        try:
+            results = [future.result() for future in futures]
+        except:
+            from concurrent.futures.process import BrokenProcessPool
+            if isinstance(sys.exc_info()[1], BrokenProcessPool):
+                LOG.warning('Material compiler worker pool is broken, restarting it')
+                self.restart_executor()
+            # Compile again in the main thread, so errors are reported as usual
+            return self.send(msg)
+        dependencies = {}
+        for result, result_dependencies in results:
+            dependencies.update(result_dependencies)
+        preprocessed = [result for result, result_dependencies in results]
+        if self.shader_compiler:
+            shaders = graph.link_material(preprocessed, dependencies, cache_key, self.shader_compiler)
+            self.linking[path] = (msg, graph, cache_key, dependencies, shaders)
+        else:
+            self.send(msg, graph.link_material(preprocessed, dependencies, cache_key))
+    
+    def finish(self, path):
+        msg, graph, cache_key, dependencies, shaders = self.linking.pop(path)
+        graph.cache_material(shaders, dependencies, cache_key)
+        self.send(msg, shaders)
+    
+    def update(self, visible_paths, time_budget):
+        # At least one material is processed on each update, even if it goes over the time budget
+        start_time = time.perf_counter()
+        def has_time():
+            return time.perf_counter() - start_time < time_budget
+        def priority(path):
+            return 0 if path in visible_paths else 1
+
+        if self.shader_compiler:
+            self.shader_compiler.update()
+            linked = [path for path, job in self.linking.items() if not any(s.is_pending() for s in job[4].values())]
+            for path in sorted(linked, key=priority):
+                try:
+                    self.finish(path)
+                except:
+                    import traceback
+                    LOG.error(traceback.format_exc())
+                if has_time() == False:
+                    return
+
+        ready = [path for path, job in self.jobs.items() if all(future.done() for future in job[3])]
+        for path in sorted(ready, key=priority):
+            try:
+                self.link(path)
+            except:
+                import traceback
+                LOG.error(traceback.format_exc())
+            if has_time() == False:
+                return
+        
+        for path in sorted(self.pending.keys(), key=priority):
+            msg = self.pending.pop(path)
+            try:
+                self.schedule(msg)
+            except:
+                import traceback
+                LOG.error(traceback.format_exc())
+                self.send(msg)
+            if has_time() == False:
+                return
+
+
+# GL fences can't be waited on together with the connections, so they're polled
+FENCE_POLL_INTERVAL = 0.001
+# Keep processing window events while idle
+IDLE_TIMEOUT = 1.0
+
+def get_wait_timeout(viewports, material_compiler):
+    # How long the main loop can sleep until there's work to do.
+    # Messages, finished readback copies and material compiler jobs wake it up earlier.
+    if any(v.needs_more_samples for v in viewports.values()):
+        return 0
+    if material_compiler.has_ready_work():
+        return 0
+    if any(v.is_waiting_gpu() for v in viewports.values()):
+        return FENCE_POLL_INTERVAL
+    return IDLE_TIMEOUT
+
+
+def get_visible_material_paths(viewports):
+    from Bridge.Proxys import MaterialProxy
+    paths = set()
+    for viewport in viewports.values():
+        if viewport.scene and viewport.is_final_render == False:
+            for proxy in getattr(viewport.scene, 'proxys', {}).values():
+                if isinstance(proxy, MaterialProxy):
+                    paths.add(proxy.path)
+    return paths
+
+
 def main(pipeline_path, viewport_bit_depth, connection_addresses,
-    shared_dic, lock, log_path, debug_mode, plugins_paths, docs_path):
+    control, lock, log_path, debug_mode, plugins_paths, docs_path):
     LOG.info('DEBUG MODE: {}'.format(debug_mode))
 
     LOG.info('CONNECTIONS:')
@@ -303,6 +856,7 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
     
     LOG.info('INIT PIPELINE: ' + pipeline_path)
 
+    pipeline = None
     try:
         pipeline_dir, pipeline_name = os.path.split(pipeline_path)
         if pipeline_dir not in sys.path:
@@ -351,9 +905,39 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
 
     viewports = {}
 
+    shader_compiler = None
+    try:
+        # A hidden context that shares objects with the main one, so materials can be linked in the background
+        glfw.window_hint(glfw.VISIBLE, glfw.FALSE)
+        compiler_window = glfw.create_window(1, 1, 'Malt Shader Compiler', None, window)
+        if compiler_window:
+            from Malt.GL.Shader import AsyncShaderCompiler
+            shader_compiler = AsyncShaderCompiler(lambda: glfw.make_context_current(compiler_window), get_wakeup().set)
+    except:
+        import traceback
+        LOG.warning(traceback.format_exc())
+    
+    material_compiler = MaterialCompiler(pipeline, connections['MAIN'], shader_compiler)
+    material_compiler_was_active = False
+    # Viewports set up since their last finished render
+    unfinished_viewports = set()
+    frame_scheduler = FrameScheduler(control)
+    deferred_messages = []
+
+    # The loop blocks on the connections until there's something to do, instead of spinning.
+    # Work is dispatched by priority: messages, final render, viewports, background material compilation.
+    wakeup = get_wakeup()
+    wait_list = [connections['MAIN'], connections['REFLECTION'], wakeup]
+
     while glfw.window_should_close(window) == False:
         
         try:
+            timeout = get_wait_timeout(viewports, material_compiler)
+            if len(deferred_messages) > 0 and 0 not in unfinished_viewports:
+                timeout = 0
+            connection.wait(wait_list, timeout)
+            wakeup.clear()
+
             profiler = cProfile.Profile()
             profiling_data = io.StringIO()
             global PROFILE
@@ -399,19 +983,21 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
                     graphs = pipeline.get_graphs()
                     connections['REFLECTION'].send(graphs)
 
-            while connections['MAIN'].poll():
-                msg = connections['MAIN'].recv()
+            while True:
+                if len(deferred_messages) > 0 and 0 not in unfinished_viewports:
+                    msg = deferred_messages.pop(0)
+                elif connections['MAIN'].poll():
+                    msg = connections['MAIN'].recv()
+                else:
+                    break
+                
+                if msg['msg_type'] in DEFERRED_MESSAGES and 0 in unfinished_viewports:
+                    deferred_messages.append(msg)
+                    continue
                 
                 if msg['msg_type'] == 'MATERIAL':
                     LOG.debug('COMPILE MATERIAL : {}'.format(msg))
-                    path = msg['path']
-                    search_paths = msg['search_paths']
-                    custom_passes = msg['custom_passes']
-                    material = Bridge.Material.Material(path, pipeline, search_paths, custom_passes)
-                    connections['MAIN'].send({
-                        'msg_type': 'MATERIAL',
-                        'material' : material
-                    })
+                    material_compiler.add(msg)
                 
                 if msg['msg_type'] == 'MESH':
                     msg_log = copy.copy(msg)
@@ -437,7 +1023,6 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
                     viewport_id = msg['viewport_id']
                     resolution = msg['resolution']
                     scene = msg['scene']
-                    scene_update = msg['scene_update']
                     new_buffers = msg['new_buffers']
                     renderdoc_capture = msg['renderdoc_capture']
 
@@ -445,38 +1030,45 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
                         bit_depth = viewport_bit_depth if viewport_id != 0 else 32
                         viewports[viewport_id] = Viewport(pipeline_class(plugins), viewport_id == 0, bit_depth)
 
-                    viewports[viewport_id].setup(new_buffers, resolution, scene, scene_update, renderdoc_capture)
-                    shared_dic[(viewport_id, 'FINISHED')] = False
-                    shared_dic[(viewport_id, 'SETUP')] = True
-
-                    if viewport_id == 0: # Final Render
-                        # Render all samples at once to ensure render is done with the correct state
-                        while viewports[0].render() == False:
-                            continue
+                    try:
+                        viewports[viewport_id].setup(new_buffers, resolution, scene, renderdoc_capture)
+                    except:
+                        # The retained scene can't be trusted anymore, ask the client for a full scene
+                        viewports[viewport_id].scene_sync.reset()
+                        viewports[viewport_id].scene = None
+                        viewports[viewport_id].needs_more_samples = False
+                        unfinished_viewports.discard(viewport_id)
+                        control.request_resync(viewport_id)
+                        control.set_setup_done(viewport_id)
+                        raise
+                    unfinished_viewports.add(viewport_id)
+                    control.set_setup_done(viewport_id)
             
-            active_viewports = {}
-            render_finished = True
+            rendered, finished = frame_scheduler.render(viewports)
+            active_viewports = {v_id : viewports[v_id] for v_id in rendered}
             for v_id, v in viewports.items():
-                if v.needs_more_samples:
-                    active_viewports[v_id] = v
-                has_finished = v.render()
-                if has_finished == False:
-                    render_finished = False
-                shared_dic[(v_id, 'READ_RESOLUTION')] = v.read_resolution
-                if has_finished and shared_dic[(v_id, 'FINISHED')] == False:
-                    shared_dic[(v_id, 'FINISHED')] = True
+                control.set_read_resolution(v_id, v.read_resolution)
+                control.set_ready_frames(v_id, v.readback_copied)
+                if v_id in finished and v_id in unfinished_viewports:
+                    unfinished_viewports.discard(v_id)
+                    control.set_finished(v_id)
             
-            if render_finished:
-                glfw.swap_interval(1)
-            else:
-                glfw.swap_interval(0)
-            glfw.swap_buffers(window)
-
             if len(active_viewports) > 0:
+                glfw.swap_buffers(window)
+            
+            if material_compiler.queue_depth() > 0:
+                rendering = len(active_viewports) > 0
+                material_compiler.update(get_visible_material_paths(viewports), 0.016 if rendering else 0.25)
+
+            material_compiler_is_active = material_compiler.queue_depth() > 0
+            if len(active_viewports) > 0 or material_compiler_is_active or material_compiler_was_active:
                 stats = ''
+                if material_compiler_is_active or material_compiler_was_active:
+                    stats += "Material Compiler:\n{}\n\n".format(material_compiler.get_print_stats())
+                material_compiler_was_active = material_compiler_is_active
                 for v_id, v in active_viewports.items():
                     stats += "Viewport ({}):\n{}\n\n".format(v_id, v.get_print_stats())
-                shared_dic['STATS'] = stats
+                control.set_stats(stats)
                 LOG.debug('STATS: {} '.format(stats))
             
             if PROFILE:
@@ -494,4 +1086,7 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
             import traceback
             LOG.error(traceback.format_exc())
 
+    material_compiler.shutdown()
+    if READBACK_COPY_THREAD:
+        READBACK_COPY_THREAD.shutdown()
     glfw.terminate()
@@ -1,11 +1,11 @@
 def reload():
     import importlib
-    from . import Client_API, Server, Material, Mesh, Texture
-    for module in [ Client_API, Server, Material, Mesh, Texture ]:
+    from . import Client_API, Server, Material, Mesh, Texture, SceneSync
+    for module in [ Client_API, Server, Material, Mesh, Texture, SceneSync ]:
         importlib.reload(module)
 
 def start_server(pipeline_path, viewport_bit_depth, connection_addresses, 
-    shared_dic, lock, log_path, debug_mode, renderdoc_path, plugins_paths, docs_path):
+    control, lock, log_path, debug_mode, renderdoc_path, plugins_paths, docs_path):
     import logging
     log_level = logging.DEBUG if debug_mode else logging.INFO
     logging.basicConfig(filename=log_path, level=log_level, format='Malt > %(message)s')
@@ -28,7 +28,7 @@ def start_server(pipeline_path, viewport_bit_depth, connection_addresses,
     from . import Server
     try:
         Server.main(pipeline_path, viewport_bit_depth, connection_addresses,
-            shared_dic, lock, log_path, debug_mode, plugins_paths, docs_path)
+            control, lock, log_path, debug_mode, plugins_paths, docs_path)
     except:
         import traceback
         logging.error(traceback.format_exc())
@@ -1,4 +1,4 @@
-import os, ctypes, platform
+import os, ctypes, platform, weakref
 
 src_dir = os.path.abspath(os.path.dirname(__file__))
 
@@ -39,29 +39,178 @@ close_shared_memory.restype = None
 
 from Malt.Utils import IBuffer
 
-class SharedBuffer(IBuffer):
+# Shared buffers are sub-allocated from a few large shared memory arenas, so sending a buffer only pickles
+# the arena name and the buffer offset, and each process maps each arena once while it has buffers in it.
+# Arenas are managed by a buddy allocator in the process that creates them (SharedMemoryPool),
+# the extra arenas created for allocation peaks are released once they're empty.
+# The arena header stores a pair of counters for each minimum size block.
+# Each counter has a single writer, so they don't need any synchronization:
+#   sent : Incremented by the owner each time the buffer is pickled.
+#   released : Incremented by the receiving process when its copy is deleted.
+# A buffer is in use by other processes while sent != released.
+
+MIN_BLOCK_SIZE = 1024
+MIN_ARENA_SIZE = 64*1024*1024
+
+class C_BlockCounters(ctypes.Structure):
+    _fields_ = [
+        ('sent', ctypes.c_uint32),
+        ('released', ctypes.c_uint32),
+    ]
 
-    _GARBAGE = []
+def _header_size(arena_size):
+    size = ctypes.sizeof(C_BlockCounters) * (arena_size // MIN_BLOCK_SIZE)
+    return ((size + MIN_BLOCK_SIZE - 1) // MIN_BLOCK_SIZE) * MIN_BLOCK_SIZE
+
+
+class SharedArena():
+
+    def __init__(self, name, size, is_owner):
+        self.name = name
+        self.size = size
+        self.is_owner = is_owner
+        self.header_size = _header_size(size)
+        self.memory = C_SharedMemory()
+        if is_owner:
+            create_shared_memory(name.encode('ascii'), self.header_size + size, ctypes.byref(self.memory))
+            ctypes.memset(self.memory.data, 0, self.header_size)
+        else:
+            open_shared_memory(name.encode('ascii'), self.header_size + size, ctypes.byref(self.memory))
+        self.counters = (C_BlockCounters * (size // MIN_BLOCK_SIZE)).from_address(self.memory.data)
+        self.data = self.memory.data + self.header_size
+        # Buddy allocator state, only used by the owner
+        self.max_order = (size // MIN_BLOCK_SIZE).bit_length() - 1
+        self.free_lists = [set() for i in range(self.max_order + 1)]
+        self.free_lists[self.max_order].add(0)
+        self.allocated = {}
+    
+    def block_size(self, order):
+        return MIN_BLOCK_SIZE << order
     
-    @classmethod
-    def GC(cls):
-        from copy import copy
-        for buffer, release_flag in copy(cls._GARBAGE):
-            if ctypes.c_bool.from_address(release_flag.data).value == True:
-                close_shared_memory(buffer, True)
-                close_shared_memory(release_flag, True)
-                cls._GARBAGE.remove((buffer, release_flag))
+    def block_order(self, size):
+        return max(0, ((size + MIN_BLOCK_SIZE - 1) // MIN_BLOCK_SIZE - 1).bit_length())
+
+    def allocate(self, size):
+        order = self.block_order(size)
+        for split_order in range(order, self.max_order + 1):
+            if len(self.free_lists[split_order]) > 0:
+                offset = self.free_lists[split_order].pop()
+                while split_order > order:
+                    split_order -= 1
+                    self.free_lists[split_order].add(offset + self.block_size(split_order))
+                self.allocated[offset] = order
+                counters = self.counters[offset // MIN_BLOCK_SIZE]
+                counters.sent = 0
+                counters.released = 0
+                return offset
+        return None
+    
+    def free(self, offset):
+        order = self.allocated.pop(offset)
+        while order < self.max_order:
+            buddy = offset ^ self.block_size(order)
+            if buddy not in self.free_lists[order]:
+                break
+            self.free_lists[order].remove(buddy)
+            offset = min(offset, buddy)
+            order += 1
+        self.free_lists[order].add(offset)
+    
+    def shrink(self, offset, size):
+        # Returns the upper halves of the block to the free lists.
+        # Their buddies are the lower halves that stay allocated, so they can't be merged.
+        order = self.allocated[offset]
+        new_order = self.block_order(size)
+        while order > new_order:
+            order -= 1
+            self.free_lists[order].add(offset + self.block_size(order))
+        self.allocated[offset] = order
+    
+    def is_released(self, offset):
+        counters = self.counters[offset // MIN_BLOCK_SIZE]
+        return counters.sent == counters.released
+    
+    def allocated_size(self):
+        return sum(self.block_size(order) for order in self.allocated.values())
+
+    def __del__(self):
+        try:
+            close_shared_memory(self.memory, self.is_owner)
+        except:
+            pass
+
+
+# Arenas opened by the receiving processes, by name.
+# They're kept open only while any of their buffers is alive, so released arenas are unmapped.
+_OPEN_ARENAS = weakref.WeakValueDictionary()
 
-    def __init__(self, ctype, size):
+def _open_arena(name, size):
+    arena = _OPEN_ARENAS.get(name)
+    if arena is None:
+        arena = SharedArena(name, size, False)
+        _OPEN_ARENAS[name] = arena
+    return arena
+
+
+class SharedMemoryPool():
+
+    def __init__(self):
         import random, string
+        self.id = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+        self.arenas = []
+        self.arena_count = 0
+        # Owner buffers deleted while still in use by other processes, as (arena, offset)
+        self.garbage = []
+    
+    def GC(self):
+        for arena, offset in self.garbage[:]:
+            if arena.is_released(offset):
+                self.free(arena, offset)
+                self.garbage.remove((arena, offset))
+    
+    def free(self, arena, offset):
+        arena.free(offset)
+        # Unlink the extra arenas once they're empty, so allocation peaks don't stay reserved.
+        # The first one is kept, since it's reused by every new allocation.
+        if len(arena.allocated) == 0 and arena is not self.arenas[0]:
+            self.arenas.remove(arena)
+
+    def allocate(self, ctype, size):
+        self.GC()
+        size_in_bytes = max(1, ctypes.sizeof(ctype) * size)
+        for arena in self.arenas:
+            offset = arena.allocate(size_in_bytes)
+            if offset is not None:
+                return SharedBuffer(self, arena, offset, ctype, size)
+        arena_size = MIN_ARENA_SIZE
+        while arena_size < size_in_bytes:
+            arena_size *= 2
+        # Released arenas are removed from the list, so names come from a separate counter
+        arena = SharedArena(f'MALT_ARENA_{self.id}_{self.arena_count}', arena_size, True)
+        self.arena_count += 1
+        self.arenas.append(arena)
+        return SharedBuffer(self, arena, arena.allocate(size_in_bytes), ctype, size)
+
+    def release(self, arena, offset):
+        if arena.is_released(offset):
+            self.free(arena, offset)
+        else:
+            self.garbage.append((arena, offset))
+    
+    def get_stats(self):
+        allocated = sum(arena.allocated_size() for arena in self.arenas)
+        reserved = sum(arena.size for arena in self.arenas)
+        return f'Shared Memory : {allocated/(1024*1024):.1f} / {reserved/(1024*1024):.1f} MB'
+
+
+class SharedBuffer(IBuffer):
+
+    def __init__(self, pool, arena, offset, ctype, size):
+        self._pool = pool
+        self._arena = arena
+        self._offset = offset
         self._ctype = ctype
         self._size = size
-        self.id = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
-        self._buffer = C_SharedMemory()
-        create_shared_memory(('MALT_SHARED_'+self.id).encode('ascii'), self.size_in_bytes(), ctypes.byref(self._buffer))
-        self._release_flag = C_SharedMemory()
-        create_shared_memory(('MALT_FLAG_'+self.id).encode('ascii'), ctypes.sizeof(ctypes.c_bool), ctypes.byref(self._release_flag))
-        ctypes.c_bool.from_address(self._release_flag.data).value = True
         self._is_owner = True
     
     def ctype(self):
@@ -71,33 +220,195 @@ class SharedBuffer(IBuffer):
         return self._size
     
     def buffer(self):
-        return (self._ctype*self._size).from_address(self._buffer.data)
+        return (self._ctype*self._size).from_address(self._arena.data + self._offset)
+    
+    def truncate(self, size):
+        # Keeps only the first size elements and returns the unused blocks to the pool.
+        # Only for buffers that are not in use by other processes.
+        assert(self._is_owner and size <= self._size and self._arena.is_released(self._offset))
+        self._size = size
+        self._arena.shrink(self._offset, max(1, ctypes.sizeof(self._ctype) * size))
     
     def __getstate__(self):
         assert(self._is_owner)
-        ctypes.c_bool.from_address(self._release_flag.data).value = False
-        state = self.__dict__.copy()
-        state['_buffer'] = None
-        state['_release_flag'] = None
-        return state
+        self._arena.counters[self._offset // MIN_BLOCK_SIZE].sent += 1
+        return {
+            'arena' : (self._arena.name, self._arena.size),
+            'offset' : self._offset,
+            'ctype' : self._ctype,
+            'size' : self._size,
+        }
 
     def __setstate__(self, state):
-        self.__dict__.update(state)
+        self._pool = None
+        self._arena = _open_arena(*state['arena'])
+        self._offset = state['offset']
+        self._ctype = state['ctype']
+        self._size = state['size']
         self._is_owner = False
-        self._buffer = C_SharedMemory()
-        open_shared_memory(('MALT_SHARED_'+self.id).encode('ascii'), self.size_in_bytes(), ctypes.byref(self._buffer))
-        self._release_flag = C_SharedMemory()
-        open_shared_memory(('MALT_FLAG_'+self.id).encode('ascii'), ctypes.sizeof(ctypes.c_bool), ctypes.byref(self._release_flag))
 
     def __del__(self):
-        if self._is_owner == False or ctypes.c_bool.from_address(self._release_flag.data).value == True:
-            ctypes.c_bool.from_address(self._release_flag.data).value = True
-            close_shared_memory(self._buffer, self._is_owner)
-            close_shared_memory(self._release_flag, self._is_owner)
-        else:
-            buffer_copy = C_SharedMemory()
-            ctypes.memmove(ctypes.addressof(buffer_copy), ctypes.addressof(self._buffer), ctypes.sizeof(C_SharedMemory))
-            flag_copy = C_SharedMemory()
-            ctypes.memmove(ctypes.addressof(flag_copy), ctypes.addressof(self._release_flag), ctypes.sizeof(C_SharedMemory))
-            self._GARBAGE.append((buffer_copy, flag_copy))
-            self.GC()
+        try:
+            if self._is_owner:
+                self._pool.release(self._arena, self._offset)
+            else:
+                self._arena.counters[self._offset // MIN_BLOCK_SIZE].released += 1
+        except:
+            pass
+
+
+# Fixed layout shared state between the Bridge client and the server, replaces a multiprocessing Manager dict.
+# Like the arena counters, every field has a single writer, so no locks are needed:
+#   Client : render_requests, resync_handled, read_frames
+#   Server : setup_done, finished, resync_requests, ready_frames, read_resolution, stats
+# Multi-word values are published with a sequence counter (odd while writing), readers retry on a torn read.
+
+MAX_VIEWPORTS = 64
+STATS_SLOTS = 2
+STATS_SIZE = 16*1024
+
+class C_ViewportControl(ctypes.Structure):
+    _fields_ = [
+        ('render_requests', ctypes.c_uint32),
+        ('resync_handled', ctypes.c_uint32),
+        ('read_frames', ctypes.c_uint32),
+        ('setup_done', ctypes.c_uint32),
+        ('finished', ctypes.c_uint32),
+        ('resync_requests', ctypes.c_uint32),
+        ('ready_frames', ctypes.c_uint32),
+        ('read_resolution_sequence', ctypes.c_uint32),
+        ('read_resolution', ctypes.c_int32 * 2),
+    ]
+
+class C_ControlBlock(ctypes.Structure):
+    _fields_ = [
+        ('viewports', C_ViewportControl * MAX_VIEWPORTS),
+        ('stats_sequence', ctypes.c_uint32),
+        ('stats_length', ctypes.c_uint32 * STATS_SLOTS),
+        ('stats', (ctypes.c_char * STATS_SIZE) * STATS_SLOTS),
+    ]
+
+
+class ControlBlock():
+
+    def __init__(self, pool, context):
+        self.buffer = pool.allocate(ctypes.c_byte, ctypes.sizeof(C_ControlBlock))
+        ctypes.memset(self.buffer.buffer(), 0, ctypes.sizeof(C_ControlBlock))
+        # Set by the server after each render setup, so the client can sleep instead of polling
+        self.setup_event = context.Event()
+        self._block = None
+    
+    def __getstate__(self):
+        return {
+            'buffer' : self.buffer,
+            'setup_event' : self.setup_event,
+        }
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._block = None
+    
+    def block(self):
+        if self._block is None:
+            self._block = C_ControlBlock.from_buffer(self.buffer.buffer())
+        return self._block
+    
+    def viewport(self, viewport_id):
+        assert(viewport_id < MAX_VIEWPORTS)
+        return self.block().viewports[viewport_id]
+
+    # Client
+
+    def request_render(self, viewport_id):
+        self.viewport(viewport_id).render_requests += 1
+    
+    def is_setup_pending(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        return viewport.setup_done != viewport.render_requests
+
+    def wait_setup(self, viewport_id, timeout):
+        import time
+        start = time.perf_counter()
+        while True:
+            self.setup_event.clear()
+            if self.is_setup_pending(viewport_id) == False:
+                return True
+            remaining = timeout - (time.perf_counter() - start)
+            if remaining <= 0:
+                return False
+            self.setup_event.wait(remaining)
+    
+    def is_finished(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        return viewport.render_requests > 0 and viewport.finished == viewport.render_requests
+    
+    def needs_resync(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        return viewport.resync_requests != viewport.resync_handled
+    
+    def resync_handled(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        viewport.resync_handled = viewport.resync_requests
+    
+    def set_read(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        viewport.read_frames = viewport.ready_frames
+    
+    def get_read_resolution(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        while True:
+            sequence = viewport.read_resolution_sequence
+            if sequence == 0:
+                return None
+            resolution = tuple(viewport.read_resolution)
+            if sequence % 2 == 0 and sequence == viewport.read_resolution_sequence:
+                return resolution
+    
+    def get_stats(self):
+        block = self.block()
+        while True:
+            sequence = block.stats_sequence
+            slot = sequence % STATS_SLOTS
+            stats = block.stats[slot].raw[:block.stats_length[slot]]
+            if sequence == block.stats_sequence:
+                return stats.decode('utf-8', errors='replace')
+
+    # Server
+
+    def set_setup_done(self, viewport_id):
+        self.viewport(viewport_id).setup_done += 1
+        self.setup_event.set()
+    
+    def set_finished(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        viewport.finished = viewport.setup_done
+    
+    def request_resync(self, viewport_id):
+        self.viewport(viewport_id).resync_requests += 1
+    
+    def set_ready_frames(self, viewport_id, ready_frames):
+        self.viewport(viewport_id).ready_frames = ready_frames
+    
+    def is_unread(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        return viewport.read_frames != viewport.ready_frames
+    
+    def set_read_resolution(self, viewport_id, resolution):
+        viewport = self.viewport(viewport_id)
+        if resolution is None:
+            return
+        if viewport.read_resolution_sequence > 0 and tuple(viewport.read_resolution) == tuple(resolution):
+            return
+        viewport.read_resolution_sequence += 1
+        viewport.read_resolution[0] = resolution[0]
+        viewport.read_resolution[1] = resolution[1]
+        viewport.read_resolution_sequence += 1
+    
+    def set_stats(self, stats):
+        # Written to the slot the readers aren't using, then published by the sequence increment
+        block = self.block()
+        slot = (block.stats_sequence + 1) % STATS_SLOTS
+        stats = stats.encode('utf-8')[:STATS_SIZE]
+        ctypes.memmove(block.stats[slot], stats, len(stats))
+        block.stats_length[slot] = len(stats)
+        block.stats_sequence += 1
@@ -56,6 +56,18 @@ class DrawQuery():
     def end_conditional_draw(self):
         glEndConditionalRender()
     
+    def get_result(self, wait=False):
+        # None if the result is not available yet and wait is False
+        if self.query is None:
+            return None
+        result = gl_buffer(GL_UNSIGNED_INT, 1)
+        if wait == False:
+            glGetQueryObjectuiv(self.query[0], GL_QUERY_RESULT_AVAILABLE, result)
+            if result[0] == GL_FALSE:
+                return None
+        glGetQueryObjectuiv(self.query[0], GL_QUERY_RESULT, result)
+        return result[0]
+    
 
 def gl_buffer(type, size, data=None):
     types = {
@@ -0,0 +1,776 @@
+import os, re
+
+# In-process C preprocessor for GLSL sources.
+# Supports #include, #define/#undef (object-like, function-like, # and ##), #if/#ifdef/#ifndef/#elif/#else/#endif,
+# #line, #error and #pragma. Comments are kept and #line directives are emitted whenever the output
+# goes out of sync with the source, so compiler errors and GLSLParser reflection point to the original files.
+
+NEWLINE, SPACE, COMMENT, IDENT, NUMBER, STRING, PUNCT = range(7)
+
+_TOKEN_RE = re.compile('|'.join((
+    r'(\n)',
+    r'([ \t\r\f\v]+)',
+    r'(//[^\n]*|/\*.*?(?:\*/|\Z))',
+    r'([A-Za-z_]\w*)',
+    r'(\.?[0-9](?:[eEpP][+-]|[\w.])*)',
+    r'("(?:\\.|[^"\\\n])*"?|\'(?:\\.|[^\'\\\n])*\'?)',
+    r'(##|<<=|>>=|\.\.\.|->|\+\+|--|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&|^]=|.)',
+)), re.S)
+
+_EMPTY = frozenset()
+
+class Token():
+    __slots__ = ('kind', 'value', 'hide')
+
+    def __init__(self, kind, value, hide=_EMPTY):
+        self.kind = kind
+        self.value = value
+        # Names of the macros this token comes from, they can't be expanded again
+        self.hide = hide
+
+    def __repr__(self):
+        return repr(self.value)
+
+_SPACE = Token(SPACE, ' ')
+_NEWLINE = Token(NEWLINE, '\n')
+_WHITESPACE = (SPACE, NEWLINE, COMMENT)
+
+
+def tokenize(text):
+    return [Token(m.lastindex - 1, m.group()) for m in _TOKEN_RE.finditer(text)]
+
+
+class Line():
+    __slots__ = ('number', 'tokens', 'directive', 'text', 'identifiers', 'comments')
+
+    def __init__(self, number, tokens):
+        self.number = number
+        self.tokens = tokens
+        self.directive = None
+        self.text = ''.join(t.value for t in tokens)
+        self.identifiers = frozenset(t.value for t in tokens if t.kind == IDENT)
+        self.comments = None
+        for i, token in enumerate(tokens):
+            if token.kind in _WHITESPACE:
+                continue
+            if token.kind == PUNCT and token.value == '#':
+                self.directive = ''
+                for next in tokens[i+1:]:
+                    if next.kind not in _WHITESPACE:
+                        self.directive = next.value
+                        break
+                # Comments are removed from directives, but still sent to the output
+                comments = [t.value for t in tokens if t.kind == COMMENT]
+                if comments:
+                    self.comments = ' '.join(comments)
+            break
+
+    def arguments(self):
+        # Tokens after the directive name
+        tokens = self.tokens
+        i = 0
+        while tokens[i].value != '#': i += 1
+        i += 1
+        while i < len(tokens) and tokens[i].kind in _WHITESPACE: i += 1
+        return tokens[i+1:]
+
+
+def split_lines(text):
+    # Splice backslash-newlines, but keep track of the original line numbers
+    parts = text.split('\\\n')
+    splices = []
+    offset = 0
+    for part in parts[:-1]:
+        offset += len(part)
+        splices.append(offset)
+    tokens = tokenize(''.join(parts))
+
+    lines = []
+    line_tokens = []
+    number = 1
+    start = 1
+    offset = 0
+    splice = 0
+    for token in tokens:
+        offset += len(token.value)
+        while splice < len(splices) and splices[splice] < offset:
+            number += 1
+            splice += 1
+        if token.kind == NEWLINE:
+            lines.append(Line(start, line_tokens))
+            line_tokens = []
+            number += 1
+            start = number
+        else:
+            line_tokens.append(token)
+            if token.kind == COMMENT:
+                number += token.value.count('\n')
+    if line_tokens:
+        lines.append(Line(start, line_tokens))
+    return lines
+
+
+def _find_include_guard(lines):
+    # Returns the macro name if the whole file is wrapped in #ifndef NAME ... #endif
+    def is_blank(line):
+        return line.directive is None and all(t.kind == SPACE for t in line.tokens)
+    first = 0
+    while first < len(lines) and is_blank(lines[first]):
+        first += 1
+    last = len(lines) - 1
+    while last >= 0 and is_blank(lines[last]):
+        last -= 1
+    if first >= last or lines[first].directive != 'ifndef' or lines[last].directive != 'endif':
+        return None
+    depth = 0
+    for line in lines[first:last]:
+        if line.directive in ('if', 'ifdef', 'ifndef'):
+            depth += 1
+        elif line.directive == 'endif':
+            depth -= 1
+            if depth == 0:
+                return None
+    names = [t for t in lines[first].arguments() if t.kind not in _WHITESPACE]
+    if len(names) == 1 and names[0].kind == IDENT:
+        return names[0].value
+    return None
+
+
+class SourceFile():
+
+    def __init__(self, path, text):
+        self.path = path
+        self.lines = split_lines(text)
+        self.include_guard = _find_include_guard(self.lines)
+
+# path : (mtime, size, SourceFile)
+FILE_CACHE = {}
+
+def load_source_file(path, dependencies=None):
+    stat = os.stat(path)
+    if dependencies is not None:
+        dependencies[path] = (stat.st_mtime_ns, stat.st_size)
+    cached = FILE_CACHE.get(path)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+    with open(path, 'r', encoding='utf-8') as f:
+        source = SourceFile(path, f.read())
+    FILE_CACHE[path] = (stat.st_mtime_ns, stat.st_size, source)
+    return source
+
+def dependencies_changed(dependencies):
+    for path, (mtime, size) in dependencies.items():
+        try:
+            stat = os.stat(path)
+            if stat.st_mtime_ns != mtime or stat.st_size != size:
+                return True
+        except:
+            return True
+    return False
+
+
+class Macro():
+
+    def __init__(self, name, params, variadic, body):
+        self.name = name
+        self.params = params
+        self.variadic = variadic
+        self.body = body
+
+# __FILE__ and __LINE__ are expanded by the preprocessor itself
+_DYNAMIC_MACROS = {
+    '__FILE__' : Macro('__FILE__', None, False, None),
+    '__LINE__' : Macro('__LINE__', None, False, None),
+}
+
+
+class PreprocessorError(Exception):
+    pass
+
+
+_BINARY_OPERATORS = {
+    '*': 10, '/': 10, '%': 10,
+    '+': 9, '-': 9,
+    '<<': 8, '>>': 8,
+    '<': 7, '<=': 7, '>': 7, '>=': 7,
+    '==': 6, '!=': 6,
+    '&': 5, '^': 4, '|': 3,
+    '&&': 2, '||': 1,
+    '?': 0,
+}
+
+def _c_division(a, b, operator):
+    if b == 0:
+        raise PreprocessorError('Division by zero in #if')
+    q = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        q = -q
+    return q if operator == '/' else a - b * q
+
+def _binary_operation(operator, a, b):
+    if operator == '*': return a * b
+    if operator in ('/', '%'): return _c_division(a, b, operator)
+    if operator == '+': return a + b
+    if operator == '-': return a - b
+    if operator == '<<': return a << b
+    if operator == '>>': return a >> b
+    if operator == '<': return int(a < b)
+    if operator == '<=': return int(a <= b)
+    if operator == '>': return int(a > b)
+    if operator == '>=': return int(a >= b)
+    if operator == '==': return int(a == b)
+    if operator == '!=': return int(a != b)
+    if operator == '&': return a & b
+    if operator == '^': return a ^ b
+    if operator == '|': return a | b
+    if operator == '&&': return int(bool(a) and bool(b))
+    if operator == '||': return int(bool(a) or bool(b))
+
+def _parse_number(value):
+    if value.startswith("'"):
+        body = value[1:-1].encode().decode('unicode_escape')
+        return ord(body[0]) if body else 0
+    value = value.rstrip('uUlL')
+    if value.lower().startswith('0x'):
+        return int(value, 16)
+    if value.startswith('0') and len(value) > 1:
+        return int(value, 8)
+    return int(value)
+
+def evaluate_expression(tokens):
+    tokens = [t.value if t.kind != NUMBER and t.kind != STRING else t for t in tokens if t.kind not in _WHITESPACE]
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def next():
+        nonlocal position
+        token = peek()
+        if token is None:
+            raise PreprocessorError('Unexpected end of #if expression')
+        position += 1
+        return token
+
+    def primary():
+        token = next()
+        if isinstance(token, Token):
+            try:
+                return _parse_number(token.value)
+            except:
+                raise PreprocessorError(f'Invalid number in #if expression: {token.value}')
+        if token == '(':
+            value = expression(0)
+            if next() != ')':
+                raise PreprocessorError('Missing ")" in #if expression')
+            return value
+        if token == '!': return int(not primary())
+        if token == '~': return ~primary()
+        if token == '-': return -primary()
+        if token == '+': return primary()
+        if token.isidentifier():
+            # Undefined identifiers evaluate to 0
+            return 0
+        raise PreprocessorError(f'Unexpected "{token}" in #if expression')
+
+    def expression(min_precedence):
+        left = primary()
+        while True:
+            operator = peek()
+            precedence = _BINARY_OPERATORS.get(operator) if isinstance(operator, str) else None
+            if precedence is None or precedence < min_precedence:
+                return left
+            next()
+            if operator == '?':
+                a = expression(0)
+                if next() != ':':
+                    raise PreprocessorError('Missing ":" in #if expression')
+                b = expression(0)
+                left = a if left else b
+            else:
+                right = expression(precedence + 1)
+                left = _binary_operation(operator, left, right)
+
+    value = expression(0)
+    if position != len(tokens):
+        raise PreprocessorError(f'Unexpected "{tokens[position]}" in #if expression')
+    return value
+
+
+def _strip(tokens):
+    start = 0
+    end = len(tokens)
+    while start < end and tokens[start].kind in _WHITESPACE: start += 1
+    while end > start and tokens[end-1].kind in _WHITESPACE: end -= 1
+    return tokens[start:end]
+
+def _normalize_whitespace(tokens):
+    result = []
+    for token in _strip(tokens):
+        if token.kind in _WHITESPACE:
+            if result and result[-1].kind == SPACE:
+                continue
+            token = _SPACE
+        result.append(token)
+    return result
+
+def _stringify(tokens):
+    result = ''
+    for token in _normalize_whitespace(tokens):
+        value = token.value
+        if token.kind == STRING:
+            value = value.replace('\\', '\\\\').replace('"', '\\"')
+        result += value
+    return Token(STRING, '"' + result + '"')
+
+def _paste(a, b):
+    value = a.value + b.value
+    tokens = tokenize(value)
+    kind = tokens[0].kind if len(tokens) == 1 else PUNCT
+    return Token(kind, value, a.hide | b.hide)
+
+
+class Preprocessor():
+
+    MAX_INCLUDE_DEPTH = 200
+    # Skipped lines are emitted as empty lines up to this count, otherwise a #line directive is used
+    MAX_LINE_GAP = 8
+
+    def __init__(self, include_directories=[], definitions=[]):
+        self.include_directories = [d.replace('\\', '/').rstrip('/') for d in include_directories]
+        self.definitions = list(definitions)
+        self.macros = dict(_DYNAMIC_MACROS)
+        self.output = []
+        self.output_path = None
+        self.output_line = 0
+        self.include_cache = {}
+        # Included files. path : (mtime, size)
+        self.dependencies = {}
+        self.depth = 0
+        # Current file and line, for errors and __FILE__/__LINE__
+        self.path = None
+        self.line = 0
+        for definition in definitions:
+            name, _, value = definition.partition('=')
+            if value == '':
+                value = '1'
+            self.define(tokenize(f'{name} {value}'))
+
+    def error(self, message):
+        raise PreprocessorError(f'{self.path}:{self.line}: error: {message}')
+
+    def define(self, tokens):
+        tokens = _strip(tokens)
+        if len(tokens) == 0 or tokens[0].kind != IDENT:
+            self.error('No identifier in #define')
+        name = tokens[0].value
+        params = None
+        variadic = False
+        i = 1
+        if i < len(tokens) and tokens[i].value == '(':
+            params = []
+            i += 1
+            while True:
+                while i < len(tokens) and tokens[i].kind in _WHITESPACE: i += 1
+                if i >= len(tokens):
+                    self.error(f'Unterminated parameter list in #define {name}')
+                token = tokens[i]
+                i += 1
+                if token.value == ')':
+                    break
+                if token.value == ',':
+                    continue
+                if token.value == '...':
+                    variadic = True
+                    params.append('__VA_ARGS__')
+                elif token.kind == IDENT:
+                    params.append(token.value)
+                else:
+                    self.error(f'Invalid parameter "{token.value}" in #define {name}')
+        body = _normalize_whitespace(tokens[i:])
+        self.macros[name] = Macro(name, params, variadic, body)
+
+    def emit(self, path, line, text):
+        if path != self.output_path or line != self.output_line:
+            gap = line - self.output_line
+            if path == self.output_path and 0 < gap <= self.MAX_LINE_GAP:
+                self.output.append('\n' * gap)
+            else:
+                self.output.append(f'#line {line} "{path}"\n')
+        self.output.append(text)
+        self.output.append('\n')
+        self.output_path = path
+        self.output_line = line + 1 + text.count('\n')
+
+    def expand(self, tokens, pull=None):
+        macros = self.macros
+        stack = tokens[::-1]
+        result = []
+        while stack:
+            token = stack.pop()
+            if token.kind != IDENT or token.value in token.hide:
+                result.append(token)
+                continue
+            name = token.value
+            macro = macros.get(name)
+            if macro is None:
+                result.append(token)
+                continue
+            if macro.body is None:
+                if name == '__LINE__':
+                    result.append(Token(NUMBER, str(self.line)))
+                else:
+                    result.append(Token(STRING, f'"{self.path}"'))
+                continue
+            if macro.params is None:
+                body = self.substitute(macro, None, token.hide | {name})
+                stack.extend(reversed(body))
+                continue
+            # Function-like macros are only expanded when followed by a parenthesis
+            skipped = []
+            has_arguments = False
+            while True:
+                if not stack:
+                    more = pull() if pull else None
+                    if more is None:
+                        break
+                    stack.extend(reversed(more))
+                next = stack.pop()
+                if next.kind in _WHITESPACE:
+                    skipped.append(next)
+                    continue
+                has_arguments = next.value == '('
+                stack.append(next)
+                break
+            if has_arguments == False:
+                result.append(token)
+                stack.extend(reversed(skipped))
+                continue
+            stack.pop()
+            arguments, closing = self.collect_arguments(stack, pull, macro)
+            body = self.substitute(macro, arguments, (token.hide & closing.hide) | {name})
+            stack.extend(reversed(body))
+        return result
+
+    def collect_arguments(self, stack, pull, macro):
+        arguments = [[]]
+        depth = 0
+        while True:
+            if not stack:
+                more = pull() if pull else None
+                if more is None:
+                    self.error(f'Unterminated macro call "{macro.name}"')
+                stack.extend(reversed(more))
+            token = stack.pop()
+            if token.kind == PUNCT:
+                if token.value == '(':
+                    depth += 1
+                elif token.value == ')':
+                    if depth == 0:
+                        break
+                    depth -= 1
+                elif token.value == ',' and depth == 0:
+                    if macro.variadic == False or len(arguments) < len(macro.params):
+                        arguments.append([])
+                        continue
+            arguments[-1].append(token)
+
+        if len(macro.params) == 0 and len(arguments) == 1 and len(_strip(arguments[0])) == 0:
+            arguments = []
+        if macro.variadic and len(arguments) == len(macro.params) - 1:
+            arguments.append([])
+        if len(arguments) != len(macro.params):
+            self.error(f'Macro "{macro.name}" expects {len(macro.params)} arguments, but {len(arguments)} were given')
+        return [_normalize_whitespace(argument) for argument in arguments], token
+
+    def substitute(self, macro, arguments, hide):
+        body = macro.body
+        params = macro.params or []
+        expanded = {}
+        result = []
+
+        def argument(name):
+            return arguments[params.index(name)]
+
+        def next_non_space(i):
+            i += 1
+            while i < len(body) and body[i].kind == SPACE: i += 1
+            return i
+
+        i = 0
+        while i < len(body):
+            token = body[i]
+            if arguments is not None and token.kind == PUNCT and token.value == '#':
+                j = next_non_space(i)
+                if j < len(body) and body[j].value in params:
+                    result.append(_stringify(argument(body[j].value)))
+                    i = j + 1
+                    continue
+            if token.kind == PUNCT and token.value == '##':
+                while result and result[-1].kind == SPACE:
+                    result.pop()
+                j = next_non_space(i)
+                if j >= len(body):
+                    break
+                right = [body[j]]
+                if arguments is not None and body[j].value in params:
+                    right = argument(body[j].value)
+                if result and right:
+                    result[-1] = _paste(result[-1], right[0])
+                    result.extend(right[1:])
+                else:
+                    result.extend(right)
+                i = j + 1
+                continue
+            if token.kind == IDENT and arguments is not None and token.value in params:
+                j = next_non_space(i)
+                if j < len(body) and body[j].value == '##':
+                    result.extend(argument(token.value))
+                else:
+                    if token.value not in expanded:
+                        expanded[token.value] = self.expand(list(argument(token.value)))
+                    result.extend(expanded[token.value])
+                i += 1
+                continue
+            result.append(token)
+            i += 1
+
+        result = [Token(t.kind, t.value, t.hide | hide) for t in result]
+        # Pad the expansion, so it can't be accidentally pasted to the surrounding tokens
+        return [_SPACE, *result, _SPACE]
+
+    def evaluate_condition(self, tokens):
+        resolved = []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token.kind == IDENT and token.value == 'defined':
+                j = i + 1
+                while j < len(tokens) and tokens[j].kind in _WHITESPACE: j += 1
+                parenthesis = j < len(tokens) and tokens[j].value == '('
+                if parenthesis:
+                    j += 1
+                    while j < len(tokens) and tokens[j].kind in _WHITESPACE: j += 1
+                if j >= len(tokens) or tokens[j].kind != IDENT:
+                    self.error('Invalid "defined" in #if')
+                defined = tokens[j].value in self.macros
+                if parenthesis:
+                    j += 1
+                    while j < len(tokens) and tokens[j].kind in _WHITESPACE: j += 1
+                    if j >= len(tokens) or tokens[j].value != ')':
+                        self.error('Missing ")" after "defined" in #if')
+                resolved.append(Token(NUMBER, '1' if defined else '0'))
+                i = j + 1
+                continue
+            resolved.append(token)
+            i += 1
+        try:
+            return evaluate_expression(self.expand(resolved)) != 0
+        except PreprocessorError as e:
+            self.error(str(e))
+
+    def find_include(self, name, angled, current_directory, current_include_directory):
+        # Returns (path, display path, include directory)
+        # Files found relative to the including file are displayed relative to the include directory
+        # the including file was found in (like mcpp does), so reflection paths stay the same.
+        key = (name, angled, current_directory, current_include_directory)
+        if key in self.include_cache:
+            return self.include_cache[key]
+        name = name.replace('\\', '/')
+        candidates = []
+        if os.path.isabs(name):
+            candidates.append((name, name, ''))
+        else:
+            if current_directory is not None and angled == False:
+                display_path = current_include_directory + '/' + name if current_include_directory else name
+                candidates.append((current_directory + '/' + name, display_path, current_include_directory))
+            for directory in self.include_directories:
+                path = directory + '/' + name
+                candidates.append((path, path, directory))
+        result = None
+        for candidate in candidates:
+            if os.path.isfile(candidate[0]):
+                result = candidate
+                break
+        self.include_cache[key] = result
+        return result
+
+    def include(self, tokens, current_directory, current_include_directory):
+        tokens = _strip(tokens)
+        if len(tokens) == 0 or (tokens[0].kind != STRING and tokens[0].value != '<'):
+            tokens = _strip(self.expand(tokens))
+        if len(tokens) == 1 and tokens[0].kind == STRING and tokens[0].value.startswith('"'):
+            name = tokens[0].value[1:-1]
+            angled = False
+        elif len(tokens) > 2 and tokens[0].value == '<' and tokens[-1].value == '>':
+            name = ''.join(t.value for t in tokens[1:-1])
+            angled = True
+        else:
+            self.error('Invalid #include')
+
+        found = self.find_include(name, angled, current_directory, current_include_directory)
+        if found is None:
+            self.error(f'Can\'t open include file "{name}"')
+        path, display_path, include_directory = found
+        if self.depth >= self.MAX_INCLUDE_DEPTH:
+            self.error(f'#include nested too deeply')
+        source = load_source_file(path, self.dependencies)
+        if source.include_guard and source.include_guard in self.macros:
+            return
+        self.depth += 1
+        self.process(source.lines, path, display_path, include_directory)
+        self.depth -= 1
+
+    def process(self, lines, path, display_path, include_directory):
+        directory = os.path.dirname(path).replace('\\', '/') if path is not None else None
+        line_offset = 0
+        # [parent_active, branch_taken]
+        conditions = []
+        active = True
+
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            i += 1
+            self.path = display_path
+            self.line = line.number + line_offset
+            directive = line.directive
+
+            if directive is None:
+                if active == False:
+                    continue
+                if line.identifiers.isdisjoint(self.macros):
+                    self.emit(display_path, self.line, line.text)
+                    continue
+
+                def pull():
+                    # Function-like macro calls can span multiple lines
+                    nonlocal i
+                    if i < len(lines) and lines[i].directive is None:
+                        i += 1
+                        return [_NEWLINE, *lines[i-1].tokens]
+                    return None
+
+                expanded = self.expand(list(line.tokens), pull)
+                self.emit(display_path, self.line, ''.join(t.value for t in expanded))
+                continue
+
+            if active and line.comments:
+                self.emit(display_path, self.line, line.comments)
+
+            if directive in ('if', 'ifdef', 'ifndef'):
+                if active:
+                    arguments = line.arguments()
+                    if directive == 'if':
+                        condition = self.evaluate_condition(arguments)
+                    else:
+                        names = _strip(arguments)
+                        if len(names) == 0 or names[0].kind != IDENT:
+                            self.error(f'No identifier in #{directive}')
+                        condition = (names[0].value in self.macros) == (directive == 'ifdef')
+                    conditions.append([True, condition])
+                    active = condition
+                else:
+                    conditions.append([False, True])
+                continue
+            if directive in ('elif', 'else', 'endif'):
+                if len(conditions) == 0:
+                    self.error(f'#{directive} without #if')
+                parent_active, taken = conditions[-1]
+                if directive == 'endif':
+                    conditions.pop()
+                    active = parent_active
+                elif directive == 'else':
+                    active = parent_active and taken == False
+                    conditions[-1][1] = True
+                else:
+                    active = False
+                    if parent_active and taken == False:
+                        active = self.evaluate_condition(line.arguments())
+                        conditions[-1][1] = active
+                continue
+
+            if active == False:
+                continue
+
+            if directive == 'include':
+                self.include(line.arguments(), directory, include_directory)
+            elif directive == 'define':
+                self.define(line.arguments())
+            elif directive == 'undef':
+                names = _strip(line.arguments())
+                if len(names) == 0 or names[0].kind != IDENT:
+                    self.error('No identifier in #undef')
+                self.macros.pop(names[0].value, None)
+            elif directive == 'line':
+                arguments = [t for t in self.expand(line.arguments()) if t.kind not in _WHITESPACE]
+                if len(arguments) == 0 or arguments[0].kind != NUMBER or len(arguments) > 2:
+                    self.error('Invalid #line')
+                line_offset = int(arguments[0].value) - (line.number + 1)
+                if len(arguments) == 2:
+                    display_path = arguments[1].value.strip('"')
+            elif directive == 'error':
+                self.error(''.join(t.value for t in _strip(line.arguments())))
+            elif directive == 'pragma':
+                self.emit(display_path, self.line, line.text)
+            elif directive != '':
+                self.error(f'Unknown #directive "{directive}"')
+
+        if len(conditions) > 0:
+            self.error('Unterminated #if')
+
+    def preprocess(self, source, display_path):
+        lines = split_lines(source)
+        # Sources usually start with the same #include headers (only the material code changes),
+        # so the preprocessor state after them is cached and reused.
+        header_length = 0
+        for line in lines:
+            if line.directive in ('include', 'define', 'undef') or (line.directive is None and line.text.strip() == ''):
+                header_length += 1
+            else:
+                break
+        while header_length > 0 and lines[header_length-1].directive is None:
+            header_length -= 1
+        
+        if header_length > 0:
+            header = '\n'.join(line.text for line in lines[:header_length])
+            key = (header, display_path, tuple(self.include_directories), tuple(self.definitions))
+            cached = HEADER_CACHE.get(key)
+            if cached and dependencies_changed(cached['dependencies']) == False:
+                self.output = [cached['output']]
+                self.macros = dict(cached['macros'])
+                self.dependencies = dict(cached['dependencies'])
+                self.output_path = cached['output_path']
+                self.output_line = cached['output_line']
+            else:
+                self.process(lines[:header_length], None, display_path, None)
+                if len(HEADER_CACHE) >= HEADER_CACHE_SIZE:
+                    HEADER_CACHE.pop(next(iter(HEADER_CACHE)))
+                HEADER_CACHE[key] = {
+                    'dependencies' : dict(self.dependencies),
+                    'output' : ''.join(self.output),
+                    'macros' : dict(self.macros),
+                    'output_path' : self.output_path,
+                    'output_line' : self.output_line,
+                }
+        
+        self.process(lines[header_length:], None, display_path, None)
+        return ''.join(self.output)
+
+HEADER_CACHE_SIZE = 64
+HEADER_CACHE = {}
+
+
+def preprocess(source, include_directories=[], definitions=[], display_path='src', dependencies=None):
+    # dependencies (optional) is filled with the included files. path : (mtime, size)
+    preprocessor = Preprocessor(include_directories, definitions)
+    result = preprocessor.preprocess(source, display_path)
+    if dependencies is not None:
+        dependencies.update(preprocessor.dependencies)
+    return result
+
+def preprocess_stage(source, include_directories=[], definitions=[]):
+    # Returns (result, dependencies). Doesn't touch GL, so it can run in worker processes
+    dependencies = {}
+    result = preprocess(source + '\n', include_directories, definitions, dependencies=dependencies)
+    return result, dependencies
@@ -11,8 +11,12 @@ class Mesh():
         self.uvs = []
         self.colors = []
         self.color_is_srgb = [False]*4
+        # (location, VBO, element_size, gl_type, gl_normalize)
+        self.vertex_attributes = []
 
         self.index_count = len(index)
+        self.index_type = GL_UNSIGNED_INT
+        self.bounding_sphere = None
 
         self.VAO = None
         self.EBO = gl_buffer(GL_INT, 1)
@@ -45,6 +49,16 @@ class Mesh():
             self.uvs.append(load_VBO(uv))
         for color in colors:
             self.colors.append(load_VBO(color))
+        
+        self.vertex_attributes.append((0, self.position, 3, GL_FLOAT, GL_FALSE))
+        if self.normal:
+            self.vertex_attributes.append((1, self.normal, 3, GL_FLOAT, GL_FALSE))
+        if self.tangent:
+            self.vertex_attributes.append((2, self.tangent, 4, GL_FLOAT, GL_FALSE))
+        for i, uv in enumerate(self.uvs):
+            self.vertex_attributes.append((3 + i, uv, 2, GL_FLOAT, GL_FALSE))
+        for i, color in enumerate(self.colors):
+            self.vertex_attributes.append((7 + i, color, 4, GL_FLOAT, GL_FALSE))
     
     #Blender uses different OGL contexts, this function should only be called from the draw callback
     #https://developer.blender.org/T65208
@@ -55,25 +69,11 @@ class Mesh():
 
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.EBO[0])
 
-        def bind_VBO(VBO, index, element_size):
+        assert(len(self.uvs) <= 4)
+        for location, VBO, element_size, gl_type, gl_normalize in self.vertex_attributes:
             glBindBuffer(GL_ARRAY_BUFFER, VBO[0])
-            glEnableVertexAttribArray(index)
-            glVertexAttribPointer(index, element_size, GL_FLOAT, GL_FALSE, 0, None)
-        
-        bind_VBO(self.position, 0, 3)
-        if(self.normal):
-            bind_VBO(self.normal, 1, 3)
-        if(self.tangent):
-            bind_VBO(self.tangent, 2, 4)
-        
-        max_uv = 4
-        uv0_index = 3
-        color0_index = uv0_index + max_uv
-        for i, uv in enumerate(self.uvs):
-            assert(i < max_uv)
-            bind_VBO(uv, uv0_index + i, 2)
-        for i, color in enumerate(self.colors):
-            bind_VBO(color, color0_index + i, 4)
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, element_size, gl_type, gl_normalize, 0, None)
 
         glBindVertexArray(0)
 
@@ -85,7 +85,7 @@ class Mesh():
     def draw(self, bind=True):
         if bind:
             self.bind()
-        glDrawElements(GL_TRIANGLES, self.index_count, GL_UNSIGNED_INT, NULL)
+        glDrawElements(GL_TRIANGLES, self.index_count, self.index_type, NULL)
         if bind:
             glBindVertexArray(0)
     
@@ -118,8 +118,12 @@ class MeshCustomLoad(Mesh):
         self.uvs = []
         self.colors = []
         self.color_is_srgb = [False]*4
+        self.vertex_attributes = []
 
         self.index_count = 0
+        self.index_type = GL_UNSIGNED_INT
+        # Local (center, radius), None if the mesh can't be culled
+        self.bounding_sphere = None
 
         self.VAO = None
         self.EBO = None
@@ -99,3 +99,16 @@ class ArrayLayerTarget(TargetBase):
     
     def attach(self, attachment):
         glFramebufferTextureLayer(GL_FRAMEBUFFER, attachment, self.texture_array, 0, self.layer)
+
+
+class MipLevelTarget(TargetBase):
+    def __init__(self, texture, level):
+        self.texture = texture.texture[0]
+        self.level = level
+        self.resolution = (max(1, texture.resolution[0] >> level), max(1, texture.resolution[1] >> level))
+        self.internal_format = texture.internal_format
+        self.format = texture.format
+        self.data_format = texture.data_format
+    
+    def attach(self, attachment):
+        glFramebufferTexture2D(GL_FRAMEBUFFER, attachment, GL_TEXTURE_2D, self.texture, self.level)
@@ -6,36 +6,27 @@ from Malt.Utils import LOG
 
 class Shader():
 
-    def __init__(self, vertex_source, pixel_source):
-        if vertex_source and pixel_source:
-            self.vertex_source = vertex_source
-            self.pixel_source = pixel_source
-            self.program, self.error = compile_gl_program(vertex_source, pixel_source)
-            self.validator = glslang_validator(vertex_source,'vert')
-            self.validator += glslang_validator(pixel_source,'frag')
-            if self.validator == '':
-                self.validator = None
-        else:
-            self.vertex_source = vertex_source
-            self.pixel_source = pixel_source
-            self.program = None
-            self.error = 'NO SOURCE'
-            self.validator = None
+    def __init__(self, vertex_source, pixel_source, compiler=None):
+        self.vertex_source = vertex_source
+        self.pixel_source = pixel_source
+        self.program = None
+        self.error = 'NO SOURCE'
+        self.validator = None
         self.uniforms = {}
         self.textures = {}
         self.uniform_blocks = {}
-        if self.error == '':
-            self.error = None
-            self.uniforms = reflect_program_uniforms(self.program)
-            texture_index = 0
-            for name, uniform in self.uniforms.items():
-                if uniform.is_sampler():
-                    uniform.set_value(texture_index)
-                    texture_index += 1 
-                    self.textures[name] = None
-            self.uniform_blocks = reflect_program_uniform_blocks(self.program)
-        elif self.error != 'NO SOURCE':
-            LOG.error(self.error)
+        self.pending = False
+        if vertex_source and pixel_source:
+            if compiler:
+                # Compiled in the background (See AsyncShaderCompiler), the shader can't be used until is_pending() is False
+                self.error = None
+                self.pending = True
+                compiler.compile(self)
+            else:
+                self.__dict__.update(link_shader(vertex_source, pixel_source))
+    
+    def is_pending(self):
+        return self.pending
         
     def bind(self):
         glUseProgram(self.program)
@@ -61,6 +52,7 @@ class Shader():
         new.pixel_source = self.pixel_source
         new.program = self.program
         new.error = self.error
+        new.pending = self.pending
         for name, uniform in self.uniforms.items():
             new.uniforms[name] = uniform.copy()
         for name, texture in self.textures.items():
@@ -70,10 +62,138 @@ class Shader():
         
         return new
     
+    def get_cache_data(self):
+        # Everything needed to rebuild the shader without compiling and reflecting it again
+        length = gl_buffer(GL_INT, 1)
+        glGetProgramiv(self.program, GL_PROGRAM_BINARY_LENGTH, length)
+        format = gl_buffer(GL_UNSIGNED_INT, 1)
+        binary = gl_buffer(GL_UNSIGNED_BYTE, length[0])
+        glGetProgramBinary(self.program, length[0], NULL, format, binary)
+        return {
+            'vertex_source' : self.vertex_source,
+            'pixel_source' : self.pixel_source,
+            'format' : format[0],
+            'binary' : bytes(binary),
+            'uniforms' : {
+                name : (uniform.index, uniform.type, list(uniform.value), uniform.array_length)
+                for name, uniform in self.uniforms.items()
+            },
+            'uniform_blocks' : {name : dict(block) for name, block in self.uniform_blocks.items()},
+        }
+    
     def __del__(self):
         #TODO: Programs are shared between Shaders. Should refcount them
         pass
 
+def link_shader(vertex_source, pixel_source):
+    # Returns the Shader members that depend on the compiled program
+    result = {
+        'uniforms' : {},
+        'textures' : {},
+        'uniform_blocks' : {},
+    }
+    result['program'], error = compile_gl_program(vertex_source, pixel_source)
+    validator = glslang_validator(vertex_source,'vert')
+    validator += glslang_validator(pixel_source,'frag')
+    result['validator'] = validator if validator != '' else None
+    if error == '':
+        result['error'] = None
+        result['uniforms'] = reflect_program_uniforms(result['program'])
+        texture_index = 0
+        for name, uniform in result['uniforms'].items():
+            if uniform.is_sampler():
+                uniform.set_value(texture_index)
+                texture_index += 1 
+                result['textures'][name] = None
+        result['uniform_blocks'] = reflect_program_uniform_blocks(result['program'])
+    else:
+        result['error'] = error
+        LOG.error(error)
+    return result
+
+
+class AsyncShaderCompiler():
+    # Compiles and links GL programs in a dedicated thread, with its own GL context.
+    # The context must share objects with the main one, make_context_current is called from the compile thread.
+    # Pending Shaders are swapped in all at once from the main thread, see update().
+    # on_finished is called from the compile thread after each shader, so the main thread doesn't need to poll.
+
+    def __init__(self, make_context_current, on_finished=None):
+        import threading, queue, collections
+        self.make_context_current = make_context_current
+        self.on_finished = on_finished
+        self.queue = queue.Queue()
+        self.finished = collections.deque()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def compile(self, shader):
+        self.queue.put(shader)
+    
+    def run(self):
+        self.make_context_current()
+        while True:
+            shader = self.queue.get()
+            if shader is None:
+                break
+            try:
+                result = link_shader(shader.vertex_source, shader.pixel_source)
+            except:
+                import traceback
+                result = { 'error' : traceback.format_exc() }
+            # Make sure the program is complete before it's used from the main context
+            glFinish()
+            self.finished.append((shader, result))
+            if self.on_finished:
+                self.on_finished()
+    
+    def update(self):
+        while len(self.finished) > 0:
+            shader, result = self.finished.popleft()
+            shader.__dict__.update(result)
+            shader.pending = False
+    
+    def shutdown(self):
+        # Skip the queued shaders and wait for the current one, so the shared context can be destroyed afterwards
+        import queue
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.queue.put(None)
+        self.thread.join()
+
+
+def shader_from_cache_data(data):
+    program = glCreateProgram()
+    status = gl_buffer(GL_INT,1)
+    try:
+        binary = (GLubyte*len(data['binary'])).from_buffer_copy(data['binary'])
+        glProgramBinary(program, data['format'], binary, len(binary))
+        glGetProgramiv(program, GL_LINK_STATUS, status)
+    except:
+        status[0] = GL_FALSE
+    if status[0] == GL_FALSE:
+        #Program binary format can change on driver updates
+        glDeleteProgram(program)
+        return None
+    
+    shader = Shader(None, None)
+    shader.vertex_source = data['vertex_source']
+    shader.pixel_source = data['pixel_source']
+    shader.program = program
+    shader.error = None
+    for name, (index, type, value, array_length) in data['uniforms'].items():
+        uniform = GLUniform(index, type, value, array_length)
+        shader.uniforms[name] = uniform
+        if uniform.is_sampler():
+            shader.textures[name] = None
+    for name, block in data['uniform_blocks'].items():
+        glUniformBlockBinding(program, glGetUniformBlockIndex(program, name), block['bind'])
+        shader.uniform_blocks[name] = dict(block)
+    return shader
+
 
 class GLUniform():
     def __init__(self, index, type, value, array_length=1):
@@ -154,12 +274,50 @@ class UBO():
         glDeleteBuffers(1, self.buffer[0])
 
 
-def shader_preprocessor(shader_source, include_directories=[], definitions=[]):
-    import tempfile, subprocess, sys, platform
+class UBORange():
+    # A section of an UBO, so several uniform blocks can be loaded with a single upload.
+    # The UBO range_count tells if it's still in use.
+
+    def __init__(self, ubo, offset, size):
+        self.ubo = ubo
+        self.offset = offset
+        self.size = size
+        self.location = None
+        ubo.range_count = getattr(ubo, 'range_count', 0) + 1
+    
+    def bind(self, uniform_block):
+        location = uniform_block['bind']
+        if self.location != location or UBO.BINDS[location] != self:
+            glBindBufferRange(GL_UNIFORM_BUFFER, location, self.ubo.buffer[0], self.offset, min(self.size, uniform_block['size']))
+            self.location = location
+            UBO.BINDS[location] = self
+    
+    def __del__(self):
+        self.ubo.range_count -= 1
+
+
+__UNIFORM_BUFFER_OFFSET_ALIGNMENT = None
+
+def uniform_buffer_offset_alignment():
+    global __UNIFORM_BUFFER_OFFSET_ALIGNMENT
+    if __UNIFORM_BUFFER_OFFSET_ALIGNMENT is None:
+        __UNIFORM_BUFFER_OFFSET_ALIGNMENT = glGetInteger(GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT)
+    return __UNIFORM_BUFFER_OFFSET_ALIGNMENT
+
+
+def shader_preprocessor(shader_source, include_directories=[], definitions=[], dependencies=None):
+    from Malt.GL.GLSLPreprocessor import preprocess
 
     if hasGLExtension('GL_ARB_bindless_texture'):
-        definitions.append('GL_ARB_bindless_texture')
+        definitions = [*definitions, 'GL_ARB_bindless_texture']
     
+    return preprocess(shader_source + '\n', include_directories, definitions, dependencies=dependencies)
+
+
+def mcpp_preprocessor(shader_source, include_directories=[], definitions=[]):
+    # Reference implementation, runs the mcpp executable bundled with the dependencies
+    import tempfile, subprocess, sys, platform
+
     shader_source = shader_source + '\n'
     tmp = tempfile.NamedTemporaryFile(delete=False)
     tmp.write(shader_source.encode('utf-8'))
@@ -503,28 +661,154 @@ def reflect_program_uniform_blocks(program):
 
 USE_GLSLANG_VALIDATOR = False
 
+def get_cache_folder(name):
+    import tempfile
+    cache_folder = os.path.join(tempfile.gettempdir(), name)
+    os.makedirs(cache_folder, exist_ok=True)
+    return cache_folder
+
+def evict_cache_folder(cache_folder, max_size):
+    # Files are touched when read, so the least recently used ones go first
+    try:
+        entries = []
+        total_size = 0
+        for entry in os.scandir(cache_folder):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+        if total_size <= max_size:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= max_size:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except:
+                pass
+    except:
+        import traceback
+        LOG.warning(traceback.format_exc())
+
+REFLECTION_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+MATERIAL_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+__DRIVER_STRING = None
+
+def gl_driver_string():
+    global __DRIVER_STRING
+    if __DRIVER_STRING is None:
+        __DRIVER_STRING = ' '.join(glGetString(e).decode() for e in (GL_VENDOR, GL_RENDERER, GL_VERSION))
+        __DRIVER_STRING += f" bindless:{hasGLExtension('GL_ARB_bindless_texture')}"
+    return __DRIVER_STRING
+
+def _file_hash(path):
+    import hashlib
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def material_cache_key(source, include_directories, definitions):
+    # The included files are only known after preprocessing,
+    # so their content hashes are stored (and validated) in the cache entry itself
+    import hashlib
+    hash_src = repr((source, list(include_directories), list(definitions), gl_driver_string()))
+    return hashlib.sha1(hash_src.encode('utf-8')).hexdigest()
+
+def load_material_cache(key):
+    import pickle
+    cache_path = os.path.join(get_cache_folder('MALT_MATERIALS_CACHE'), key+'.material')
+    if os.path.exists(cache_path) == False:
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+        for path, (mtime, size, digest) in cache['dependencies'].items():
+            stat = os.stat(path)
+            if stat.st_mtime_ns == mtime and stat.st_size == size:
+                continue
+            #The file has been rewritten, but the content can still be the same
+            if stat.st_size != size or _file_hash(path) != digest:
+                return None
+        from pathlib import Path
+        Path(cache_path).touch()
+        return cache
+    except:
+        return None
+
+def save_material_cache(key, dependencies, shaders):
+    # dependencies : { path : (mtime, size) }, as returned by shader_preprocessor
+    # shaders : { name : Shader.get_cache_data() }
+    import pickle, tempfile
+    cache_folder = get_cache_folder('MALT_MATERIALS_CACHE')
+    try:
+        cache = {
+            'dependencies' : {
+                path : (mtime, size, _file_hash(path)) for path, (mtime, size) in dependencies.items()
+            },
+            'shaders' : shaders,
+        }
+        with tempfile.NamedTemporaryFile(dir=cache_folder, delete=False) as f:
+            pickle.dump(cache, f)
+        os.replace(f.name, os.path.join(cache_folder, key+'.material'))
+    except:
+        import traceback
+        LOG.warning(traceback.format_exc())
+    evict_cache_folder(cache_folder, MATERIAL_CACHE_MAX_SIZE)
+
 def glsl_reflection(code, root_paths=[]):
-    import tempfile, subprocess, json, platform
+    import tempfile, subprocess, json, platform, hashlib
     
     GLSLParser = os.path.join(os.path.dirname(__file__), 'GLSLParser', '.bin', 'GLSLParser')
     
-    tmp = tempfile.NamedTemporaryFile(delete=False)
-    tmp.write(code.encode('utf-8'))
-    tmp.close()
+    # The parser output only depends on the preprocessed code (and the parser itself)
+    parser_stat = os.stat(GLSLParser)
+    hash_src = f'{parser_stat.st_mtime_ns} {parser_stat.st_size}\n{code}'
+    reflection_hash = hashlib.sha1(hash_src.encode('utf-8')).hexdigest()
+    cache_folder = get_cache_folder('MALT_REFLECTION_CACHE')
+    cache_path = os.path.join(cache_folder, reflection_hash+'.json')
 
-    command = f'"{GLSLParser}" "{tmp.name}"'
-    if platform.system() == 'Windows':
-        #run with utf8 code page to support non-ascii paths
-        command = f'CHCP 65001 > nul && {command}'
-    
-    try:
-        json_string = subprocess.check_output(command, shell=True)
-    except:
-        import stat
-        os.chmod(GLSLParser, os.stat(GLSLParser).st_mode | stat.S_IEXEC)
-        json_string = subprocess.check_output(command, shell=True)
+    json_string = None
+    if os.path.exists(cache_path):
+        try:
+            from pathlib import Path
+            Path(cache_path).touch()
+            with open(cache_path, 'rb') as f:
+                json_string = f.read()
+        except:
+            json_string = None
     
-    os.remove(tmp.name)
+    if json_string is None:
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        tmp.write(code.encode('utf-8'))
+        tmp.close()
+
+        command = f'"{GLSLParser}" "{tmp.name}"'
+        if platform.system() == 'Windows':
+            #run with utf8 code page to support non-ascii paths
+            command = f'CHCP 65001 > nul && {command}'
+        
+        try:
+            json_string = subprocess.check_output(command, shell=True)
+        except:
+            import stat
+            os.chmod(GLSLParser, os.stat(GLSLParser).st_mode | stat.S_IEXEC)
+            json_string = subprocess.check_output(command, shell=True)
+        
+        os.remove(tmp.name)
+
+        try:
+            # Write to a temporary file first, so other processes never read partial results
+            tmp_path = cache_path + f'.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(json_string)
+            os.replace(tmp_path, cache_path)
+            evict_cache_folder(cache_folder, REFLECTION_CACHE_MAX_SIZE)
+        except:
+            import traceback
+            LOG.warning(traceback.format_exc())
     
     reflection = json.loads(json_string)
 
@@ -4,6 +4,7 @@ from Malt.GL.RenderTarget import RenderTarget
 from Malt.PipelineNode import PipelineNode
 from Malt.PipelineParameters import Parameter, Type
 from copy import copy, deepcopy
+import numpy as np
 
 class SceneFilter(PipelineNode):
     """
@@ -45,11 +46,20 @@ class SceneFilter(PipelineNode):
             self.non_matches = copy(scene)
             self.non_matches.objects = []
             self.non_matches.shader_resources = copy(self.non_matches.shader_resources)
-            for obj in scene.objects:
-                if tag in obj.tags:
-                    self.matches.objects.append(obj)
-                else:
-                    self.non_matches.objects.append(obj)
+            # Filtered scenes keep the BVH of the full scene, so it's only used when it matches the scene objects
+            if scene.bvh and scene.bvh.objects is scene.objects:
+                objects = scene.bvh.objects
+                indices = scene.bvh.query_tag(tag)
+                non_matches = np.ones(len(objects), bool)
+                non_matches[indices] = False
+                self.matches.objects = [objects[i] for i in indices.tolist()]
+                self.non_matches.objects = [objects[i] for i in np.flatnonzero(non_matches).tolist()]
+            else:
+                for obj in scene.objects:
+                    if tag in obj.tags:
+                        self.matches.objects.append(obj)
+                    else:
+                        self.non_matches.objects.append(obj)
             self.matches.batches = self.pipeline.build_scene_batches(self.matches.objects)
             self.non_matches.batches = self.pipeline.build_scene_batches(self.non_matches.objects)
             
@@ -43,5 +43,8 @@ class SuperSamplingAA(PipelineNode):
         if inputs['Color']:
             self.pipeline.blend_texture(inputs['Color'], self.fbo, 1.0 / (self.pipeline.sample_count + 1))
             outputs['Color'] = self.t_color
+            if self.pipeline.sampling_noise_threshold > 0:
+                self.pipeline.get_sample_variance(self).add_sample(self.pipeline, inputs['Color'], 
+                    self.pipeline.sample_count, self.pipeline.is_new_frame)
 
 NODE = SuperSamplingAA
@@ -1,7 +1,7 @@
-import math, os, ctypes
+import math, os, ctypes, itertools, weakref
 from os import path
 
-from Malt.Utils import LOG
+from Malt.Utils import LOG, IBuffer
 
 from Malt.GL.GL import *
 from Malt.GL.Mesh import Mesh, MeshCustomLoad
@@ -12,6 +12,51 @@ from Malt.PipelineParameters import *
 
 SHADER_DIR = path.join(path.dirname(__file__), 'Shaders')
 
+# Unique id of each scene batch. Batches are rebuilt when any of their objects change,
+# so it can be used to know if the objects of a batch are still the same.
+BATCH_VERSIONS = itertools.count(1)
+
+def get_object_matrices(objects):
+    # Returns the (count, 16) float32 array of the object matrices.
+    # Scene objects usually store their matrix as a float32 buffer (See Bridge.SceneSync), so they can be joined in a single copy
+    import numpy as np
+    count = len(objects)
+    try:
+        return np.frombuffer(b''.join([obj.matrix for obj in objects]), np.float32).reshape(count, 16)
+    except:
+        return np.array([obj.matrix for obj in objects], np.float32).reshape(count, 16)
+
+def group_scene_objects(objects, max_batch_size):
+    # Sorts the objects by (material, mesh, scale group) and splits each group in batches of up to max_batch_size.
+    # Returns:
+    #   groups : [(material, mesh, scale_group)], in order of appearance
+    #   objects : The sorted objects
+    #   matrices, ids : Sorted float32 (count,16) and uint32 (count) arrays
+    #   batch_index, batch_offset : Batch and index inside the batch of each sorted object
+    #   batch_counts, batch_groups : Object count and group index of each batch
+    import numpy as np
+    count = len(objects)
+    keys = {}
+    group_index = np.fromiter((keys.setdefault((obj.material, obj.mesh, 'mirror_scale' if obj.mirror_scale else 'normal_scale'), len(keys))
+        for obj in objects), np.int64, count)
+    ids = np.fromiter((obj.parameters['ID'] for obj in objects), np.uint32, count)
+    matrices = get_object_matrices(objects)
+
+    order = np.argsort(group_index, kind='stable')
+    sorted_groups = group_index[order]
+    group_counts = np.bincount(group_index, minlength=len(keys))
+    group_starts = np.cumsum(group_counts) - group_counts
+    group_batch_counts = -(-group_counts // max_batch_size)
+    group_first_batch = np.cumsum(group_batch_counts) - group_batch_counts
+    rank = np.arange(count) - group_starts[sorted_groups]
+    batch_index = group_first_batch[sorted_groups] + rank // max_batch_size
+    batch_offset = rank % max_batch_size
+    batch_counts = np.bincount(batch_index, minlength=int(group_batch_counts.sum()))
+    batch_groups = np.repeat(np.arange(len(keys)), group_batch_counts)
+    sorted_objects = [objects[i] for i in order.tolist()]
+    return list(keys.keys()), sorted_objects, matrices[order], ids[order], batch_index, batch_offset, batch_counts, batch_groups
+
+
 class Pipeline():
 
     SHADER_INCLUDE_PATHS = []
@@ -19,10 +64,29 @@ class Pipeline():
     BLEND_SHADER = None
     COPY_SHADER = None
 
+    # Draw scene batches with glMultiDrawElementsIndirect (See Malt.Render.IndirectBatching)
+    INDIRECT_BATCHING = False
+    # Build a Malt.Render.BVH for the Bridge scenes (See Bridge.SceneSync)
+    SCENE_BVH = False
+
     def __init__(self, plugins=[]):
         from multiprocessing.dummy import Pool
         self.pool = Pool(16)
 
+        self.batch_UBOs = []
+        self.indirect_batching = None
+        # Preprocessor definitions for all the pipeline shaders and GLSL graphs
+        self.shader_defines = []
+        if self.INDIRECT_BATCHING:
+            from Malt.Render.IndirectBatching import IndirectBatching, SHADER_DEFINE
+            self.indirect_batching = IndirectBatching()
+            self.shader_defines.append(SHADER_DEFINE)
+        
+        from Malt.Render.Culling import FrustumCulling
+        self.culling = FrustumCulling(self)
+        # {pass name : (visible, total)} instances of the last occlusion test of each pass (See Malt.Render.OcclusionCulling)
+        self.occlusion_stats = {}
+
         if SHADER_DIR not in Pipeline.SHADER_INCLUDE_PATHS:
             Pipeline.SHADER_INCLUDE_PATHS.append(SHADER_DIR)
 
@@ -30,6 +94,12 @@ class Pipeline():
         self.sample_count = 0
         self.result = None
         self.is_final_render = None
+        # Early sampling termination, see needs_more_samples
+        self.sampling_noise_threshold = 0
+        self.sampling_time_budget = 0
+        # { accumulation node : SampleVariance }
+        self.sample_variances = weakref.WeakKeyDictionary()
+        self.frame_start_time = 0
         
         plugins = [plugin for plugin in plugins if plugin.poll_pipeline(self)]
         self.setup_parameters()
@@ -56,6 +126,15 @@ class Pipeline():
             It's disabled by default since it slows down mesh loading in Blender.  
             When disabled, the *tangents* are calculated on the fly from the *pixel shader*.""")
         
+        self.parameters.mesh['compact_vertex_format'] = Parameter(False, Type.BOOL, doc="""
+            Store normals and tangents as 10-10-10-2 integers, UVs and float vertex colors as half floats, 
+            and indices as 16 bit integers when the mesh has few enough vertices.  
+            Roughly halves the mesh memory usage, at the cost of some UV precision on large texture coordinates.""")
+        
+        self.parameters.mesh['bounds_padding'] = Parameter(0.0, Type.FLOAT, doc="""
+            Extra radius added to the mesh bounds used for frustum culling, in object space.  
+            Increase it for materials with vertex displacement, so displaced geometry is not culled while it's still visible.""")
+        
         self.parameters.world['Material.Default'] = MaterialParameter('', '.mesh.glsl', 'Mesh', doc=
             "The default material, used for objects with no material assigned.")
         
@@ -69,6 +148,9 @@ class Pipeline():
         self.parameters.world['Viewport.Smooth Interpolation'] = Parameter(True , Type.BOOL, doc="""
             The interpolation mode used when *Resolution Scale* is not 1.
             Toggles between *Nearest/Bilinear* interpolation.""")
+        self.parameters.world['Viewport.Readback Latency'] = Parameter(3 , Type.INT, doc="""
+            The maximum number of frames that can be in flight between the render and the viewport display (1 to 8).
+            Higher values avoid stalls on high resolutions and bit depths, at the cost of display latency.""")
     
     def get_parameters(self):
         return self.parameters
@@ -79,6 +161,7 @@ class Pipeline():
     def add_graph(self, graph):
         if graph.file_extension.endswith('glsl'):
             graph.include_paths += self.SHADER_INCLUDE_PATHS
+            graph.defines += self.shader_defines
         self.graphs[graph.name] = graph
     
     def get_graphs(self):
@@ -121,7 +204,31 @@ class Pipeline():
         return [(0,0)]
     
     def needs_more_samples(self):
-        return self.sample_count < len(self.get_samples())
+        if self.sample_count >= len(self.get_samples()):
+            return False
+        if self.sample_count > 0 and self.sampling_time_budget > 0:
+            import time
+            if time.perf_counter() - self.frame_start_time > self.sampling_time_budget:
+                return False
+        if self.sampling_noise_threshold > 0:
+            from Malt.Render.AdaptiveSampling import MIN_SAMPLES
+            # Only the estimators fed by the last sample, nodes may not run every frame
+            variances = [variance for variance in self.sample_variances.values() if variance.sample_count == self.sample_count]
+            if self.sample_count >= MIN_SAMPLES and len(variances) > 0:
+                errors = [variance.poll() for variance in variances]
+                if None not in errors and max(errors) < self.sampling_noise_threshold:
+                    return False
+        return True
+    
+    def get_sample_variance(self, owner):
+        # Each sample accumulation (See Malt.Nodes.SuperSamplingAA) has its own estimator,
+        # sampling stops once all of them are below the noise threshold
+        variance = self.sample_variances.get(owner)
+        if variance is None:
+            from Malt.Render.AdaptiveSampling import SampleVariance
+            variance = SampleVariance()
+            self.sample_variances[owner] = variance
+        return variance
     
     def setup_render_targets(self, resolution):
         pass
@@ -137,6 +244,7 @@ class Pipeline():
         return None
     
     def compile_shader_from_source(self, source, include_paths=[], defines=[]):
+        defines = self.shader_defines + defines
         vertex_src = shader_preprocessor(source, include_paths + self.SHADER_INCLUDE_PATHS, defines + ['VERTEX_SHADER'])
         pixel_src = shader_preprocessor(source, include_paths + self.SHADER_INCLUDE_PATHS, defines + ['PIXEL_SHADER'])
         return Shader(vertex_src, pixel_src)
@@ -144,38 +252,80 @@ class Pipeline():
     def compile_material_from_source(self, material_type, source, include_paths=[]):
         return self.graphs[material_type].compile_material(source, include_paths)
     
+    def get_material_source(self, shader_path, search_paths=[]):
+        file_dir = path.dirname(shader_path)
+        source = '#include "{}"'.format(path.basename(shader_path))
+        material_type = shader_path.split('.')[-2]
+        for graph in self.graphs.values():
+            if shader_path.endswith(graph.file_extension):
+                material_type = graph.name
+        return material_type, source, [file_dir] + search_paths
+    
     def compile_material(self, shader_path, search_paths=[]):
         try:
-            file_dir = path.dirname(shader_path)
-            source = '#include "{}"'.format(path.basename(shader_path))
-            material_type = shader_path.split('.')[-2]
-            for graph in self.graphs.values():
-                if shader_path.endswith(graph.file_extension):
-                    material_type = graph.name
-            return self.compile_material_from_source(material_type, source, [file_dir] + search_paths)
+            material_type, source, include_paths = self.get_material_source(shader_path, search_paths)
+            return self.compile_material_from_source(material_type, source, include_paths)
         except Exception as e:
             import traceback
             traceback.print_exc()
             return str(e)
     
-    def load_mesh(self, position, indices, normal, tangent=None, uvs=[], colors=[]):  
+    def load_mesh(self, position, indices, normal, tangent=None, uvs=[], colors=[], compact=False):  
         # Each parameter implements the Malt.Utils.IBuffer interface
         # Indices is an array of index buffers corresponding to each of the materials a mesh has
         # VBOs are shared for all the materials
+        # See the compact_vertex_format mesh parameter for the compact layout
           
         def load_VBO(data):
             VBO = gl_buffer(GL_INT, 1)
             glGenBuffers(1, VBO)
             glBindBuffer(GL_ARRAY_BUFFER, VBO[0])
-            glBufferData(GL_ARRAY_BUFFER, data.size_in_bytes(), data.buffer(), GL_STATIC_DRAW)
+            if isinstance(data, IBuffer):
+                glBufferData(GL_ARRAY_BUFFER, data.size_in_bytes(), data.buffer(), GL_STATIC_DRAW)
+            else: #numpy array
+                glBufferData(GL_ARRAY_BUFFER, data.nbytes, data.ctypes.data_as(ctypes.c_void_p), GL_STATIC_DRAW)
             glBindBuffer(GL_ARRAY_BUFFER, 0)
             return VBO
+        
+        def pack_snorm_2_10_10_10(data, components):
+            import numpy as np
+            vectors = data.as_np_array().reshape(-1, components)
+            packed = np.zeros(len(vectors), np.uint32)
+            for i in range(components):
+                bits = 2 if i == 3 else 10
+                max_value = (1 << (bits - 1)) - 1
+                value = np.rint(np.clip(vectors[:,i], -1.0, 1.0) * max_value).astype(np.int32)
+                packed |= (value.astype(np.uint32) & ((1 << bits) - 1)) << (i * 10)
+            return packed
+        
+        def to_half(data):
+            import numpy as np
+            return data.as_np_array().astype(np.float16)
+
+        def get_bounding_sphere(index):
+            # Local (center, radius) of the vertices used by each index buffer, for frustum culling
+            import numpy as np
+            if len(index) == 0:
+                return None
+            used = np.zeros(len(positions), bool)
+            used[index.as_np_array()] = True
+            vertices = positions[used]
+            center = (vertices.min(axis=0) + vertices.max(axis=0)) / 2.0
+            radius = np.sqrt(np.max(np.sum((vertices - center) ** 2, axis=1)))
+            return tuple(center.tolist()), float(radius)
+
+        vertex_count = len(position) // 3
+        positions = position.as_np_array().reshape(-1, 3)
+        compact_normal = compact and position.size_in_bytes() == normal.size_in_bytes()
 
         position_vbo = load_VBO(position)
-        normal_vbo = load_VBO(normal)
-        tangent_vbo = load_VBO(tangent) if tangent else None
-        uv_vbos = [load_VBO(e) for e in uvs]
-        color_vbos = [load_VBO(e) if e else None for e in colors]
+        normal_vbo = load_VBO(pack_snorm_2_10_10_10(normal, 3) if compact_normal else normal)
+        tangent_vbo = None
+        if tangent:
+            tangent_vbo = load_VBO(pack_snorm_2_10_10_10(tangent, 4) if compact else tangent)
+        uv_vbos = [load_VBO(to_half(e) if compact else e) for e in uvs]
+        compact_colors = [compact and e is not None and e.ctype() == ctypes.c_float for e in colors]
+        color_vbos = [load_VBO(to_half(e) if compact_color else e) if e else None for e, compact_color in zip(colors, compact_colors)]
 
         results = []
 
@@ -189,9 +339,16 @@ class Pipeline():
             result.EBO = gl_buffer(GL_INT, 1)
             glGenBuffers(1, result.EBO)
             glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, result.EBO[0])
-            glBufferData(GL_ELEMENT_ARRAY_BUFFER, index.size_in_bytes(), index.buffer(), GL_STATIC_DRAW)
+            if compact and vertex_count <= 65536:
+                import numpy as np
+                index_data = index.as_np_array().astype(np.uint16)
+                glBufferData(GL_ELEMENT_ARRAY_BUFFER, index_data.nbytes, index_data.ctypes.data_as(ctypes.c_void_p), GL_STATIC_DRAW)
+                result.index_type = GL_UNSIGNED_SHORT
+            else:
+                glBufferData(GL_ELEMENT_ARRAY_BUFFER, index.size_in_bytes(), index.buffer(), GL_STATIC_DRAW)
             
             result.index_count = len(index)
+            result.bounding_sphere = get_bounding_sphere(index)
 
             result.position = position_vbo
             result.normal = normal_vbo
@@ -203,15 +360,21 @@ class Pipeline():
                 glBindBuffer(GL_ARRAY_BUFFER, VBO[0])
                 glEnableVertexAttribArray(index)
                 glVertexAttribPointer(index, element_size, gl_type, gl_normalize, 0, None)
+                result.vertex_attributes.append((index, VBO, element_size, gl_type, gl_normalize))
             
             bind_VBO(result.position, 0, 3)
-            if position.size_in_bytes() == normal.size_in_bytes():
+            if compact_normal:
+                bind_VBO(result.normal, 1, 4, GL_INT_2_10_10_10_REV, GL_TRUE)
+            elif position.size_in_bytes() == normal.size_in_bytes():
                 bind_VBO(result.normal, 1, 3)
             else:
                 bind_VBO(result.normal, 1, 3, GL_SHORT, GL_TRUE)
             
             if tangent:
-                bind_VBO(result.tangent, 2, 4)
+                if compact:
+                    bind_VBO(result.tangent, 2, 4, GL_INT_2_10_10_10_REV, GL_TRUE)
+                else:
+                    bind_VBO(result.tangent, 2, 4)
             
             max_uv = 4
             max_vertex_colors = 4
@@ -221,7 +384,7 @@ class Pipeline():
                 if i >= max_uv:
                     LOG.warning('{} : UV count exceeds max supported UVs ({})'.format(name, max_uv))
                     break
-                bind_VBO(uv, uv0_index + i, 2)
+                bind_VBO(uv, uv0_index + i, 2, GL_HALF_FLOAT if compact else GL_FLOAT)
             for i, color in enumerate(result.colors):
                 if i >= max_vertex_colors:
                     LOG.warning('{} : Vertex Color Layer count exceeds max supported layers ({})'.format(name, max_uv))
@@ -231,7 +394,7 @@ class Pipeline():
                         bind_VBO(color, color0_index + i, 4, GL_UNSIGNED_BYTE, GL_TRUE)
                         result.color_is_srgb[i] = True
                     if colors[i]._ctype == ctypes.c_float:
-                        bind_VBO(color, color0_index + i, 4, GL_FLOAT)
+                        bind_VBO(color, color0_index + i, 4, GL_HALF_FLOAT if compact_colors[i] else GL_FLOAT)
 
             glBindVertexArray(0)
             results.append(result)
@@ -264,67 +427,86 @@ class Pipeline():
         self.copy_shader.textures['IN_DEPTH'] = depth_source
         self.draw_screen_pass(self.copy_shader, target)
     
+    def get_batch_UBO(self):
+        # Reuse the UBOs of the scene batches that are not alive anymore
+        spare = [ubo for ubo in self.batch_UBOs if getattr(ubo, 'range_count', 0) == 0]
+        for ubo in spare[1:]:
+            self.batch_UBOs.remove(ubo)
+        if len(spare) > 0:
+            return spare[0]
+        ubo = UBO()
+        self.batch_UBOs.append(ubo)
+        return ubo
+
     def build_scene_batches(self, objects):
-        result = {}
-        for obj in objects:
-            if obj.material not in result:
-                result[obj.material] = {}
-            if obj.mesh not in result[obj.material]:
-                result[obj.material][obj.mesh] = {}
-            mesh_dict = result[obj.material][obj.mesh]
-            if obj.mirror_scale:
-                if 'mirror_scale' not in mesh_dict:
-                    mesh_dict['mirror_scale'] = []
-                mesh_dict['mirror_scale'].append(obj)
-            else:
-                if 'normal_scale' not in mesh_dict:
-                    mesh_dict['normal_scale'] = []
-                mesh_dict['normal_scale'].append(obj)
+        if self.indirect_batching:
+            return self.indirect_batching.build_scene_batches(objects)
+        
+        import numpy as np
+        from Malt.GL.Shader import UBORange, uniform_buffer_offset_alignment
+
+        if len(objects) == 0:
+            return {}
         
         # Assume at least 64kb of UBO storage (d3d11 requirement) and max element size of mat4
         max_instances = 1000
-        models = (max_instances * (ctypes.c_float * 16))()
-        ids = (max_instances * ctypes.c_uint)()
-
-        for material, meshes in result.items():
-            for mesh, scale_groups in meshes.items():
-                for scale_group, objs in scale_groups.items():
-                    batches = []
-                    scale_groups[scale_group] = batches
-                    
-                    i = 0
-                    batch_length = len(objs)
-                    
-                    while i < batch_length:
-                        instance_i = i % max_instances
-                        models[instance_i] = objs[i].matrix
-                        ids[instance_i] = objs[i].parameters['ID']
-
-                        i+=1
-                        instances_count = instance_i + 1
-
-                        if i == batch_length or instances_count == max_instances:
-                            local_models = ((ctypes.c_float * 16) * instances_count).from_address(ctypes.addressof(models))
-                            # IDs are stored as uvec4, so we make sure the buffer count is a multiple of 4,
-                            # since some drivers will only bind a full uvec4 (see issue #319)
-                            id_buffer_count = math.ceil(instances_count/4)*4
-                            local_ids = (ctypes.c_uint * id_buffer_count).from_address(ctypes.addressof(ids))
-
-                            models_UBO = UBO()
-                            ids_UBO = UBO()
-
-                            models_UBO.load_data(local_models)
-                            ids_UBO.load_data(local_ids)
-
-                            batches.append({
-                                'instances_count': instances_count,
-                                'BATCH_MODELS':models_UBO,
-                                'BATCH_IDS':ids_UBO,
-                            })
+        groups, objects, matrices, ids, batch_index, batch_offset, batch_counts, batch_groups = group_scene_objects(objects, max_instances)
+
+        # All the batches are uploaded to a single UBO, each batch section starts at a multiple of the offset alignment.
+        # IDs are stored as uvec4, so we make sure the buffer count is a multiple of 4,
+        # since some drivers will only bind a full uvec4 (see issue #319)
+        alignment = uniform_buffer_offset_alignment()
+        model_align = max(1, alignment // 64)
+        id_align = max(4, alignment // 4)
+        model_slots = -(-batch_counts // model_align) * model_align
+        id_slots = -(-batch_counts // id_align) * id_align
+        model_starts = np.cumsum(model_slots) - model_slots
+        id_starts = np.cumsum(id_slots) - id_slots
+        models_size = int(model_slots.sum()) * 64
+
+        data = np.zeros(models_size + int(id_slots.sum()) * 4, np.uint8)
+        data[:models_size].view(np.float32).reshape(-1, 16)[model_starts[batch_index] + batch_offset] = matrices
+        data[models_size:].view(np.uint32)[id_starts[batch_index] + batch_offset] = ids
+
+        ubo = self.get_batch_UBO()
+        ubo.load_data((ctypes.c_ubyte * len(data)).from_buffer(data))
+
+        result = {}
+        group_batches = []
+        for material, mesh, scale_group in groups:
+            if material not in result:
+                result[material] = {}
+            if mesh not in result[material]:
+                result[material][mesh] = {}
+            batches = []
+            result[material][mesh][scale_group] = batches
+            group_batches.append(batches)
+        
+        first = 0
+        for group, count, model_start, id_start in zip(batch_groups.tolist(), batch_counts.tolist(), 
+            model_starts.tolist(), id_starts.tolist()):
+            group_batches[group].append({
+                'version': next(BATCH_VERSIONS),
+                'instances_count': count,
+                # CPU copies for culling (See Malt.Render.Culling)
+                'objects': objects[first:first+count],
+                'matrices': matrices[first:first+count],
+                'BATCH_MODELS': UBORange(ubo, model_start * 64, count * 64),
+                'BATCH_IDS': UBORange(ubo, models_size + id_start * 4, math.ceil(count/4) * 16),
+            })
+            first += count
             
         return result
     
-    def draw_scene_pass(self, render_target, scene_batches, pass_name=None, default_shader=None, shader_resources={}, depth_test_function=GL_LEQUAL):
+    def cull_scene_batches(self, scene_batches, camera, projection, clip_depth=True, bvh=None):
+        # Only the instances inside the camera frustum (See Malt.Render.Culling)
+        # Use clip_depth=False for passes rendered with GL_DEPTH_CLAMP
+        return self.culling.cull(scene_batches, camera, projection, clip_depth, bvh)
+    
+    def draw_scene_pass(self, render_target, scene_batches, pass_name=None, default_shader=None, shader_resources={}, depth_test_function=GL_LEQUAL,
+        batch_queries={}):
+        # batch_queries : Optional {id(batch) : DrawQuery}, the batches are only drawn if their query passed
+        # (See Malt.Render.OcclusionCulling)
         glDisable(GL_BLEND)
         glEnable(GL_DEPTH_TEST)
         glDepthFunc(depth_test_function)
@@ -338,12 +520,18 @@ class Pipeline():
         for material in scene_batches.keys():
             shader = default_shader
             if material and pass_name in material.shader and material.shader[pass_name]:
-                shader = material.shader[pass_name]
+                if material.shader[pass_name].is_pending() == False:
+                    shader = material.shader[pass_name]
             
             for resource in shader_resources.values():
                 resource.shader_callback(shader)
             
             shader.bind()
+
+            if self.indirect_batching and self.indirect_batching.can_draw(shader):
+                self.indirect_batching.draw(shader, scene_batches[material])
+                _double_sided = None
+                continue
             
             precomputed_tangents_uniform = shader.uniforms.get('PRECOMPUTED_TANGENTS')
             _precomputed_tangents = None
@@ -388,9 +576,16 @@ class Pipeline():
                                 shader.uniforms['MIRROR_SCALE'].bind(True)
                 
                     for batch in batches:
+                        if 'BATCH_MODELS' not in batch:
+                            self.indirect_batching.load_batch_UBOs(batch)
                         batch['BATCH_MODELS'].bind(shader.uniform_blocks['BATCH_MODELS'])
                         batch['BATCH_IDS'].bind(shader.uniform_blocks['BATCH_IDS'])
-                        glDrawElementsInstanced(GL_TRIANGLES, mesh.mesh.index_count, GL_UNSIGNED_INT, NULL, batch['instances_count'])
+                        query = batch_queries.get(id(batch))
+                        if query:
+                            query.begin_conditional_draw()
+                        glDrawElementsInstanced(GL_TRIANGLES, mesh.mesh.index_count, mesh.mesh.index_type, NULL, batch['instances_count'])
+                        if query:
+                            query.end_conditional_draw()
 
 
     def render(self, resolution, scene, is_final_render, is_new_frame):
@@ -403,12 +598,21 @@ class Pipeline():
         if is_new_frame:
             self.sample_count = 0
         
+        if self.sample_count == 0:
+            import time
+            self.frame_start_time = time.perf_counter()
+        
         if self.needs_more_samples() == False:
             return self.result
         
         self.common_buffer.load(scene, resolution)
+        self.culling.begin_frame()
         self.result = self.do_render(resolution, scene, is_final_render, is_new_frame)
         
+        self.culling.end_frame()
+        if self.indirect_batching:
+            self.indirect_batching.end_frame()
+        
         self.sample_count += 1
 
         return self.result
@@ -27,6 +27,8 @@ class PipelineGraph():
         self.libs = []
         self.lib_files = []
         self.include_paths = []
+        # Preprocessor definitions for all the graph shaders (See Pipeline.shader_defines)
+        self.defines = []
         self.functions = {}
         self.structs = {}
         self.subcategories = {}
@@ -112,7 +114,7 @@ class GLSLPipelineGraph(PipelineGraph):
     
     def preprocess_shader_from_source(self, source, include_paths=[], defines=[]):
         from Malt.GL.Shader import shader_preprocessor
-        return shader_preprocessor(source, self.include_paths + include_paths, [self.get_material_define()] + defines)
+        return shader_preprocessor(source, self.include_paths + include_paths, [self.get_material_define()] + self.defines + defines)
 
     def setup_reflection(self):
         super().setup_reflection()
@@ -159,21 +161,70 @@ class GLSLPipelineGraph(PipelineGraph):
         code += '\n\n'
         return code
     
-    def compile_material(self, source, include_paths=[]):
-        def preprocess(params):
-            return self.preprocess_shader_from_source(*params)
-        
-        params = []
+    def get_material_stages(self, source, include_paths=[]):
+        # (include directories, definitions) of each shader stage, in the order expected by link_material
+        from Malt.GL.GL import hasGLExtension
+        include_directories = self.include_paths + include_paths
+        definitions = [self.get_material_define()] + self.defines
+        if hasGLExtension('GL_ARB_bindless_texture'):
+            definitions.append('GL_ARB_bindless_texture')
+        stages = []
         for shader in self.shaders:
-            params.append((source, include_paths, [shader, 'VERTEX_SHADER']))
-            params.append((source, include_paths, [shader, 'PIXEL_SHADER']))
-        preprocessed = self.pool.map(preprocess, params)
-
+            stages.append((include_directories, definitions + [shader, 'VERTEX_SHADER']))
+            stages.append((include_directories, definitions + [shader, 'PIXEL_SHADER']))
+        return stages
+    
+    def get_material_cache_key(self, source, include_paths=[]):
+        from Malt.GL.Shader import material_cache_key
+        return material_cache_key(source, self.include_paths + include_paths, [self.get_material_define()] + self.defines + self.shaders)
+    
+    def load_cached_material(self, cache_key):
+        from Malt.GL.Shader import load_material_cache, shader_from_cache_data
+        cache = load_material_cache(cache_key)
+        if cache:
+            shaders = {}
+            for shader, data in cache['shaders'].items():
+                shaders[shader] = shader_from_cache_data(data)
+            if None not in shaders.values():
+                return shaders
+        return None
+    
+    def link_material(self, preprocessed, dependencies, cache_key=None, compiler=None):
+        # When a compiler (Malt.GL.Shader.AsyncShaderCompiler) is passed, the shaders are returned in a pending state
+        # and cache_material should be called once they are ready
         from Malt.GL.Shader import Shader
+        preprocessed = list(preprocessed)
         shaders = {}
         for shader in self.shaders:
-            shaders[shader] = Shader(preprocessed.pop(0), preprocessed.pop(0))
+            shaders[shader] = Shader(preprocessed.pop(0), preprocessed.pop(0), compiler)
+        if compiler is None:
+            self.cache_material(shaders, dependencies, cache_key)
         return shaders
+    
+    def cache_material(self, shaders, dependencies, cache_key):
+        from Malt.GL.Shader import save_material_cache
+        from Malt.GL.GLSLPreprocessor import dependencies_changed
+        if cache_key and all(shader.error is None for shader in shaders.values()) and dependencies_changed(dependencies) == False:
+            save_material_cache(cache_key, dependencies, {name : shader.get_cache_data() for name, shader in shaders.items()})
+    
+    def compile_material(self, source, include_paths=[]):
+        cache_key = self.get_material_cache_key(source, include_paths)
+        shaders = self.load_cached_material(cache_key)
+        if shaders:
+            return shaders
+
+        from Malt.GL.GLSLPreprocessor import preprocess_stage
+        def preprocess(stage):
+            return preprocess_stage(source, *stage)
+        
+        preprocessed = self.pool.map(preprocess, self.get_material_stages(source, include_paths))
+
+        dependencies = {}
+        for result, result_dependencies in preprocessed:
+            dependencies.update(result_dependencies)
+        preprocessed = [result for result, result_dependencies in preprocessed]
+
+        return self.link_material(preprocessed, dependencies, cache_key)
 
 class PythonGraphIO(PipelineGraphIO):
 
@@ -58,7 +58,9 @@ class MiniPipeline(Pipeline):
 
         self.fbo_main.clear([scene.world_parameters['Background Color']], 1)
 
-        self.draw_scene_pass(self.fbo_main, scene.batches, 'MAIN_PASS', self.default_shader['MAIN_PASS'], shader_resources)
+        batches = self.cull_scene_batches(scene.batches, scene.camera.camera_matrix, scene.camera.projection_matrix,
+            bvh=scene.bvh)
+        self.draw_scene_pass(self.fbo_main, batches, 'MAIN_PASS', self.default_shader['MAIN_PASS'], shader_resources)
 
         return { 'COLOR' : self.t_main_color }
 
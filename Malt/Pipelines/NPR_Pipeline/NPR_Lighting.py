@@ -61,13 +61,8 @@ class NPR_ShadowMaps(Lighting.ShadowMaps):
             for i in range(self.point_depth_t.length*6):
                 self.point_fbos.append(RenderTarget([ArrayLayerTarget(self.point_id_t, i)], ArrayLayerTarget(self.point_depth_t, i)))
     
-    def clear(self, spot_count, sun_count, point_count):
-        for i in range(spot_count):
-            self.spot_fbos[i].clear([0], depth=1)
-        for i in range(sun_count):
-            self.sun_fbos[i].clear([0], depth=1)
-        for i in range(point_count*6):
-            self.point_fbos[i].clear([0], depth=1)
+    def clear_fbo(self, fbo):
+        fbo.clear([0], depth=1)
     
     def shader_callback(self, shader):
         super().shader_callback(shader)
@@ -105,13 +100,8 @@ class NPR_TransparentShadowMaps(NPR_ShadowMaps):
                 targets = [ArrayLayerTarget(self.point_id_t, i), ArrayLayerTarget(self.point_color_t, i)]
                 self.point_fbos.append(RenderTarget(targets, ArrayLayerTarget(self.point_depth_t, i)))
     
-    def clear(self, spot_count, sun_count, point_count):
-        for i in range(spot_count):
-            self.spot_fbos[i].clear([0, (0,0,0,0)], depth=1)
-        for i in range(sun_count):
-            self.sun_fbos[i].clear([0, (0,0,0,0)], depth=1)
-        for i in range(point_count*6):
-            self.point_fbos[i].clear([0, (0,0,0,0)], depth=1)
+    def clear_fbo(self, fbo):
+        fbo.clear([0, (0,0,0,0)], depth=1)
 
     def shader_callback(self, shader):
         shader.textures['TRANSPARENT_SHADOWMAPS_DEPTH_SPOT'] = self.spot_depth_t
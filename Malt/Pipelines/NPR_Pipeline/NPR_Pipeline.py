@@ -67,11 +67,14 @@ DEFAULTS_PATH = os.path.join(os.path.dirname(__file__), 'Defaults', 'defaults')
 
 class NPR_Pipeline(Pipeline):
 
+    SCENE_BVH = True
+
     def __init__(self, plugins=[]):
         shader_dir = path.join(path.dirname(__file__), 'Shaders')
         if shader_dir not in self.SHADER_INCLUDE_PATHS:
             self.SHADER_INCLUDE_PATHS.append(shader_dir)
         self.sampling_grid_size = 1
+        self.sampling_pattern = 'Rotated Grid'
         self.samples = None
         super().__init__(plugins)
     
@@ -83,11 +86,25 @@ class NPR_Pipeline(Pipeline):
             Higher values will provide cleaner renders at the cost of increased render times.""")
         
         self.parameters.world['Samples.Grid Size @ Preview'] = Parameter(4, Type.INT)
+
+        self.parameters.world['Samples.Pattern'] = EnumParameter(Sampling.PATTERNS, 'Rotated Grid', doc="""
+            The distribution and order of the render samples. 
+            *Halton*, *Sobol*, *R2* and *Blue Noise* are ordered so partial results are well distributed, 
+            which makes progressive viewport renders converge faster.""")
         
         self.parameters.world['Samples.Width'] = Parameter(1.0, Type.FLOAT, doc="""
             The width (and height) of the sampling grid. 
             Larger values will result in smoother/blurrier images while lower values will result in sharper/more aliased ones. 
             Keep it withing the 1-2 range for best results.""")
+        
+        self.parameters.world['Samples.Viewport Noise Threshold'] = Parameter(0.0, Type.FLOAT, doc="""
+            Stops rendering viewport samples once the estimated noise (the standard error of the accumulated luminance) falls below this value. 
+            Around 0.002 (half an 8 bit step) is usually indistinguishable from the full sample count. 0 disables it.  
+            Final renders always render all the samples.""")
+        
+        self.parameters.world['Samples.Viewport Time Budget'] = Parameter(0.0, Type.FLOAT, doc="""
+            The maximum time (in seconds) spent on the samples of a viewport frame. 0 disables it.  
+            Final renders always render all the samples.""")
                 
         self.parameters.world['Material.Default'] = MaterialParameter((DEFAULTS_PATH, 'Malt - Default Mesh Material'),
             '.mesh.glsl', 'Mesh',
@@ -252,7 +269,7 @@ class NPR_Pipeline(Pipeline):
     
     def get_samples(self):
         if self.samples is None:
-            self.samples = Sampling.get_RGSS_samples(self.sampling_grid_size, 1.0)
+            self.samples = Sampling.get_samples(self.sampling_pattern, self.sampling_grid_size, 1.0)
         return self.samples
     
     def get_sample(self, width):
@@ -277,8 +294,19 @@ class NPR_Pipeline(Pipeline):
         if self.sampling_grid_size != scene.world_parameters['Samples.Grid Size']:
             self.sampling_grid_size = scene.world_parameters['Samples.Grid Size']
             self.samples = None
+        pattern = Sampling.PATTERNS[scene.world_parameters['Samples.Pattern']]
+        if self.sampling_pattern != pattern:
+            self.sampling_pattern = pattern
+            self.samples = None
         
         self.is_new_frame = is_new_frame
+
+        if is_final_render:
+            self.sampling_noise_threshold = 0
+            self.sampling_time_budget = 0
+        else:
+            self.sampling_noise_threshold = scene.world_parameters['Samples.Viewport Noise Threshold']
+            self.sampling_time_budget = scene.world_parameters['Samples.Viewport Time Budget']
         
         sample_offset = self.get_sample(scene.world_parameters['Samples.Width'])
 
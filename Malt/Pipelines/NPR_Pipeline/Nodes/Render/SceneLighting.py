@@ -18,6 +18,8 @@ class SceneLighting(PipelineNode):
         self.shadowmaps_opaque = NPR_Lighting.NPR_ShadowMaps()
         self.shadowmaps_transparent = NPR_Lighting.NPR_TransparentShadowMaps()
         self.common_buffer = Common.CommonBuffer()
+        # (light type, shadow map index, opaque/transparent) : key of the last render, see get_shadowmap_key
+        self.shadowmap_cache = {}
 
     @classmethod
     def reflect_inputs(cls):
@@ -46,6 +48,11 @@ class SceneLighting(PipelineNode):
         inputs['Sun CSM Distribution'] = Parameter(0.9, Type.FLOAT, doc="""
             Interpolates the cascades distribution along the view distance between linear distribution *(at 0)* and logarithmic distribution *(at 1)*.  
             The appropriate value depends on camera FOV and scene characteristics.""")
+        
+        inputs['Shadow Cache'] = Parameter(True, Type.BOOL, doc="""
+            Reuse the shadow maps across samples and frames while their lights and shadow casters don't change.  
+            Disable it for materials with per sample random opacity in their shadows. 
+            Transparent shadows are always rendered on each sample.""")
         return inputs
     
     @classmethod
@@ -55,6 +62,20 @@ class SceneLighting(PipelineNode):
             "The scene with the light data already loaded in the shader resources.")
         return outputs
 
+    def get_casters_key(self, batches):
+        key = []
+        for material, meshes in batches.items():
+            shader = material.shader['SHADOW_PASS'] if material and material.shader else None
+            versions = tuple(batch['version'] for scale_groups in meshes.values() 
+                for scale_batches in scale_groups.values() for batch in scale_batches)
+            key.append((material, shader, versions))
+        return tuple(key)
+    
+    def get_shadowmap_key(self, scene, shadowmaps, camera, projection, casters):
+        scene_key = scene.proxys_version if scene.proxys_version is not None else scene
+        return (scene_key, scene.time, scene.frame, shadowmaps.setup_version,
+            tuple(camera), tuple(projection), self.get_casters_key(casters))
+
     def execute(self, parameters):
         inputs = parameters['IN']
         outputs = parameters['OUT']
@@ -84,45 +105,66 @@ class SceneLighting(PipelineNode):
             inputs['Spot Resolution'],
             inputs['Sun Resolution'],
             inputs['Point Resolution'],
-            inputs['Sun CSM Count'])
+            inputs['Sun CSM Count'],
+            clear=False)
         self.shadowmaps_transparent.load(scene,
             inputs['Spot Resolution'],
             inputs['Sun Resolution'],
             inputs['Point Resolution'],
-            inputs['Sun CSM Count'])
+            inputs['Sun CSM Count'],
+            clear=False)
+        use_cache = inputs['Shadow Cache']
         
         shader_resources = scene.shader_resources.copy()
         shader_resources['COMMON_UNIFORMS'] = self.common_buffer
         shader_resources['SCENE_LIGHTS'] = self.lights_buffer
 
-        def render_shadowmaps(lights, fbos_opaque, fbos_transparent):
+        def render_shadowmaps(light_type, lights, fbos_opaque, fbos_transparent):
             for light_index, light_matrices_pair in enumerate(lights.items()):
                 light, matrices = light_matrices_pair
+                def get_light_group_batches(batches):
+                    result = {}
+                    for material, meshes in batches.items():
+                        if material and light.parameters['Light Group'] in material.parameters['Light Groups.Shadow']:
+                            result[material] = meshes
+                    return result
+                light_opaque_batches = get_light_group_batches(opaque_batches)
+                light_transparent_batches = get_light_group_batches(transparent_batches)
                 for matrix_index, camera_projection_pair in enumerate(matrices): 
                     camera, projection = camera_projection_pair
                     i = light_index * len(matrices) + matrix_index
-                    self.common_buffer.load(scene, fbos_opaque[i].resolution, (0,0), self.pipeline.sample_count, camera, projection)
-                    def get_light_group_batches(batches):
-                        result = {}
-                        for material, meshes in batches.items():
-                            if material and light.parameters['Light Group'] in material.parameters['Light Groups.Shadow']:
-                                result[material] = meshes
-                        return result
-                    #TODO: Callback
-                    self.pipeline.draw_scene_pass(fbos_opaque[i], get_light_group_batches(opaque_batches), 
-                        'SHADOW_PASS', self.pipeline.default_shader['SHADOW_PASS'], shader_resources)
-                    self.pipeline.draw_scene_pass(fbos_transparent[i], get_light_group_batches(transparent_batches), 
-                        'SHADOW_PASS', self.pipeline.default_shader['SHADOW_PASS'], shader_resources)
+                    # Transparent shadows are stochastic, they can only be reused when there are no transparent casters
+                    passes = (
+                        ('OPAQUE', self.shadowmaps_opaque, fbos_opaque[i], light_opaque_batches, True),
+                        ('TRANSPARENT', self.shadowmaps_transparent, fbos_transparent[i], light_transparent_batches, 
+                            len(light_transparent_batches) == 0),
+                    )
+                    common_buffer_loaded = False
+                    for pass_name, shadowmaps, fbo, batches, can_cache in passes:
+                        cache_key = (light_type, i, pass_name)
+                        key = self.get_shadowmap_key(scene, shadowmaps, camera, projection, batches)
+                        if use_cache and can_cache and self.shadowmap_cache.get(cache_key) == key:
+                            continue
+                        self.shadowmap_cache[cache_key] = key
+                        if common_buffer_loaded == False:
+                            self.common_buffer.load(scene, fbo.resolution, (0,0), self.pipeline.sample_count, camera, projection)
+                            common_buffer_loaded = True
+                        shadowmaps.clear_fbo(fbo)
+                        # Sun cascades are rendered with depth clamp, casters outside the depth range still count
+                        batches = self.pipeline.cull_scene_batches(batches, camera, projection, light_type != 'SUN', scene.bvh)
+                        #TODO: Callback
+                        self.pipeline.draw_scene_pass(fbo, batches, 
+                            'SHADOW_PASS', self.pipeline.default_shader['SHADOW_PASS'], shader_resources)
         
-        render_shadowmaps(self.lights_buffer.spots,
+        render_shadowmaps('SPOT', self.lights_buffer.spots,
             self.shadowmaps_opaque.spot_fbos, self.shadowmaps_transparent.spot_fbos)
         
         glEnable(GL_DEPTH_CLAMP)
-        render_shadowmaps(self.lights_buffer.suns,
+        render_shadowmaps('SUN', self.lights_buffer.suns,
             self.shadowmaps_opaque.sun_fbos, self.shadowmaps_transparent.sun_fbos)
         glDisable(GL_DEPTH_CLAMP)
 
-        render_shadowmaps(self.lights_buffer.points,
+        render_shadowmaps('POINT', self.lights_buffer.points,
             self.shadowmaps_opaque.point_fbos, self.shadowmaps_transparent.point_fbos)
         
         import copy
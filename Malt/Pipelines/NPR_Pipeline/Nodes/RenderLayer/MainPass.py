@@ -4,6 +4,7 @@ from Malt.GL.RenderTarget import RenderTarget
 from Malt.PipelineNode import PipelineNode
 from Malt.PipelineParameters import Parameter, Type
 from Malt.Scene import TextureShaderResource
+from Malt.Render.OcclusionCulling import HiZ, OcclusionCulling
 
 class MainPass(PipelineNode):
     """
@@ -16,6 +17,9 @@ class MainPass(PipelineNode):
         PipelineNode.__init__(self, pipeline)
         self.resolution = None
         self.t_depth = None
+        self.hiz = HiZ()
+        # { layer index : OcclusionCulling }
+        self.occlusion_culling = {}
     
     @staticmethod
     def get_pass_type():
@@ -27,6 +31,10 @@ class MainPass(PipelineNode):
         inputs['Scene'] = Parameter('Scene', Type.OTHER)
         inputs['Normal Depth'] = Parameter('', Type.TEXTURE)
         inputs['ID'] = Parameter('', Type.TEXTURE)
+        inputs['Occlusion Culling'] = Parameter(False, Type.BOOL, doc="""
+            Skip the objects hidden behind the *Pre Pass* depth.  
+            Objects are tested with their mesh bounds, use the mesh *bounds_padding* for materials that displace their vertices.
+            """)
         return inputs
     
     @classmethod
@@ -78,9 +86,19 @@ class MainPass(PipelineNode):
                     glsl_name = GLSLTranspiler.custom_io_reference('IN', 'MAIN_PASS_PIXEL_SHADER', io['name'])
                     shader_resources['CUSTOM_IO'+glsl_name] = TextureShaderResource(glsl_name, inputs[io['name']])
                     
+        batches = self.pipeline.cull_scene_batches(scene.batches, scene.camera.camera_matrix, scene.camera.projection_matrix,
+            bvh=scene.bvh)
+        batch_queries = {}
+        if inputs['Occlusion Culling']:
+            layer_index = parameters['__GLOBALS__']['__LAYER_INDEX__']
+            if layer_index not in self.occlusion_culling:
+                self.occlusion_culling[layer_index] = OcclusionCulling(self.pipeline, 'Main Pass Layer {}'.format(layer_index))
+            self.hiz.build(self.pipeline, t_depth)
+            batch_queries = self.occlusion_culling[layer_index].test(batches, self.hiz, shader_resources)
+        
         self.fbo.clear([(0,0,0,0)] * len(self.fbo.targets))
-        self.pipeline.draw_scene_pass(self.fbo, scene.batches, 'MAIN_PASS', self.pipeline.default_shader['MAIN_PASS'], 
-            shader_resources, GL_EQUAL)
+        self.pipeline.draw_scene_pass(self.fbo, batches, 'MAIN_PASS', self.pipeline.default_shader['MAIN_PASS'], 
+            shader_resources, GL_EQUAL, batch_queries)
 
         outputs.update(self.custom_targets)
 
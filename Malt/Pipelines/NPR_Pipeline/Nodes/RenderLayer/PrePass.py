@@ -4,6 +4,7 @@ from Malt.GL.RenderTarget import RenderTarget
 from Malt.PipelineNode import PipelineNode
 from Malt.PipelineParameters import Parameter, Type
 from Malt.Scene import TextureShaderResource
+from Malt.Render.OcclusionCulling import HiZ, OcclusionCulling
 
 from Malt.Pipelines.NPR_Pipeline.NPR_LightShaders import NPR_LightShaders
 
@@ -19,6 +20,10 @@ class PrePass(PipelineNode):
         self.resolution = None
         self.custom_io = []
         self.npr_light_shaders = NPR_LightShaders()
+        self.opaque_hiz = HiZ()
+        self.opaque_hiz_valid = False
+        # { layer index : OcclusionCulling }
+        self.occlusion_culling = {}
     
     @staticmethod
     def get_pass_type():
@@ -28,6 +33,10 @@ class PrePass(PipelineNode):
     def reflect_inputs(cls):
         inputs = {}
         inputs['Scene'] = Parameter('Scene', Type.OTHER)
+        inputs['Occlusion Culling'] = Parameter(False, Type.BOOL, doc="""
+            Skip the transparent layer objects hidden behind the opaque layer depth.  
+            Objects are tested with their mesh bounds, use the mesh *bounds_padding* for materials that displace their vertices.
+            """)
         return inputs
     
     @classmethod
@@ -63,7 +72,8 @@ class PrePass(PipelineNode):
         custom_io = parameters['CUSTOM_IO']
         scene = inputs['Scene']
 
-        is_opaque_pass = parameters['__GLOBALS__']['__LAYER_INDEX__'] == 0
+        layer_index = parameters['__GLOBALS__']['__LAYER_INDEX__']
+        is_opaque_pass = layer_index == 0
 
         if self.pipeline.resolution != self.resolution or self.custom_io != custom_io:
             self.setup_render_targets(self.pipeline.resolution, custom_io)
@@ -74,6 +84,8 @@ class PrePass(PipelineNode):
         scene = copy.copy(scene)
         opaque_batches, transparent_batches = self.pipeline.get_scene_batches(scene)
         scene.batches = opaque_batches if is_opaque_pass else transparent_batches
+        scene.batches = self.pipeline.cull_scene_batches(scene.batches, scene.camera.camera_matrix, scene.camera.projection_matrix,
+            bvh=scene.bvh)
         
         shader_resources = scene.shader_resources.copy()
         shader_resources.update({
@@ -81,14 +93,25 @@ class PrePass(PipelineNode):
             'IN_TRANSPARENT_DEPTH': TextureShaderResource('IN_TRANSPARENT_DEPTH', self.t_transparent_depth),
             'IN_LAST_ID': TextureShaderResource('IN_LAST_ID', self.t_last_layer_id),
         })
+        batch_queries = {}
+        if inputs['Occlusion Culling'] and not is_opaque_pass and self.opaque_hiz_valid:
+            if layer_index not in self.occlusion_culling:
+                self.occlusion_culling[layer_index] = OcclusionCulling(self.pipeline, 'Pre Pass Layer {}'.format(layer_index))
+            batch_queries = self.occlusion_culling[layer_index].test(scene.batches, self.opaque_hiz, shader_resources)
+        
         self.fbo.clear([(0,0,0,1), (0,0,0,0)] + [(0,0,0,0)]*len(self.custom_targets), 1)
 
-        self.pipeline.draw_scene_pass(self.fbo, scene.batches, 'PRE_PASS', self.pipeline.default_shader['PRE_PASS'], shader_resources)
+        self.pipeline.draw_scene_pass(self.fbo, scene.batches, 'PRE_PASS', self.pipeline.default_shader['PRE_PASS'], shader_resources,
+            batch_queries=batch_queries)
 
         if is_opaque_pass:
             self.fbo_last_layer_id.clear([(0,0,0,0)])
             self.fbo_transparent_depth.clear([], -1)
             self.pipeline.copy_textures(self.fbo_opaque_depth, [], self.t_depth)
+            # The transparent layers are tested against the opaque depth
+            self.opaque_hiz_valid = inputs['Occlusion Culling'] and len(transparent_batches) > 0
+            if self.opaque_hiz_valid:
+                self.opaque_hiz.build(self.pipeline, self.t_opaque_depth)
         else:
             self.pipeline.copy_textures(self.fbo_last_layer_id, [self.t_id])
             self.pipeline.copy_textures(self.fbo_transparent_depth, [], self.t_depth)
@@ -0,0 +1,118 @@
+import ctypes
+
+from Malt.GL.GL import *
+from Malt.GL.Texture import Texture
+from Malt.GL.RenderTarget import RenderTarget
+
+_MOMENTS_SHADER_SRC='''
+#define SAMPLE_MOMENTS
+#include "Passes/SampleVariance.glsl"
+'''
+
+_ERROR_SHADER_SRC='''
+#define SAMPLE_ERROR
+#include "Passes/SampleVariance.glsl"
+'''
+
+_MOMENTS_SHADER = None
+_ERROR_SHADER = None
+
+# The error estimate is not reliable with fewer samples
+MIN_SAMPLES = 4
+
+class SampleVariance():
+    # Estimates the remaining noise of a progressively accumulated image.
+    # The luminance mean and mean of squares are accumulated alongside the samples,
+    # the per pixel standard error is averaged by a mipmap reduction, and the 1x1 level is read back asynchronously.
+    # So the estimate lags a few samples behind, but it never stalls the pipeline.
+    
+    def __init__(self):
+        self.resolution = None
+        self.moments_shader = None
+        self.error_shader = None
+        # Average standard error of the pixels with any variance, for the last read back sample
+        self.error = None
+        # Accumulated samples of the current frame
+        self.sample_count = 0
+        # [(buffer, sync)]
+        self.readbacks = []
+        self.free_buffers = []
+    
+    def setup_render_targets(self, resolution):
+        self.t_moments = Texture(resolution, GL_RG32F)
+        self.fbo_moments = RenderTarget([self.t_moments])
+        self.t_error = Texture(resolution, GL_RG32F, min_filter=GL_LINEAR_MIPMAP_LINEAR, build_mipmaps=True)
+        self.fbo_error = RenderTarget([self.t_error])
+        self.max_level = max(resolution).bit_length() - 1
+        self.resolution = resolution
+    
+    def reset(self):
+        for buffer, sync in self.readbacks:
+            glDeleteSync(sync)
+            self.free_buffers.append(buffer)
+        self.readbacks = []
+        self.error = None
+    
+    def add_sample(self, pipeline, color, sample_count, is_new_frame):
+        if self.moments_shader is None:
+            global _MOMENTS_SHADER, _ERROR_SHADER
+            if _MOMENTS_SHADER is None: _MOMENTS_SHADER = pipeline.compile_shader_from_source(_MOMENTS_SHADER_SRC)
+            if _ERROR_SHADER is None: _ERROR_SHADER = pipeline.compile_shader_from_source(_ERROR_SHADER_SRC)
+            self.moments_shader = _MOMENTS_SHADER
+            self.error_shader = _ERROR_SHADER
+        if self.resolution != pipeline.resolution:
+            self.setup_render_targets(pipeline.resolution)
+        if is_new_frame:
+            self.reset()
+            self.fbo_moments.clear([(0,0,0,0)])
+        self.sample_count = sample_count + 1
+        
+        self.moments_shader.textures['color_texture'] = color
+        glBlendFunc(GL_CONSTANT_ALPHA, GL_ONE_MINUS_CONSTANT_ALPHA)
+        glBlendEquation(GL_FUNC_ADD)
+        glBlendColor(0, 0, 0, 1.0 / (sample_count + 1))
+        pipeline.draw_screen_pass(self.moments_shader, self.fbo_moments, True)
+
+        self.error_shader.textures['moments_texture'] = self.t_moments
+        self.error_shader.uniforms['sample_count'].set_value(sample_count + 1)
+        pipeline.draw_screen_pass(self.error_shader, self.fbo_error)
+
+        self.t_error.bind()
+        glGenerateMipmap(GL_TEXTURE_2D)
+        if len(self.free_buffers) > 0:
+            buffer = self.free_buffers.pop()
+        else:
+            buffer = gl_buffer(GL_INT, 1)
+            glGenBuffers(1, buffer)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, buffer[0])
+            glBufferData(GL_PIXEL_PACK_BUFFER, ctypes.sizeof(ctypes.c_float) * 2, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, buffer[0])
+        glGetTexImage(GL_TEXTURE_2D, self.max_level, GL_RG, GL_FLOAT, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        self.readbacks.append((buffer, glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)))
+    
+    def poll(self):
+        while len(self.readbacks) > 0:
+            buffer, sync = self.readbacks[0]
+            wait = glClientWaitSync(sync, GL_SYNC_FLUSH_COMMANDS_BIT, 0)
+            if wait not in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+                break
+            self.readbacks.pop(0)
+            glDeleteSync(sync)
+            result = (ctypes.c_float * 2)()
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, buffer[0])
+            glGetBufferSubData(GL_PIXEL_PACK_BUFFER, 0, ctypes.sizeof(result), result)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+            self.free_buffers.append(buffer)
+            error, noisy_pixels = result
+            self.error = error / noisy_pixels if noisy_pixels > 0 else 0
+        return self.error
+    
+    def __del__(self):
+        try:
+            self.reset()
+            for buffer in self.free_buffers:
+                glDeleteBuffers(1, buffer)
+        except:
+            pass
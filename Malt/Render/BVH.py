@@ -0,0 +1,193 @@
+import itertools
+import numpy as np
+
+# Bounding volume hierarchy over the world space bounding spheres of the scene objects.
+# Nodes are stored in flat arrays and queries traverse a whole tree level at a time, so they run as numpy operations.
+# Query results are sorted index arrays into the objects list the tree was built from.
+
+LEAF_SIZE = 16
+# Objects without a bounding sphere can't be culled, they're returned by every spatial query
+UNBOUNDED_RADIUS = 1e30
+# Rebuild instead of refitting once the nodes have grown this much since the last build
+REFIT_MAX_GROWTH = 2.0
+
+VERSIONS = itertools.count(1)
+
+def get_object_spheres(objects):
+    from Malt.Render.Culling import get_world_spheres, get_mesh_sphere
+    from Malt.Pipeline import get_object_matrices
+    count = len(objects)
+    matrices = get_object_matrices(objects)
+    mesh_spheres = {}
+    local_centers = np.zeros((count, 3))
+    local_radii = np.full(count, UNBOUNDED_RADIUS)
+    for i, obj in enumerate(objects):
+        sphere = mesh_spheres.get(obj.mesh)
+        if sphere is None:
+            sphere = get_mesh_sphere(obj.mesh) or False
+            mesh_spheres[obj.mesh] = sphere
+        if sphere:
+            local_centers[i], local_radii[i] = sphere
+    centers, radii = get_world_spheres(matrices.astype(np.float64), local_centers, local_radii)
+    radii[local_radii == UNBOUNDED_RADIUS] = UNBOUNDED_RADIUS
+    return centers, radii
+
+def ranges_to_indices(starts, counts):
+    # Concatenated arange(start, start + count) of each range
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, np.int64)
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(total)
+
+
+class BVH():
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.version = None
+        self.build_version = None
+        self.tags = None
+        self.build()
+
+    def build(self):
+        self.centers, self.radii = get_object_spheres(self.objects)
+        count = len(self.objects)
+        self.order = np.arange(count)
+        # Children are always consecutive, first_child is -1 for leaves
+        starts, counts, first_child, depths = [], [], [], []
+        def add_node(start, count, depth):
+            starts.append(start)
+            counts.append(count)
+            first_child.append(-1)
+            depths.append(depth)
+            return len(starts) - 1
+        stack = [add_node(0, count, 0)] if count > 0 else []
+        while stack:
+            node = stack.pop()
+            start, count = starts[node], counts[node]
+            if count <= LEAF_SIZE:
+                continue
+            # Median split along the longest axis of the sphere centers
+            segment = self.order[start:start+count]
+            centers = self.centers[segment]
+            axis = int(np.argmax(centers.max(axis=0) - centers.min(axis=0)))
+            half = count // 2
+            self.order[start:start+count] = segment[np.argpartition(centers[:,axis], half)]
+            first_child[node] = add_node(start, half, depths[node] + 1)
+            add_node(start + half, count - half, depths[node] + 1)
+            stack += [first_child[node], first_child[node] + 1]
+
+        self.node_starts = np.array(starts, np.int64)
+        self.node_counts = np.array(counts, np.int64)
+        self.node_first_child = np.array(first_child, np.int64)
+        self.node_min = np.zeros((len(starts), 3))
+        self.node_max = np.zeros((len(starts), 3))
+        depths = np.array(depths, np.int64)
+        leaves = np.flatnonzero(self.node_first_child < 0)
+        self.leaves = leaves[np.argsort(self.node_starts[leaves])]
+        inner = np.flatnonzero(self.node_first_child >= 0)
+        self.levels = [inner[depths[inner] == depth] for depth in range(int(depths.max(initial=0)), -1, -1)]
+        self.build_version = next(VERSIONS)
+        self.object_indices = None
+        self.update_bounds()
+        self.built_area = self.get_area()
+
+    def update_bounds(self):
+        self.version = next(VERSIONS)
+        if len(self.leaves) == 0:
+            return
+        prim_min = (self.centers - self.radii[:,None])[self.order]
+        prim_max = (self.centers + self.radii[:,None])[self.order]
+        # Leaves are sorted and contiguous, so each reduceat segment is a leaf
+        leaf_starts = self.node_starts[self.leaves]
+        self.node_min[self.leaves] = np.minimum.reduceat(prim_min, leaf_starts)
+        self.node_max[self.leaves] = np.maximum.reduceat(prim_max, leaf_starts)
+        for nodes in self.levels:
+            children = self.node_first_child[nodes]
+            self.node_min[nodes] = np.minimum(self.node_min[children], self.node_min[children + 1])
+            self.node_max[nodes] = np.maximum(self.node_max[children], self.node_max[children + 1])
+
+    def get_area(self):
+        size = np.minimum(self.node_max - self.node_min, UNBOUNDED_RADIUS)
+        return float(np.sum(size[:,0] * size[:,1] + size[:,1] * size[:,2] + size[:,2] * size[:,0]))
+
+    def refit(self, objects):
+        # Update the bounds for transform-only changes, the objects must be the same (or replacements) in the same order
+        assert(len(objects) == len(self.objects))
+        self.objects = objects
+        self.object_indices = None
+        self.tags = None
+        self.centers, self.radii = get_object_spheres(objects)
+        self.update_bounds()
+        if self.get_area() > self.built_area * REFIT_MAX_GROWTH:
+            self.build()
+
+    def get_indices(self, objects):
+        # Index of each object in the tree, or None if any of them is not in it
+        if self.object_indices is None:
+            self.object_indices = {id(obj): i for i, obj in enumerate(self.objects)}
+        try:
+            return np.fromiter((self.object_indices[id(obj)] for obj in objects), np.int64, len(objects))
+        except KeyError:
+            return None
+
+    def traverse(self, test_nodes, test_objects):
+        # test_nodes(nodes) -> (outside, inside) masks, test_objects(indices) -> mask
+        if len(self.node_starts) == 0:
+            return np.zeros(0, np.int64)
+        inside_nodes = []
+        partial_leaves = []
+        frontier = np.zeros(1, np.int64)
+        while len(frontier) > 0:
+            outside, inside = test_nodes(frontier)
+            inside_nodes.append(frontier[inside])
+            partial = frontier[~outside & ~inside]
+            is_leaf = self.node_first_child[partial] < 0
+            partial_leaves.append(partial[is_leaf])
+            children = self.node_first_child[partial[~is_leaf]]
+            frontier = np.concatenate((children, children + 1))
+
+        def get_objects(nodes):
+            nodes = np.concatenate(nodes)
+            return self.order[ranges_to_indices(self.node_starts[nodes], self.node_counts[nodes])]
+
+        candidates = get_objects(partial_leaves)
+        result = np.concatenate((get_objects(inside_nodes), candidates[test_objects(candidates)]))
+        result.sort()
+        return result
+
+    def query_frustum(self, planes):
+        # planes : Inward (normal, distance) planes, see Malt.Render.Culling.get_frustum_planes
+        from Malt.Render.Culling import get_visible_spheres
+        normals = planes[:,:3]
+        def test_nodes(nodes):
+            center = (self.node_min[nodes] + self.node_max[nodes]) / 2.0
+            extent = (self.node_max[nodes] - self.node_min[nodes]) / 2.0
+            distance = center @ normals.T + planes[:,3]
+            radius = extent @ np.abs(normals).T
+            return np.any(distance < -radius, axis=1), np.all(distance >= radius, axis=1)
+        def test_objects(indices):
+            return get_visible_spheres(planes, self.centers[indices], self.radii[indices])
+        return self.traverse(test_nodes, test_objects)
+
+    def query_sphere(self, center, radius):
+        center = np.asarray(center, np.float64)
+        def test_nodes(nodes):
+            node_min, node_max = self.node_min[nodes], self.node_max[nodes]
+            nearest = np.clip(center, node_min, node_max)
+            farthest = np.maximum(np.abs(node_min - center), np.abs(node_max - center))
+            return (np.sum((nearest - center) ** 2, axis=1) > radius ** 2,
+                np.sum(farthest ** 2, axis=1) <= radius ** 2)
+        def test_objects(indices):
+            return np.linalg.norm(self.centers[indices] - center, axis=1) <= radius + self.radii[indices]
+        return self.traverse(test_nodes, test_objects)
+
+    def query_tag(self, tag):
+        if self.tags is None:
+            tags = {}
+            for i, obj in enumerate(self.objects):
+                for object_tag in obj.tags:
+                    tags.setdefault(object_tag, []).append(i)
+            self.tags = {key: np.array(value, np.int64) for key, value in tags.items()}
+        return self.tags.get(tag, np.zeros(0, np.int64))
@@ -0,0 +1,129 @@
+import numpy as np
+
+# CPU frustum culling for the scene batches.
+# Meshes store a local bounding sphere (See Pipeline.load_mesh), the spheres of all the instances of a batch
+# are transformed to world space at once and tested against the frustum planes.
+# Passes with culled instances get their own batches, rebuilt from the visible objects.
+# When the scene has a BVH (See Malt.Render.BVH), the visible objects are found with a single tree query instead.
+
+def get_frustum_planes(camera, projection, clip_depth=True):
+    # Camera and projection are column-major flat matrices, as the ones loaded in the Common buffer.
+    # Returns a (planes, 4) array of normalized (normal, distance) planes, pointing inwards.
+    view_projection = np.array(projection, np.float64).reshape(4,4).T @ np.array(camera, np.float64).reshape(4,4).T
+    x, y, z, w = view_projection
+    planes = [w + x, w - x, w + y, w - y]
+    if clip_depth:
+        planes += [w + z, w - z]
+    planes = np.array(planes)
+    length = np.linalg.norm(planes[:,:3], axis=1)
+    # Degenerate planes (ie. infinite far planes) can't cull anything
+    planes = planes[length > 1e-8]
+    return planes / np.linalg.norm(planes[:,:3], axis=1)[:,None]
+
+def get_mesh_data(mesh):
+    # The loaded mesh of a Scene.Mesh. Bridge MeshProxys are updated in place when their mesh is reloaded,
+    # so the proxy itself doesn't identify the geometry.
+    return getattr(mesh.mesh, 'mesh', None) or mesh.mesh
+
+def get_mesh_sphere(mesh):
+    # Local (center, radius) of a Scene.Mesh, grown by its bounds_padding parameter.
+    # None if the mesh can't be culled.
+    bounding_sphere = getattr(mesh.mesh, 'bounding_sphere', None)
+    if bounding_sphere is None:
+        return None
+    center, radius = bounding_sphere
+    return center, radius + max(0.0, mesh.parameters.get('bounds_padding', 0.0))
+
+def get_world_spheres(matrices, center, radius):
+    # matrices : (count, 16) column-major model matrices
+    # center, radius : A single local sphere, or (count, 3) and (count) arrays with one sphere per matrix
+    # Returns the world space centers and radii, the radii are scaled by the largest axis scale of each matrix.
+    columns = matrices.reshape(-1, 4, 4)
+    center = np.asarray(center)
+    centers = (columns[:,3,:3] + center[...,0,None] * columns[:,0,:3] + center[...,1,None] * columns[:,1,:3]
+        + center[...,2,None] * columns[:,2,:3])
+    scales = np.sqrt(np.max(np.sum(columns[:,:3,:3] ** 2, axis=2), axis=1))
+    return centers, radius * scales
+
+def get_visible_spheres(planes, centers, radii):
+    distances = centers @ planes[:,:3].T + planes[:,3]
+    return np.all(distances >= -radii[:,None], axis=1)
+
+
+class FrustumCulling():
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        # {key : (batches, total, culled)}
+        self.cache = {}
+        self.used = set()
+        # Instance counts of all the culled passes since the last begin_frame
+        self.stat_total = 0
+        self.stat_culled = 0
+
+    def begin_frame(self):
+        self.stat_total = 0
+        self.stat_culled = 0
+
+    def end_frame(self):
+        # Drop the culled batches that haven't been drawn this frame
+        self.cache = {key: value for key, value in self.cache.items() if key in self.used}
+        self.used = set()
+
+    def get_key(self, scene_batches, planes, bvh):
+        # Reloaded meshes keep their batches, so the loaded mesh is part of the key
+        versions = tuple((material, tuple((get_mesh_data(mesh), tuple(batch['version'] for batches in scale_groups.values()
+            for batch in batches)) for mesh, scale_groups in meshes.items()))
+            for material, meshes in scene_batches.items())
+        return (versions, planes.tobytes(), bvh.version if bvh else None)
+
+    def get_bvh_indices(self, batch, bvh):
+        # Cached in the batch until the tree is rebuilt
+        cached = batch.get('bvh_indices')
+        if cached is None or cached[0] != bvh.build_version:
+            cached = (bvh.build_version, bvh.get_indices(batch['objects']))
+            batch['bvh_indices'] = cached
+        return cached[1]
+
+    def cull(self, scene_batches, camera, projection, clip_depth=True, bvh=None):
+        # Returns the scene batches with only the instances inside the frustum.
+        # The original batches are returned as is when every instance is visible.
+        planes = get_frustum_planes(camera, projection, clip_depth)
+        key = self.get_key(scene_batches, planes, bvh)
+        self.used.add(key)
+        cached = self.cache.get(key)
+        if cached is None:
+            bvh_visible = None
+            if bvh:
+                bvh_visible = np.zeros(len(bvh.objects), bool)
+                bvh_visible[bvh.query_frustum(planes)] = True
+            visible_objects = []
+            total = 0
+            for meshes in scene_batches.values():
+                for mesh, scale_groups in meshes.items():
+                    bounding_sphere = get_mesh_sphere(mesh)
+                    for batches in scale_groups.values():
+                        for batch in batches:
+                            total += batch['instances_count']
+                            objects = batch['objects']
+                            if bounding_sphere is None:
+                                visible_objects.extend(objects)
+                                continue
+                            indices = self.get_bvh_indices(batch, bvh) if bvh else None
+                            if indices is not None:
+                                visible = bvh_visible[indices]
+                            else:
+                                centers, radii = get_world_spheres(batch['matrices'], *bounding_sphere)
+                                visible = get_visible_spheres(planes, centers, radii)
+                            visible_objects.extend(objects[i] for i in np.flatnonzero(visible).tolist())
+            culled = total - len(visible_objects)
+            # Don't keep the original batches alive, they're returned as is
+            batches = None
+            if culled > 0:
+                batches = self.pipeline.build_scene_batches(visible_objects)
+            cached = (batches, total, culled)
+            self.cache[key] = cached
+        batches, total, culled = cached
+        self.stat_total += total
+        self.stat_culled += culled
+        return scene_batches if batches is None else batches
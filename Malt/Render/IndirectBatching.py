@@ -0,0 +1,537 @@
+import ctypes, weakref
+
+from Malt.GL.GL import *
+from Malt.GL.Shader import UBO
+
+# Alternative to the UBO based scene batches (See Pipeline.build_scene_batches and Pipeline.draw_scene_pass).
+# All the instance transforms and IDs live in a single persistently mapped shader storage buffer,
+# meshes are copied into shared vertex/index arenas (one per vertex and index format),
+# and each material is drawn with one glMultiDrawElementsIndirect per render state
+# (double sided, mirror scale, precomputed tangents and vertex color space).
+# Shaders opt in through the INDIRECT_BATCH uniform (See Common.glsl DEFAULT_VERTEX_SHADER).
+# The uniform and the instances SSBO are only declared when the pipeline compiles its shaders with SHADER_DEFINE,
+# so pipelines without indirect batching don't pay for them.
+
+SHADER_DEFINE = 'INDIRECT_BATCHING'
+
+INSTANCES_BINDING = 0
+INSTANCE_ATTRIBUTE_LOCATION = 11
+
+# Same limit as the UBO batches, so they can be built on demand for shaders that don't support indirect draws
+MAX_BATCH_SIZE = 1000
+
+class C_Instance(ctypes.Structure):
+    _fields_ = [
+        ('MODEL', ctypes.c_float*16),
+        ('ID', ctypes.c_uint32*4),
+    ]
+
+# C_Instance layout, used to fill the instances from NumPy arrays
+INSTANCE_DTYPE = [('MODEL', 'f4', 16), ('ID', 'u4', 4)]
+
+class C_DrawElementsIndirectCommand(ctypes.Structure):
+    _fields_ = [
+        ('count', ctypes.c_uint32),
+        ('instance_count', ctypes.c_uint32),
+        ('first_index', ctypes.c_uint32),
+        ('base_vertex', ctypes.c_int32),
+        ('base_instance', ctypes.c_uint32),
+    ]
+
+_TYPE_SIZES = {
+    GL_FLOAT : 4,
+    GL_HALF_FLOAT : 2,
+    GL_UNSIGNED_INT : 4,
+    GL_SHORT : 2,
+    GL_UNSIGNED_SHORT : 2,
+    GL_BYTE : 1,
+    GL_UNSIGNED_BYTE : 1,
+}
+
+def _element_size(size, gl_type):
+    if gl_type == GL_INT_2_10_10_10_REV:
+        return 4
+    return size * _TYPE_SIZES[gl_type]
+
+def _buffer_size(target, buffer):
+    size = gl_buffer(GL_INT, 1)
+    glBindBuffer(target, buffer)
+    glGetBufferParameteriv(target, GL_BUFFER_SIZE, size)
+    glBindBuffer(target, 0)
+    return size[0]
+
+def _copy_buffer(source, destination, source_offset, destination_offset, size):
+    if size <= 0:
+        return
+    glBindBuffer(GL_COPY_READ_BUFFER, source)
+    glBindBuffer(GL_COPY_WRITE_BUFFER, destination)
+    glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, source_offset, destination_offset, size)
+    glBindBuffer(GL_COPY_READ_BUFFER, 0)
+    glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+def _new_buffer(target, size, data=None, usage=GL_STATIC_DRAW):
+    buffer = gl_buffer(GL_INT, 1)
+    glGenBuffers(1, buffer)
+    glBindBuffer(target, buffer[0])
+    glBufferData(target, size, data, usage)
+    glBindBuffer(target, 0)
+    return buffer
+
+
+class InstanceBuffer():
+    # Persistently mapped SSBO of C_Instance, with a first-fit range allocator.
+    # Freed ranges are only reused once the GPU is done with the commands submitted before they were freed.
+
+    def __init__(self):
+        self.buffer = None
+        self.address = None
+        self.capacity = 0
+        # (start, count)
+        self.free_ranges = []
+        # (fence, start, count)
+        self.released = []
+        # Instance index per instance (0, 1, 2...), read through an instanced vertex attribute
+        self.index_buffer = None
+        self.generation = 0
+
+    def grow(self, capacity):
+        size = capacity * ctypes.sizeof(C_Instance)
+        flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+        buffer = gl_buffer(GL_INT, 1)
+        glGenBuffers(1, buffer)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffer[0])
+        glBufferStorage(GL_SHADER_STORAGE_BUFFER, size, None, flags)
+        address = glMapBufferRange(GL_SHADER_STORAGE_BUFFER, 0, size, flags)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+        if self.buffer:
+            _copy_buffer(self.buffer[0], buffer[0], 0, 0, self.capacity * ctypes.sizeof(C_Instance))
+            glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.buffer[0])
+            glUnmapBuffer(GL_SHADER_STORAGE_BUFFER)
+            glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+            glDeleteBuffers(1, self.buffer)
+
+        indices = (ctypes.c_uint32 * capacity)(*range(capacity))
+        if self.index_buffer:
+            glDeleteBuffers(1, self.index_buffer)
+        self.index_buffer = _new_buffer(GL_ARRAY_BUFFER, ctypes.sizeof(indices), indices)
+
+        self.free_ranges.append((self.capacity, capacity - self.capacity))
+        self.buffer = buffer
+        self.address = ctypes.cast(address, ctypes.c_void_p).value
+        self.capacity = capacity
+        self.generation += 1
+
+    def reclaim(self):
+        released = []
+        for fence, start, count in self.released:
+            if fence is None or glClientWaitSync(fence, 0, 0) in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+                if fence:
+                    glDeleteSync(fence)
+                self.free_ranges.append((start, count))
+            else:
+                released.append((fence, start, count))
+        self.released = released
+        self.free_ranges.sort()
+        merged = []
+        for start, count in self.free_ranges:
+            if merged and merged[-1][0] + merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], merged[-1][1] + count)
+            else:
+                merged.append((start, count))
+        self.free_ranges = merged
+
+    def allocate(self, count):
+        self.reclaim()
+        for i, (start, free_count) in enumerate(self.free_ranges):
+            if free_count >= count:
+                if free_count == count:
+                    self.free_ranges.pop(i)
+                else:
+                    self.free_ranges[i] = (start + count, free_count - count)
+                return start
+        self.grow(max(self.capacity * 2, self.capacity + count, 4096))
+        return self.allocate(count)
+
+    def free(self, start, count):
+        fence = None
+        try:
+            fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        except:
+            pass
+        self.released.append((fence, start, count))
+
+    def write(self, start, instances):
+        ctypes.memmove(self.address + start * ctypes.sizeof(C_Instance), instances.ctypes.data, instances.nbytes)
+
+    def bind(self):
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, INSTANCES_BINDING, self.buffer[0])
+
+
+class InstanceRange():
+
+    def __init__(self, buffer, instances):
+        self.buffer = buffer
+        # Kept in CPU memory, in case UBO batches are needed (See IndirectBatching.load_batch_UBOs)
+        self.instances = instances
+        self.count = len(instances)
+        self.start = buffer.allocate(self.count)
+        buffer.write(self.start, instances)
+
+    def __del__(self):
+        try:
+            self.buffer.free(self.start, self.count)
+        except:
+            pass
+
+
+class MeshArena():
+    # Vertex and index buffers shared by all the meshes with the same vertex and index format.
+    # Freed meshes leave holes, the arena is rebuilt from the live meshes once they take more space than them.
+
+    def __init__(self, vertex_format, index_type, instance_buffer):
+        self.vertex_format = vertex_format
+        self.element_sizes = [_element_size(size, gl_type) for location, size, gl_type, normalize in vertex_format]
+        self.index_type = index_type
+        self.index_size = _TYPE_SIZES[index_type]
+        self.instance_buffer = instance_buffer
+        self.instance_generation = None
+        self.VBOs = [None] * len(vertex_format)
+        self.EBO = None
+        self.VAO = None
+        self.vertex_capacity = 0
+        self.index_capacity = 0
+        self.vertex_count = 0
+        self.index_count = 0
+        self.live_vertices = 0
+        self.live_indices = 0
+        # id(mesh) : (weakref, first_index, base_vertex, index_count, vertices_key)
+        # Meshes are the loaded ones, not the Bridge proxys (See Malt.Render.Culling.get_mesh_data)
+        self.allocations = {}
+        # id(position VBO) : [base_vertex, vertex_count, refcount]
+        self.vertices = {}
+        self.generation = 0
+        self.needs_rebuild = False
+
+    def reset(self):
+        self.vertex_count = 0
+        self.index_count = 0
+        self.live_vertices = 0
+        self.live_indices = 0
+        self.allocations = {}
+        self.vertices = {}
+        self.generation += 1
+        self.needs_rebuild = False
+
+    def grow(self, vertex_capacity, index_capacity):
+        if vertex_capacity > self.vertex_capacity:
+            for i, element_size in enumerate(self.element_sizes):
+                VBO = _new_buffer(GL_ARRAY_BUFFER, vertex_capacity * element_size)
+                if self.VBOs[i]:
+                    _copy_buffer(self.VBOs[i][0], VBO[0], 0, 0, self.vertex_count * element_size)
+                    glDeleteBuffers(1, self.VBOs[i])
+                self.VBOs[i] = VBO
+            self.vertex_capacity = vertex_capacity
+        if index_capacity > self.index_capacity:
+            EBO = _new_buffer(GL_ELEMENT_ARRAY_BUFFER, index_capacity * self.index_size)
+            if self.EBO:
+                _copy_buffer(self.EBO[0], EBO[0], 0, 0, self.index_count * self.index_size)
+                glDeleteBuffers(1, self.EBO)
+            self.EBO = EBO
+            self.index_capacity = index_capacity
+        self.load_VAO()
+
+    def load_VAO(self):
+        if self.VAO:
+            glDeleteVertexArrays(1, self.VAO)
+        self.VAO = gl_buffer(GL_INT, 1)
+        glGenVertexArrays(1, self.VAO)
+        glBindVertexArray(self.VAO[0])
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.EBO[0])
+        for VBO, (location, size, gl_type, normalize) in zip(self.VBOs, self.vertex_format):
+            glBindBuffer(GL_ARRAY_BUFFER, VBO[0])
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, size, gl_type, normalize, 0, None)
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_buffer.index_buffer[0])
+        glEnableVertexAttribArray(INSTANCE_ATTRIBUTE_LOCATION)
+        glVertexAttribIPointer(INSTANCE_ATTRIBUTE_LOCATION, 1, GL_UNSIGNED_INT, 0, None)
+        glVertexAttribDivisor(INSTANCE_ATTRIBUTE_LOCATION, 1)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.instance_generation = self.instance_buffer.generation
+
+    def release(self, mesh_id):
+        allocation = self.allocations.pop(mesh_id, None)
+        if allocation is None:
+            return
+        self.live_indices -= allocation[3]
+        vertices = self.vertices[allocation[4]]
+        vertices[2] -= 1
+        if vertices[2] == 0:
+            self.vertices.pop(allocation[4])
+            self.live_vertices -= vertices[1]
+        if self.live_vertices * 2 < self.vertex_count and self.live_indices * 2 < self.index_count:
+            self.needs_rebuild = True
+
+    def get(self, mesh):
+        # Returns (first_index, base_vertex)
+        allocation = self.allocations.get(id(mesh))
+        if allocation:
+            return allocation[1], allocation[2]
+
+        positions = mesh.vertex_attributes[0][1]
+        vertices_key = id(positions)
+        vertices = self.vertices.get(vertices_key)
+        vertex_count = _buffer_size(GL_ARRAY_BUFFER, positions[0]) // self.element_sizes[0]
+        if vertices is None:
+            vertices = [self.vertex_count, vertex_count, 0]
+
+        needed_vertices = self.vertex_count + (vertex_count if vertices[2] == 0 else 0)
+        needed_indices = self.index_count + mesh.index_count
+        if needed_vertices > self.vertex_capacity or needed_indices > self.index_capacity:
+            self.grow(max(needed_vertices, self.vertex_capacity * 2, 1 << 16),
+                max(needed_indices, self.index_capacity * 2, 1 << 16))
+
+        if vertices[2] == 0:
+            for i, (location, VBO, size, gl_type, normalize) in enumerate(mesh.vertex_attributes):
+                element_size = self.element_sizes[i]
+                _copy_buffer(VBO[0], self.VBOs[i][0], 0, self.vertex_count * element_size, vertex_count * element_size)
+            self.vertices[vertices_key] = vertices
+            self.vertex_count += vertex_count
+            self.live_vertices += vertex_count
+        vertices[2] += 1
+
+        first_index = self.index_count
+        _copy_buffer(mesh.EBO[0], self.EBO[0], 0, first_index * self.index_size, mesh.index_count * self.index_size)
+        self.index_count += mesh.index_count
+        self.live_indices += mesh.index_count
+
+        arena = weakref.ref(self)
+        mesh_id = id(mesh)
+        def on_free(ref):
+            if arena():
+                arena().release(mesh_id)
+        self.allocations[mesh_id] = (weakref.ref(mesh, on_free), first_index, vertices[0], mesh.index_count, vertices_key)
+        return first_index, vertices[0]
+
+    def bind(self):
+        if self.instance_generation != self.instance_buffer.generation:
+            self.load_VAO()
+        glBindVertexArray(self.VAO[0])
+
+    def __del__(self):
+        try:
+            if self.VAO:
+                glDeleteVertexArrays(1, self.VAO)
+            for VBO in self.VBOs + [self.EBO]:
+                if VBO:
+                    glDeleteBuffers(1, VBO)
+        except:
+            pass
+
+
+class DrawGroup():
+
+    def __init__(self, arena, double_sided, color_is_srgb, precomputed_tangents, mirror_scale):
+        self.arena = arena
+        self.double_sided = double_sided
+        self.color_is_srgb = color_is_srgb
+        self.precomputed_tangents = precomputed_tangents
+        self.mirror_scale = mirror_scale
+        self.commands = []
+        self.offset = 0
+
+
+class DrawList():
+    # The indirect draw commands of a material, built once for each scene_batches[material] dictionary
+
+    def __init__(self, groups, commands):
+        self.groups = groups
+        self.commands = commands
+        self.generations = None
+        # The loaded mesh of each Scene.Mesh, so reloaded meshes get a new draw list
+        self.loaded_meshes = None
+        self.buffer = None
+        self.used = True
+        if len(commands) > 0:
+            self.buffer = _new_buffer(GL_DRAW_INDIRECT_BUFFER, ctypes.sizeof(commands), commands)
+
+    def __del__(self):
+        try:
+            if self.buffer:
+                glDeleteBuffers(1, self.buffer)
+        except:
+            pass
+
+
+class IndirectBatching():
+
+    def __init__(self):
+        self.instances = InstanceBuffer()
+        # (vertex_format, index_type) : MeshArena
+        self.arenas = {}
+        # id(meshes) : (meshes, DrawList)
+        self.draw_lists = {}
+
+    def get_arena(self, mesh):
+        vertex_format = tuple((location, size, gl_type, normalize)
+            for location, VBO, size, gl_type, normalize in mesh.vertex_attributes)
+        key = (vertex_format, mesh.index_type)
+        arena = self.arenas.get(key)
+        if arena is None:
+            arena = MeshArena(vertex_format, mesh.index_type, self.instances)
+            self.arenas[key] = arena
+        return arena
+
+    def build_scene_batches(self, objects):
+        # Same layout as Pipeline.build_scene_batches
+        import numpy as np
+        from Malt.Pipeline import group_scene_objects, BATCH_VERSIONS
+
+        if len(objects) == 0:
+            return {}
+
+        groups, objects, matrices, ids, batch_index, batch_offset, batch_counts, batch_groups = group_scene_objects(objects, MAX_BATCH_SIZE)
+
+        # The objects are already sorted by batch, so they're uploaded as a single range shared by all the batches
+        instances = np.zeros(len(objects), INSTANCE_DTYPE)
+        instances['MODEL'] = matrices
+        instances['ID'][:,0] = ids
+        instance_range = InstanceRange(self.instances, instances)
+
+        result = {}
+        group_batches = []
+        for material, mesh, scale_group in groups:
+            if material not in result:
+                result[material] = {}
+            if mesh not in result[material]:
+                result[material][mesh] = {}
+            batches = []
+            result[material][mesh][scale_group] = batches
+            group_batches.append(batches)
+        
+        first_instance = 0
+        for group, count in zip(batch_groups.tolist(), batch_counts.tolist()):
+            group_batches[group].append({
+                'version': next(BATCH_VERSIONS),
+                'instances_count': count,
+                'objects': objects[first_instance:first_instance+count],
+                'matrices': matrices[first_instance:first_instance+count],
+                'INDIRECT_INSTANCES': instance_range,
+                'first_instance': first_instance,
+            })
+            first_instance += count
+
+        return result
+
+    def load_batch_UBOs(self, batch):
+        first = batch['first_instance']
+        instances = batch['INDIRECT_INSTANCES'].instances[first:first+batch['instances_count']]
+        count = len(instances)
+        models = ((ctypes.c_float * 16) * count)()
+        # IDs are stored as uvec4, see Pipeline.build_scene_batches
+        ids = (ctypes.c_uint * (((count + 3) // 4) * 4))()
+        ctypes.memmove(models, instances['MODEL'].tobytes(), ctypes.sizeof(models))
+        ctypes.memmove(ids, instances['ID'][:,0].tobytes(), count * 4)
+        batch['BATCH_MODELS'] = UBO()
+        batch['BATCH_IDS'] = UBO()
+        batch['BATCH_MODELS'].load_data(models)
+        batch['BATCH_IDS'].load_data(ids)
+
+    def can_draw(self, shader):
+        return 'INDIRECT_BATCH' in shader.uniforms
+
+    def get_generations(self):
+        return tuple(arena.generation for arena in self.arenas.values())
+
+    def get_loaded_meshes(self, meshes):
+        from Malt.Render.Culling import get_mesh_data
+        return tuple(get_mesh_data(mesh) for mesh in meshes.keys())
+
+    def build_draw_list(self, meshes):
+        for arena in self.arenas.values():
+            if arena.needs_rebuild:
+                arena.reset()
+        from Malt.Render.Culling import get_mesh_data
+        groups = {}
+        for mesh, scale_groups in meshes.items():
+            mesh_data = mesh.mesh
+            if len(getattr(mesh_data, 'vertex_attributes', [])) == 0 or mesh_data.index_count == 0:
+                continue
+            arena = self.get_arena(mesh_data)
+            # The proxy is kept when its mesh is reloaded, so allocate the loaded mesh
+            first_index, base_vertex = arena.get(get_mesh_data(mesh))
+            for scale_group, batches in scale_groups.items():
+                key = (arena, mesh.parameters['double_sided'], tuple(mesh_data.color_is_srgb),
+                    mesh.parameters['precomputed_tangents'], scale_group == 'mirror_scale')
+                if key not in groups:
+                    groups[key] = DrawGroup(*key)
+                for batch in batches:
+                    instances = batch['INDIRECT_INSTANCES']
+                    groups[key].commands.append((mesh_data.index_count, batch['instances_count'], first_index, base_vertex,
+                        instances.start + batch['first_instance']))
+
+        command_count = sum(len(group.commands) for group in groups.values())
+        commands = (C_DrawElementsIndirectCommand * command_count)()
+        i = 0
+        for group in groups.values():
+            group.offset = i * ctypes.sizeof(C_DrawElementsIndirectCommand)
+            for command in group.commands:
+                commands[i] = C_DrawElementsIndirectCommand(*command)
+                i += 1
+        draw_list = DrawList(list(groups.values()), commands)
+        draw_list.generations = self.get_generations()
+        draw_list.loaded_meshes = self.get_loaded_meshes(meshes)
+        return draw_list
+
+    def get_draw_list(self, meshes):
+        cached = self.draw_lists.get(id(meshes))
+        if (cached and cached[1].generations == self.get_generations() and
+            cached[1].loaded_meshes == self.get_loaded_meshes(meshes)):
+            draw_list = cached[1]
+        else:
+            draw_list = self.build_draw_list(meshes)
+            # The meshes dictionary is kept alive, so its id stays valid
+            self.draw_lists[id(meshes)] = (meshes, draw_list)
+        draw_list.used = True
+        return draw_list
+
+    def draw(self, shader, meshes):
+        draw_list = self.get_draw_list(meshes)
+        if draw_list.buffer is None:
+            return
+
+        self.instances.bind()
+        shader.uniforms['INDIRECT_BATCH'].bind(True)
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, draw_list.buffer[0])
+
+        precomputed_tangents_uniform = shader.uniforms.get('PRECOMPUTED_TANGENTS')
+        mirror_scale_uniform = shader.uniforms.get('MIRROR_SCALE')
+        color_is_srgb_uniform = shader.uniforms.get('COLOR_IS_SRGB')
+
+        for group in draw_list.groups:
+            group.arena.bind()
+            if group.double_sided:
+                glDisable(GL_CULL_FACE)
+            else:
+                glEnable(GL_CULL_FACE)
+                glCullFace(GL_BACK)
+            glFrontFace(GL_CW if group.mirror_scale else GL_CCW)
+            if mirror_scale_uniform:
+                mirror_scale_uniform.bind(group.mirror_scale)
+            if precomputed_tangents_uniform:
+                precomputed_tangents_uniform.bind(group.precomputed_tangents)
+            if color_is_srgb_uniform:
+                color_is_srgb_uniform.bind(group.color_is_srgb)
+            glMultiDrawElementsIndirect(GL_TRIANGLES, group.arena.index_type, ctypes.c_void_p(group.offset), len(group.commands), 0)
+
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, 0)
+        shader.uniforms['INDIRECT_BATCH'].bind(False)
+
+    def end_frame(self):
+        # Drop the draw lists of the scene batches that haven't been drawn this frame
+        for key, (meshes, draw_list) in list(self.draw_lists.items()):
+            if draw_list.used:
+                draw_list.used = False
+            else:
+                self.draw_lists.pop(key)
@@ -1,6 +1,7 @@
 import math
 import ctypes
 
+import numpy as np
 import pyrr
 
 from Malt.GL.GL import *
@@ -83,8 +84,10 @@ class ShadowMaps():
         self.point_fbos = []
 
         self.initialized = False
+        # Incremented each time the textures are reallocated
+        self.setup_version = 0
 
-    def load(self, scene, spot_resolution, sun_resolution, point_resolution, sun_cascades):
+    def load(self, scene, spot_resolution, sun_resolution, point_resolution, sun_cascades, clear=True):
         needs_setup = self.initialized is False
         self.initialized = True
         
@@ -115,9 +118,11 @@ class ShadowMaps():
         if needs_setup:
             self.setup()
         
-        self.clear(spot_count, sun_count, point_count)
+        if clear:
+            self.clear(spot_count, sun_count, point_count)
     
     def setup(self, create_fbos=True):
+        self.setup_version += 1
         self.spot_depth_t = TextureArray((self.spot_resolution, self.spot_resolution), self.max_spots, GL_DEPTH_COMPONENT32F)
         self.sun_depth_t = TextureArray((self.sun_resolution, self.sun_resolution), self.max_suns, GL_DEPTH_COMPONENT32F)
         self.point_depth_t = CubeMapArray((self.point_resolution, self.point_resolution), self.max_points, GL_DEPTH_COMPONENT32F)
@@ -137,11 +142,14 @@ class ShadowMaps():
         
     def clear(self, spot_count, sun_count, point_count):
         for i in range(spot_count):
-            self.spot_fbos[i].clear(depth=1)
+            self.clear_fbo(self.spot_fbos[i])
         for i in range(sun_count):
-            self.sun_fbos[i].clear(depth=1)
+            self.clear_fbo(self.sun_fbos[i])
         for i in range(point_count*6):
-            self.point_fbos[i].clear(depth=1)
+            self.clear_fbo(self.point_fbos[i])
+    
+    def clear_fbo(self, fbo):
+        fbo.clear(depth=1)
     
     def shader_callback(self, shader):
         shader.textures['SHADOWMAPS_DEPTH_SPOT'] = self.spot_depth_t
@@ -150,6 +158,10 @@ class ShadowMaps():
 
 
 class LightsBuffer():
+    # The shadow map matrices (spots, suns, points) don't include the sample offset, so the shadow maps
+    # can be reused across samples. The offset is applied to the lookup matrices in the UBO instead.
+    # Everything else is computed for all the lights at once and cached until the lights, the camera or the settings change,
+    # so each new sample only updates the lookup matrices.
     
     def __init__(self):
         self.data = C_LightsBuffer()
@@ -157,6 +169,7 @@ class LightsBuffer():
         self.spots = None
         self.suns = None
         self.points = None
+        self.key = None
     
     def load(
         self, scene, spot_resolution, sun_resolution, point_resolution,
@@ -164,94 +177,109 @@ class LightsBuffer():
     ):
         #TODO: Automatic distribution exponent basedd on FOV
 
-        spot_count=0
-        sun_count=0
-        point_count=0
-
+        # Lights are compared by identity, updated lights are always new objects (See Bridge.SceneSync)
+        key = (tuple(scene.lights), tuple(scene.camera.camera_matrix), tuple(scene.camera.projection_matrix),
+            spot_resolution, sun_resolution, point_resolution,
+            cascades_count, cascades_distribution_scalar, cascades_max_distance)
+        if key != self.key:
+            self.key = key
+            self.setup(scene, spot_resolution, sun_resolution, point_resolution,
+                cascades_count, cascades_distribution_scalar, cascades_max_distance)
+        
+        spot_matrices = np.ctypeslib.as_array(self.data.spot_matrices)
+        sun_matrices = np.ctypeslib.as_array(self.data.sun_matrices)
+        point_matrices = np.ctypeslib.as_array(self.data.point_matrices)
+
+        # Same as baking the offset into the spot projection matrices (See Common.bake_sample_offset)
+        offset = np.array(sample_offset, np.float64) / spot_resolution
+        spot_lookup = self.spot_lookup.copy()
+        spot_lookup[:,:2,:] += offset[None,:,None] * self.spot_views[:,None,2,:]
+        spot_matrices[:len(spot_lookup)] = to_flat(spot_lookup)
+
+        offset = np.array(sample_offset, np.float64) / sun_resolution
+        sun_lookup = self.sun_lookup.copy()
+        sun_lookup[:,:2,:] += offset[None,:,None] * self.sun_views[:,None,3,:]
+        sun_matrices[:len(sun_lookup)] = to_flat(sun_lookup)
+
+        if len(self.point_positions) > 0:
+            # The lookup offset is a rotation of the same scale as the spot and sun ones (a fraction of a texel)
+            texel_angle = (math.pi / 2.0) / point_resolution
+            rotation = np.array(pyrr.Matrix44.from_eulers((sample_offset[0] * texel_angle, sample_offset[1] * texel_angle, 0.0))).T
+            # inverse(translation(position) * rotation)
+            point_lookup = np.zeros((len(self.point_positions), 4, 4))
+            point_lookup[:,:3,:3] = rotation[:3,:3].T
+            point_lookup[:,:3,3] = -self.point_positions @ rotation[:3,:3]
+            point_lookup[:,3,3] = 1
+            point_matrices[:len(point_lookup)] = to_flat(point_lookup)
+        
+        self.UBO.load_data(self.data)
+    
+    def setup(self, scene, spot_resolution, sun_resolution, point_resolution,
+        cascades_count, cascades_distribution_scalar, cascades_max_distance):
         from collections import OrderedDict
 
+        lights = scene.lights
+        count = len(lights)
+        types = np.array([light.type for light in lights], np.int32)
+        is_spot = types == LIGHT_SPOT
+        is_sun = types == LIGHT_SUN
+        is_point = types == LIGHT_POINT
+        spots = [light for light in lights if light.type == LIGHT_SPOT]
+        suns = [light for light in lights if light.type == LIGHT_SUN]
+        points = [light for light in lights if light.type == LIGHT_POINT]
+
+        data = np.ctypeslib.as_array(self.data.lights)[:count]
+        data['color'] = [light.color for light in lights] if count else np.zeros((0,3))
+        data['type'] = types
+        data['position'] = [light.position for light in lights] if count else np.zeros((0,3))
+        data['radius'] = [light.radius for light in lights]
+        data['direction'] = [light.direction for light in lights] if count else np.zeros((0,3))
+        data['spot_angle'] = [light.spot_angle for light in lights]
+        data['spot_blend'] = [light.spot_blend for light in lights]
+        type_index = np.zeros(count, np.int32)
+        for mask in (is_spot, is_sun, is_point):
+            type_index[mask] = np.arange(np.count_nonzero(mask))
+        data['type_index'] = type_index
+        self.data.lights_count = count
+        self.data.cascades_count = cascades_count
+
+        #SPOTS
+        self.spot_views = to_matrices([light.matrix for light in spots])
+        spot_projections = make_projection_matrices([light.spot_angle for light in spots], 1, 0.01,
+            [light.radius for light in spots])
+        self.spot_lookup = spot_projections @ self.spot_views
         self.spots = OrderedDict()
+        for light, projection in zip(spots, to_flat(spot_projections).tolist()):
+            self.spots[light] = [(light.matrix, tuple(projection))]
+        
+        #SUNS
+        max_distances = np.array([light.sun_max_distance if light.sun_max_distance != 0 else cascades_max_distance
+            for light in suns], np.float64)
+        views, screens = get_sun_cascades(to_matrices([light.matrix for light in suns]), scene.camera.projection_matrix,
+            scene.camera.camera_matrix, cascades_count, cascades_distribution_scalar, max_distances)
+        self.sun_views = views.reshape(-1, 4, 4)
+        self.sun_lookup = screens.reshape(-1, 4, 4) @ self.sun_views
         self.suns = OrderedDict()
-        self.points = OrderedDict()
-
-        for i, light in enumerate(scene.lights):
-            self.data.lights[i].color = light.color
-            self.data.lights[i].type = light.type
-            self.data.lights[i].position = light.position
-            self.data.lights[i].radius = light.radius
-            self.data.lights[i].direction = light.direction
-            self.data.lights[i].spot_angle = light.spot_angle
-            self.data.lights[i].spot_blend = light.spot_blend
-
-            if light.type == LIGHT_SPOT:
-                self.data.lights[i].type_index = spot_count
-
-                projection_matrix = make_projection_matrix(light.spot_angle,1,0.01,light.radius,
-                    sample_offset,(spot_resolution, spot_resolution))
-                spot_matrix = projection_matrix * pyrr.Matrix44(light.matrix)
-                
-                self.data.spot_matrices[spot_count] = flatten_matrix(spot_matrix)
-
-                self.spots[light] = [(light.matrix, flatten_matrix(projection_matrix))]
-
-                spot_count+=1
-            
-            if light.type == LIGHT_SUN:
-                self.data.lights[i].type_index = sun_count
-
-                sun_matrix = pyrr.Matrix44(light.matrix)
-                projection_matrix = [*scene.camera.projection_matrix]
-                projection_matrix = pyrr.Matrix44(projection_matrix)
-                view_matrix = projection_matrix * pyrr.Matrix44(scene.camera.camera_matrix)
-
-                max_distance = cascades_max_distance
-                if light.sun_max_distance != 0:
-                    max_distance = light.sun_max_distance
-                
-                cascades_matrices = get_sun_cascades(sun_matrix, projection_matrix, view_matrix, cascades_count, cascades_distribution_scalar, max_distance, sample_offset, sun_resolution)
-
-                self.suns[light] = []
-                for i, cascade in enumerate(cascades_matrices):
-                    matrix = pyrr.Matrix44(cascade[1])*pyrr.Matrix44(cascade[0])
-                    self.data.sun_matrices[sun_count * cascades_count + i] = flatten_matrix(matrix)
-                    self.suns[light].append(cascade)
-
-                sun_count+=1
-            
-            if light.type == LIGHT_POINT:
-                self.data.lights[i].type_index = point_count
-
-                cube_map_axes = [
-                    (( 1, 0, 0),( 0,-1, 0)),
-                    ((-1, 0, 0),( 0,-1, 0)),
-                    (( 0, 1, 0),( 0, 0, 1)),
-                    (( 0,-1, 0),( 0, 0,-1)),
-                    (( 0, 0, 1),( 0,-1, 0)),
-                    (( 0, 0,-1),( 0,-1, 0))
-                ]
-                matrices = []
-                position = pyrr.Vector3(light.position)
-                offset_matrix = pyrr.Matrix44.from_translation(position)
-                rotation_matrix = pyrr.Matrix44.from_eulers((sample_offset[0], sample_offset[1], 0.0))
-                for axes in cube_map_axes:
-                    front = pyrr.Matrix33.from_matrix44(rotation_matrix) * pyrr.Vector3(axes[0])
-                    up = pyrr.Matrix33.from_matrix44(rotation_matrix) * pyrr.Vector3(axes[1])
-                    matrices.append(pyrr.Matrix44.look_at(position, position + front, up))
-                self.data.point_matrices[point_count] = flatten_matrix((offset_matrix * rotation_matrix).inverse)
-
-                projection_matrix = make_projection_matrix(math.pi / 2.0, 1.0, 0.01, light.radius, 
-                    (0,0), (point_resolution, point_resolution))
-
-                self.points[light] = []
-                for i in range(6):
-                    self.points[light].append((flatten_matrix(matrices[i]), flatten_matrix(projection_matrix)))
-                
-                point_count+=1
-            
-        self.data.lights_count = len(scene.lights)
-        self.data.cascades_count = cascades_count
+        views = to_flat(self.sun_views).tolist()
+        screens = to_flat(screens.reshape(-1, 4, 4)).tolist()
+        for i, light in enumerate(suns):
+            cascades = range(i * cascades_count, (i + 1) * cascades_count)
+            self.suns[light] = [(tuple(views[c]), tuple(screens[c])) for c in cascades]
         
-        self.UBO.load_data(self.data)
+        #POINTS
+        self.point_positions = np.array([light.position for light in points], np.float64).reshape(-1, 3)
+        point_projections = to_flat(make_projection_matrices(math.pi / 2.0, 1.0, 0.01,
+            [light.radius for light in points])).tolist()
+        # (points, faces, 4, 4) look at matrices
+        face_rotations = get_cube_map_rotations()
+        point_views = np.zeros((len(points), 6, 4, 4))
+        point_views[:,:,:3,:3] = face_rotations[None,:,:3,:3]
+        point_views[:,:,:3,3] = -np.einsum('fij,pj->pfi', face_rotations[:,:3,:3], self.point_positions)
+        point_views[:,:,3,3] = 1
+        point_views = to_flat(point_views.reshape(-1, 4, 4)).tolist()
+        self.points = OrderedDict()
+        for i, light in enumerate(points):
+            self.points[light] = [(tuple(point_views[i * 6 + face]), tuple(point_projections[i])) for face in range(6)]
     
     def bind(self, block):
         self.UBO.bind(block)
@@ -279,94 +307,109 @@ def make_projection_matrix(fov, aspect_ratio, near, far, sample_offset, resoluti
     return pyrr.Matrix44(matrix)
 
 
-def get_sun_cascades(sun_from_world_matrix, projection_matrix, view_from_world_matrix, cascades_count, cascades_distribution_scalar, cascades_max_distance, sample_offset, resolution):
-    cascades = []
-    splits = []
-
-    n,f = 0,0    
-    if projection_matrix[3][3] == 1.0:
+def to_matrices(flat_matrices):
+    # Column-major flat matrices to a (count, 4, 4) array
+    return np.array(flat_matrices, np.float64).reshape(-1, 4, 4).transpose(0, 2, 1)
+
+
+def to_flat(matrices):
+    # (count, 4, 4) array to (count, 16) column-major flat matrices
+    return np.ascontiguousarray(matrices.transpose(0, 2, 1)).reshape(-1, 16)
+
+
+def make_projection_matrices(fov, aspect_ratio, near, far):
+    # Same as make_projection_matrix, for arrays of fov and far values, without sample offset
+    fov, far = np.broadcast_arrays(np.array(fov, np.float64), np.array(far, np.float64))
+    fov = fov.reshape(-1)
+    far = far.reshape(-1)
+    x_scale = 1.0 / np.tan(fov / 2.0)
+    matrices = np.zeros((len(fov), 4, 4))
+    matrices[:,0,0] = x_scale
+    matrices[:,1,1] = x_scale * aspect_ratio
+    matrices[:,2,2] = (-(far + near)) / (far - near)
+    matrices[:,2,3] = (-2.0 * far * near) / (far - near)
+    matrices[:,3,2] = -1
+    return matrices
+
+
+_CUBE_MAP_ROTATIONS = None
+
+def get_cube_map_rotations():
+    # (6, 4, 4) look at matrices of each cube map face, from the origin
+    global _CUBE_MAP_ROTATIONS
+    if _CUBE_MAP_ROTATIONS is None:
+        cube_map_axes = [
+            (( 1, 0, 0),( 0,-1, 0)),
+            ((-1, 0, 0),( 0,-1, 0)),
+            (( 0, 1, 0),( 0, 0, 1)),
+            (( 0,-1, 0),( 0, 0,-1)),
+            (( 0, 0, 1),( 0,-1, 0)),
+            (( 0, 0,-1),( 0,-1, 0))
+        ]
+        origin = pyrr.Vector3((0, 0, 0))
+        _CUBE_MAP_ROTATIONS = np.array([np.array(pyrr.Matrix44.look_at(origin, pyrr.Vector3(front), pyrr.Vector3(up))).T 
+            for front, up in cube_map_axes])
+    return _CUBE_MAP_ROTATIONS
+
+
+def get_sun_cascades(sun_from_world_matrices, projection_matrix, camera_matrix, cascades_count, cascades_distribution_scalar, max_distances):
+    # sun_from_world_matrices : (suns, 4, 4)
+    # projection_matrix, camera_matrix : Column-major flat camera matrices
+    # max_distances : (suns) max shadow distance of each sun
+    # Returns the (suns, cascades, 4, 4) view and screen matrices of each cascade
+    suns = len(sun_from_world_matrices)
+    projection = to_matrices(projection_matrix)[0]
+    view_from_world = projection @ to_matrices(camera_matrix)[0]
+
+    if projection[3][3] == 1.0:
         # ortho
-        n = cascades_max_distance / 2
-        f = -cascades_max_distance / 2
+        n = max_distances / 2
+        f = -max_distances / 2
     else:
         # perspective
-        clip_start = projection_matrix.inverse * pyrr.Vector4([0,0,-1,1])
-        clip_start /= clip_start.w
-        n = clip_start.z
-        f = -cascades_max_distance
-
-    def lerp(a,b,f):
-        f = max(0,min(f,1))
-        return a * (1.0 - f) + b * f
-
-    for i in range(cascades_count+1):
-        split_log = n * pow(f/n, i/cascades_count)
-        split_uniform = n + (f-n) * (i/cascades_count)
-        split = lerp(split_uniform, split_log, cascades_distribution_scalar)
-
-        projected = projection_matrix * pyrr.Vector4([0,0,split,1])
-        projected = (projected / projected.w) * (1.0 if projected.w >= 0 else -1.0)
-        splits.append(projected.z)
-        
-    for i in range(1, len(splits)):
-        near = splits[i-1]
-        far = splits[i]
-        cascades.append(sun_shadowmap_matrix(sun_from_world_matrix, view_from_world_matrix, near, far, sample_offset, resolution))
-    
-    return cascades
-
-
-def frustum_corners(view_from_world_matrix, near, far):
-    m = view_from_world_matrix.inverse
-    corners = []
-
-    for x in (-1, 1):
-        for y in (-1, 1):
-            for z in (near, far):
-                v = pyrr.Vector4([x, y, z, 1])
-                v = m * v
-                v /= v.w
-                corners.append(v)
-    
-    return corners
-
-
-def sun_shadowmap_matrix(sun_from_world_matrix, view_from_world_matrix, near, far, sample_offset, resolution):
-    INFINITY = float('inf')
-    aabb = {
-        'min': pyrr.Vector3([ INFINITY,  INFINITY,  INFINITY]),
-        'max': pyrr.Vector3([-INFINITY, -INFINITY, -INFINITY])
-    }
-    
-    for corner in frustum_corners(view_from_world_matrix, near, far):
-        corner = sun_from_world_matrix * corner
-        aabb['min'].x = min(aabb['min'].x, corner.x)
-        aabb['min'].y = min(aabb['min'].y, corner.y)
-        aabb['min'].z = min(aabb['min'].z, corner.z)
-        aabb['max'].x = max(aabb['max'].x, corner.x)
-        aabb['max'].y = max(aabb['max'].y, corner.y)
-        aabb['max'].z = max(aabb['max'].z, corner.z)
-
-    world_from_light_space = sun_from_world_matrix.inverse
-
-    size = aabb['max'] - aabb['min']
-    aabb['min'] = world_from_light_space * pyrr.Vector4([*aabb['min'].tolist(), 1.0])
-    aabb['max'] = world_from_light_space * pyrr.Vector4([*aabb['max'].tolist(), 1.0])
-    center = (aabb['min'] + aabb['max']) / 2.0
-    center = pyrr.Vector3(center.tolist()[:3])
-
-    translate = pyrr.Matrix44.from_translation(center)
-    matrix = translate * world_from_light_space
-
-    o_x = sample_offset[0]/resolution
-    o_y = sample_offset[1]/resolution
+        clip_start = np.linalg.inv(projection) @ np.array([0,0,-1,1])
+        n = np.full(suns, clip_start[2] / clip_start[3])
+        f = -max_distances
+
+    t = np.arange(cascades_count + 1) / cascades_count
+    split_uniform = n[:,None] + (f - n)[:,None] * t
+    # For orthographic cameras the near and far distances have different signs, only the real part is used
+    split_log = (n[:,None] * np.power((f / n)[:,None].astype(np.complex128), t)).real
+    factor = max(0, min(cascades_distribution_scalar, 1))
+    split = split_uniform * (1.0 - factor) + split_log * factor
+
+    projected_z = projection[2,2] * split + projection[2,3]
+    projected_w = projection[3,2] * split + projection[3,3]
+    splits = (projected_z / projected_w) * np.where(projected_w >= 0, 1.0, -1.0)
+
+    # Frustum corners of each cascade, in world space
+    corners = np.ones((suns, cascades_count, 8, 4))
+    corners[:,:,:,0] = np.repeat((-1, 1), 4)
+    corners[:,:,:,1] = np.tile(np.repeat((-1, 1), 2), 2)
+    corners[:,:,0::2,2] = splits[:,:-1,None]
+    corners[:,:,1::2,2] = splits[:,1:,None]
+    corners = corners @ np.linalg.inv(view_from_world).T
+    corners /= corners[...,3:]
+
+    corners = np.einsum('sij,sckj->scki', sun_from_world_matrices, corners)[...,:3]
+    aabb_min = corners.min(axis=2)
+    aabb_max = corners.max(axis=2)
+    size = aabb_max - aabb_min
+    center = np.ones((suns, cascades_count, 4))
+    center[...,:3] = (aabb_min + aabb_max) / 2.0
+    center = np.einsum('sij,scj->sci', np.linalg.inv(sun_from_world_matrices), center)[...,:3]
+
+    # inverse(translation(center) * world_from_sun)
+    translation = np.zeros((suns, cascades_count, 4, 4))
+    translation[...] = np.identity(4)
+    translation[...,:3,3] = -center
+    views = sun_from_world_matrices[:,None] @ translation
 
     scale = 1.0 / (size / 2.0)
-    screen = [
-        scale[0], 0, 0, 0,
-        0, scale[1], 0, 0,
-        0, 0,-scale[2], 0,
-        o_x, o_y, 0, 1
-    ]
+    screens = np.zeros((suns, cascades_count, 4, 4))
+    screens[...,0,0] = scale[...,0]
+    screens[...,1,1] = scale[...,1]
+    screens[...,2,2] = -scale[...,2]
+    screens[...,3,3] = 1
 
-    return flatten_matrix(matrix.inverse), screen
+    return views, screens
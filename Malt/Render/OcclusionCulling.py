@@ -0,0 +1,134 @@
+from Malt.GL.GL import *
+from Malt.GL.Texture import Texture
+from Malt.GL.RenderTarget import RenderTarget, MipLevelTarget
+from Malt.Render.Culling import get_mesh_sphere
+
+_REDUCE_SHADER_SRC='''
+#define HIZ_REDUCE
+#include "Passes/HiZ.glsl"
+'''
+
+_TEST_SHADER_SRC='''
+#define HIZ_TEST
+#include "Passes/HiZ.glsl"
+'''
+
+_REDUCE_SHADER = None
+_TEST_SHADER = None
+
+def get_shaders(pipeline):
+    global _REDUCE_SHADER, _TEST_SHADER
+    if _REDUCE_SHADER is None: _REDUCE_SHADER = pipeline.compile_shader_from_source(_REDUCE_SHADER_SRC)
+    if _TEST_SHADER is None: _TEST_SHADER = pipeline.compile_shader_from_source(_TEST_SHADER_SRC)
+    return _REDUCE_SHADER, _TEST_SHADER
+
+
+class HiZ():
+    # Max depth mip chain of a depth buffer.
+    # The base level is the largest power of two that fits in the depth buffer resolution.
+
+    def __init__(self):
+        self.resolution = None
+        self.texture = None
+
+    def setup_render_targets(self, resolution):
+        self.resolution = resolution
+        base = tuple(1 << (max(1, e).bit_length() - 1) for e in resolution)
+        self.levels = max(base).bit_length()
+        self.texture = Texture(base, GL_R32F, min_filter=GL_NEAREST_MIPMAP_NEAREST, mag_filter=GL_NEAREST,
+            build_mipmaps=True)
+        self.fbos = [RenderTarget([MipLevelTarget(self.texture, level)]) for level in range(self.levels)]
+
+    def build(self, pipeline, depth_texture):
+        if self.resolution != depth_texture.resolution:
+            self.setup_render_targets(depth_texture.resolution)
+        reduce_shader, test_shader = get_shaders(pipeline)
+        glDisable(GL_DEPTH_TEST)
+        for level, fbo in enumerate(self.fbos):
+            if level == 0:
+                reduce_shader.textures['source_texture'] = depth_texture
+            else:
+                # Only the previous level is visible to the shader, so reading and writing the same texture is safe
+                self.texture.bind()
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_BASE_LEVEL, level - 1)
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, level - 1)
+                reduce_shader.textures['source_texture'] = self.texture
+            reduce_shader.uniforms['target_resolution'].set_value(fbo.resolution)
+            pipeline.draw_screen_pass(reduce_shader, fbo)
+        self.texture.bind()
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_BASE_LEVEL, 0)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, self.levels - 1)
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+
+class OcclusionCulling():
+    # Tests the instances of each batch against a Hi-Z buffer.
+    # Each batch gets a GL_SAMPLES_PASSED query with its visible instance count,
+    # so later passes can skip the hidden batches with conditional rendering (See Pipeline.draw_scene_pass).
+    # The query results are only read back once available, to report the statistics without stalling.
+
+    def __init__(self, pipeline, name):
+        self.pipeline = pipeline
+        self.name = name
+        self.queries = []
+        # [(query, instances_count)] of the last test
+        self.pending = []
+        self.fbo = None
+
+    def poll_stats(self):
+        if len(self.pending) == 0:
+            return
+        # Queries complete in order
+        if self.pending[-1][0].get_result() is None:
+            return
+        visible = sum(query.get_result(wait=True) for query, count in self.pending)
+        total = sum(count for query, count in self.pending)
+        self.pipeline.occlusion_stats[self.name] = (visible, total)
+        self.pending = []
+
+    def test(self, scene_batches, hiz, shader_resources):
+        # Returns the {id(batch) : DrawQuery} dictionary for draw_scene_pass.
+        # Shader resources should have the same COMMON_UNIFORMS as the pass that filled the Hi-Z depth buffer.
+        self.poll_stats()
+        self.pending = []
+        reduce_shader, test_shader = get_shaders(self.pipeline)
+
+        if self.fbo is None:
+            self.fbo = RenderTarget([Texture((1,1), GL_R8)])
+        self.fbo.bind()
+        glDisable(GL_DEPTH_TEST)
+        glDepthMask(GL_FALSE)
+        glDisable(GL_BLEND)
+
+        for resource in shader_resources.values():
+            resource.shader_callback(test_shader)
+        test_shader.textures['hiz_texture'] = hiz.texture
+        test_shader.uniforms['hiz_levels'].set_value(hiz.levels)
+        test_shader.bind()
+        self.pipeline.quad.bind()
+
+        queries = {}
+        for meshes in scene_batches.values():
+            for mesh, scale_groups in meshes.items():
+                bounding_sphere = get_mesh_sphere(mesh)
+                if bounding_sphere is None:
+                    continue
+                center, radius = bounding_sphere
+                test_shader.uniforms['bounding_sphere'].set_value((*center, radius))
+                test_shader.uniforms['bounding_sphere'].bind()
+                for batches in scale_groups.values():
+                    for batch in batches:
+                        if 'BATCH_MODELS' not in batch:
+                            self.pipeline.indirect_batching.load_batch_UBOs(batch)
+                        batch['BATCH_MODELS'].bind(test_shader.uniform_blocks['BATCH_MODELS'])
+                        if len(self.pending) == len(self.queries):
+                            self.queries.append(DrawQuery(GL_SAMPLES_PASSED))
+                        query = self.queries[len(self.pending)]
+                        query.begin_query()
+                        glDrawArraysInstanced(GL_POINTS, 0, 1, batch['instances_count'])
+                        query.end_query()
+                        self.pending.append((query, batch['instances_count']))
+                        queries[id(batch)] = query
+
+        glDepthMask(GL_TRUE)
+        return queries
@@ -62,3 +62,172 @@ def get_random_samples(grid_size, width=1.0):
         samples = [(0,0)]
     
     return samples
+
+
+# Low discrepancy and blue noise patterns.
+# Points are generated in the unit square, in an order that keeps every prefix well distributed,
+# so progressive renders converge faster. Then they're mapped to the sampling disk.
+
+#Sample count matching the Rotated Grid pattern at the same grid size
+def get_sample_count(grid_size):
+    return len(get_RGSS_samples(grid_size))
+
+#Shirley-Chiu concentric mapping, preserves the point distribution
+def square_to_disk(x, y, width=1.0):
+    x = x * 2.0 - 1.0
+    y = y * 2.0 - 1.0
+    if x == 0 and y == 0:
+        return (0.0, 0.0)
+    if abs(x) > abs(y):
+        r = x
+        angle = (math.pi / 4) * (y / x)
+    else:
+        r = y
+        angle = (math.pi / 2) - (math.pi / 4) * (x / y)
+    return (r * math.cos(angle) * width, r * math.sin(angle) * width)
+
+#Toroidal shift so the first sample is at the center of the pixel
+#(the first progressive result matches the non anti-aliased render)
+def _center_first_sample(points):
+    x0, y0 = points[0]
+    return [((x - x0 + 0.5) % 1.0, (y - y0 + 0.5) % 1.0) for x, y in points]
+
+def _radical_inverse(index, base):
+    result = 0.0
+    f = 1.0 / base
+    while index > 0:
+        result += f * (index % base)
+        index //= base
+        f /= base
+    return result
+
+def get_halton_points(count):
+    return [(_radical_inverse(i, 2), _radical_inverse(i, 3)) for i in range(1, count + 1)]
+
+#R2 sequence, based on the plastic constant
+#http://extremelearning.com.au/unreasonable-effectiveness-of-quasirandom-sequences/
+def get_R2_points(count):
+    g = 1.32471795724474602596
+    a1 = 1.0 / g
+    a2 = 1.0 / (g * g)
+    return [((0.5 + a1 * i) % 1.0, (0.5 + a2 * i) % 1.0) for i in range(1, count + 1)]
+
+_MASK_32 = 0xFFFFFFFF
+
+def _reverse_bits_32(x):
+    return int('{:032b}'.format(x)[::-1], 2)
+
+def _laine_karras_permutation(x, seed):
+    x = (x + seed) & _MASK_32
+    x ^= (x * 0x6c50b47c) & _MASK_32
+    x ^= (x * 0xb82f1e52) & _MASK_32
+    x ^= (x * 0xc7afe638) & _MASK_32
+    x ^= (x * 0x8d22f6e6) & _MASK_32
+    return x
+
+#Hash based Owen scrambling
+#Burley, Practical Hash-based Owen Scrambling (2020)
+def _nested_uniform_scramble(x, seed):
+    return _reverse_bits_32(_laine_karras_permutation(_reverse_bits_32(x), seed))
+
+def _sobol_32(index, dimension):
+    #The first 2 Sobol dimensions (Van der Corput, and the x+1 primitive polynomial)
+    result = 0
+    direction = 1 << 31
+    while index > 0:
+        if index & 1:
+            result ^= direction
+        index >>= 1
+        direction = direction >> 1 if dimension == 0 else direction ^ (direction >> 1)
+    return result
+
+def get_sobol_points(count, seed=0):
+    #Owen scrambled Sobol, the scrambling keeps the stratification of every power of 2 prefix
+    points = []
+    for i in range(count):
+        x = _nested_uniform_scramble(_sobol_32(i, 0), _laine_karras_permutation(seed, 0x9e3779b9))
+        y = _nested_uniform_scramble(_sobol_32(i, 1), _laine_karras_permutation(seed + 1, 0x9e3779b9))
+        points.append((x / 2**32, y / 2**32))
+    return points
+
+#Void and cluster ranking of a toroidal grid, the first ranked cells form a blue noise pattern
+#Ulichney, The void-and-cluster method for dither array generation (1993)
+def get_blue_noise_points(count, sigma=1.5, seed=0):
+    import numpy as np
+    size = 4
+    while size * size < count * 4:
+        size *= 2
+    d = np.minimum(np.arange(size), size - np.arange(size))
+    kernel = np.exp(-(d[:,None]**2 + d[None,:]**2) / (2 * sigma * sigma))
+    
+    def splat(energy, cell, sign):
+        energy += sign * np.roll(kernel, (cell // size, cell % size), (0, 1)).reshape(-1)
+    
+    def tightest_cluster(pattern, energy):
+        return int(np.argmax(np.where(pattern, energy, -np.inf)))
+    
+    def largest_void(pattern, energy):
+        return int(np.argmin(np.where(pattern, np.inf, energy)))
+
+    rng = np.random.default_rng(seed)
+    initial_count = max(1, min(count, size * size // 10))
+    pattern = np.zeros(size * size, bool)
+    pattern[rng.choice(size * size, initial_count, replace=False)] = True
+    energy = np.zeros(size * size)
+    for cell in np.flatnonzero(pattern):
+        splat(energy, cell, 1)
+    
+    #Relax the initial pattern, moving the tightest cluster point to the largest void until it's stable
+    for i in range(size * size):
+        cluster = tightest_cluster(pattern, energy)
+        pattern[cluster] = False
+        splat(energy, cluster, -1)
+        void = largest_void(pattern, energy)
+        pattern[void] = True
+        splat(energy, void, 1)
+        if void == cluster:
+            break
+
+    ranks = [None] * initial_count
+    #Rank the initial points, removing the tightest cluster each time
+    removed = pattern.copy()
+    removed_energy = energy.copy()
+    for rank in reversed(range(initial_count)):
+        cluster = tightest_cluster(removed, removed_energy)
+        removed[cluster] = False
+        splat(removed_energy, cluster, -1)
+        ranks[rank] = cluster
+    #Then keep filling the largest void
+    while len(ranks) < count:
+        void = largest_void(pattern, energy)
+        pattern[void] = True
+        splat(energy, void, 1)
+        ranks.append(void)
+
+    return [(((cell % size) + 0.5) / size, ((cell // size) + 0.5) / size) for cell in ranks]
+
+_PATTERN_POINTS = {
+    'Halton' : get_halton_points,
+    'Sobol' : get_sobol_points,
+    'R2' : get_R2_points,
+    'Blue Noise' : get_blue_noise_points,
+}
+
+PATTERNS = ['Rotated Grid', 'Random'] + list(_PATTERN_POINTS.keys())
+
+#(pattern, grid_size) : samples
+_CACHE = {}
+
+#Returns the samples of any of the PATTERNS, cached per grid size
+def get_samples(pattern, grid_size, width=1.0):
+    key = (pattern, grid_size)
+    if key not in _CACHE:
+        if pattern == 'Rotated Grid':
+            samples = get_RGSS_samples(grid_size)
+        elif pattern == 'Random':
+            samples = get_random_samples(grid_size)
+        else:
+            points = _PATTERN_POINTS[pattern](get_sample_count(grid_size))
+            samples = [square_to_disk(x, y) for x, y in _center_first_sample(points)]
+        _CACHE[key] = samples
+    return [(x * width, y * width) for x, y in _CACHE[key]]
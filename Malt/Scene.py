@@ -19,13 +19,15 @@ class Mesh():
 
 class Object():
 
-    def __init__(self, matrix, mesh, material, parameters={}, mirror_scale=False, tags=[]):
+    def __init__(self, matrix, mesh, material, parameters={}, mirror_scale=False, tags=[], key=None):
         self.matrix = matrix
         self.mesh = mesh
         self.material = material
         self.parameters = parameters
         self.mirror_scale = mirror_scale
         self.tags = tags
+        # Stable identifier across scene updates (optional)
+        self.key = key
 
 class Light():
 
@@ -40,6 +42,7 @@ class Light():
         self.spot_blend = 0
         self.radius = 0
         self.matrix = None
+        self.key = None
 
 class Scene():
 
@@ -53,6 +56,10 @@ class Scene():
         self.time = 0
 
         self.batches = None
+        # Optional spatial index over the objects (See Malt.Render.BVH)
+        self.bvh = None
+        # Changes when any material, mesh or texture is updated, None if unknown
+        self.proxys_version = None
         self.shader_resources = {}
 
 class ShaderResource():
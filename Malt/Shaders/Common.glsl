@@ -49,6 +49,11 @@ layout(std140) uniform BATCH_IDS
 };
 #define BATCH_ID(index) BATCH_ID[(index)/4][(index)%4]
 
+#ifdef INDIRECT_BATCHING
+// Set when drawing with Malt.Render.IndirectBatching
+uniform bool INDIRECT_BATCH = false;
+#endif
+
 vertex_out vec3 IO_POSITION;
 vertex_out vec3 IO_NORMAL;
 vertex_out vec3 IO_TANGENT;
@@ -80,6 +85,19 @@ layout (location = 8) in vec4 in_color1;
 layout (location = 9) in vec4 in_color2;
 layout (location = 10) in vec4 in_color3;
 
+#ifdef INDIRECT_BATCHING
+struct _IndirectBatchInstance
+{
+    mat4 MODEL;
+    uvec4 ID;
+};
+layout(std430, binding = 0) readonly buffer INDIRECT_BATCH_INSTANCES
+{
+    _IndirectBatchInstance INDIRECT_BATCH_INSTANCE[];
+};
+layout (location = 11) in uint in_instance;
+#endif
+
 void VERTEX_SETUP_OUTPUT()
 {
     gl_Position = PROJECTION * CAMERA * vec4(POSITION, 1);
@@ -95,8 +113,18 @@ void VERTEX_SETUP_OUTPUT()
 
 void DEFAULT_VERTEX_SHADER()
 {
-    MODEL = BATCH_MODEL[gl_InstanceID];
-    ID = uvec4(BATCH_ID(gl_InstanceID),0,0,0);
+#ifdef INDIRECT_BATCHING
+    if(INDIRECT_BATCH)
+    {
+        MODEL = INDIRECT_BATCH_INSTANCE[in_instance].MODEL;
+        ID = INDIRECT_BATCH_INSTANCE[in_instance].ID;
+    }
+    else
+#endif
+    {
+        MODEL = BATCH_MODEL[gl_InstanceID];
+        ID = uvec4(BATCH_ID(gl_InstanceID),0,0,0);
+    }
 
     POSITION = transform_point(MODEL, in_position);
     NORMAL = transform_normal(MODEL, in_normal);
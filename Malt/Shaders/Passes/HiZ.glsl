@@ -0,0 +1,121 @@
+#include "Common.glsl"
+
+// Hierarchical-Z occlusion culling (See Malt.Render.OcclusionCulling).
+// HIZ_REDUCE builds each level of the max depth mip chain. The base level is a power of two, so each texel
+// of the next levels covers exactly 2x2 texels of the previous one.
+// HIZ_TEST draws one point per batch instance, only the instances not hidden by the Hi-Z reach the render target,
+// so a GL_SAMPLES_PASSED query counts the visible instances.
+
+#ifdef HIZ_REDUCE
+
+#ifdef VERTEX_SHADER
+void main()
+{
+    DEFAULT_SCREEN_VERTEX_SHADER();
+}
+#endif
+
+#ifdef PIXEL_SHADER
+
+// The source level is the texture base level, so the target level is not sampled
+uniform sampler2D source_texture;
+uniform ivec2 target_resolution;
+
+layout (location = 0) out float OUT_DEPTH;
+
+void main()
+{
+    ivec2 texel = ivec2(gl_FragCoord.xy);
+    ivec2 source_size = textureSize(source_texture, 0);
+    vec2 ratio = vec2(source_size) / vec2(target_resolution);
+    // The base level can be up to 2x smaller than the depth buffer, so a texel can cover up to 3x3 source texels
+    ivec2 start = ivec2(floor(vec2(texel) * ratio));
+    ivec2 end = min(ivec2(ceil(vec2(texel + 1) * ratio)), source_size);
+
+    float depth = 0.0;
+    for(int x = start.x; x < end.x; x++)
+    {
+        for(int y = start.y; y < end.y; y++)
+        {
+            depth = max(depth, texelFetch(source_texture, ivec2(x, y), 0).x);
+        }
+    }
+    OUT_DEPTH = depth;
+}
+
+#endif //PIXEL_SHADER
+
+#endif //HIZ_REDUCE
+
+#ifdef HIZ_TEST
+
+#ifdef VERTEX_SHADER
+
+uniform sampler2D hiz_texture;
+uniform int hiz_levels = 1;
+// Local space center and radius of the batch mesh
+uniform vec4 bounding_sphere;
+
+bool is_visible(vec3 center, float radius)
+{
+    mat4 view_projection = PROJECTION * CAMERA;
+    vec3 screen_min = vec3(1);
+    vec3 screen_max = vec3(-1);
+    for(int i = 0; i < 8; i++)
+    {
+        vec3 corner = center + radius * vec3((i & 1) != 0 ? 1 : -1, (i & 2) != 0 ? 1 : -1, (i & 4) != 0 ? 1 : -1);
+        vec4 clip = view_projection * vec4(corner, 1);
+        if(clip.w <= 0.0)
+        {
+            // Crosses the camera plane
+            return true;
+        }
+        vec3 ndc = clip.xyz / clip.w;
+        screen_min = min(screen_min, ndc);
+        screen_max = max(screen_max, ndc);
+    }
+    screen_min = clamp(screen_min * 0.5 + 0.5, 0.0, 1.0);
+    screen_max = clamp(screen_max * 0.5 + 0.5, 0.0, 1.0);
+
+    // Pick the level where the bounds cover at most 2x2 texels, plus 1 texel of margin for the sample jitter
+    ivec2 base_size = textureSize(hiz_texture, 0);
+    vec2 size = (screen_max.xy - screen_min.xy) * vec2(base_size) + 1.0;
+    int level = clamp(int(ceil(log2(max(size.x, size.y)))), 0, hiz_levels - 1);
+    ivec2 level_size = textureSize(hiz_texture, level);
+    ivec2 start = clamp(ivec2(floor(screen_min.xy * vec2(level_size) - 0.5)), ivec2(0), level_size - 1);
+    ivec2 end = clamp(ivec2(floor(screen_max.xy * vec2(level_size) + 0.5)), ivec2(0), level_size - 1);
+
+    float max_depth = 0.0;
+    for(int x = start.x; x <= end.x; x++)
+    {
+        for(int y = start.y; y <= end.y; y++)
+        {
+            max_depth = max(max_depth, texelFetch(hiz_texture, ivec2(x, y), level).x);
+        }
+    }
+    return screen_min.z <= max_depth;
+}
+
+void main()
+{
+    mat4 model = BATCH_MODEL[gl_InstanceID];
+    vec3 center = transform_point(model, bounding_sphere.xyz);
+    float scale = sqrt(max(max(dot(model[0].xyz, model[0].xyz), dot(model[1].xyz, model[1].xyz)), dot(model[2].xyz, model[2].xyz)));
+    // Hidden instances are moved outside the clip volume
+    gl_Position = is_visible(center, bounding_sphere.w * scale) ? vec4(0, 0, 0, 1) : vec4(2, 2, 2, 1);
+}
+
+#endif //VERTEX_SHADER
+
+#ifdef PIXEL_SHADER
+
+layout (location = 0) out vec4 OUT_VISIBLE;
+
+void main()
+{
+    OUT_VISIBLE = vec4(1);
+}
+
+#endif //PIXEL_SHADER
+
+#endif //HIZ_TEST
@@ -0,0 +1,49 @@
+#include "Common.glsl"
+
+#ifdef VERTEX_SHADER
+void main()
+{
+    DEFAULT_SCREEN_VERTEX_SHADER();
+}
+#endif
+
+#ifdef PIXEL_SHADER
+
+// Convergence estimation of progressively accumulated samples (See Malt.Render.AdaptiveSampling).
+// SAMPLE_MOMENTS outputs the luminance and its square, to be blended into the running mean of both.
+// SAMPLE_ERROR outputs the per pixel standard error of the mean, and whether the pixel has any variance at all.
+
+#ifdef SAMPLE_MOMENTS
+uniform sampler2D color_texture;
+#endif
+
+#ifdef SAMPLE_ERROR
+uniform sampler2D moments_texture;
+uniform int sample_count = 1;
+#endif
+
+layout (location = 0) out vec4 OUT_RESULT;
+
+void main()
+{
+    ivec2 texel = ivec2(gl_FragCoord.xy);
+
+    #ifdef SAMPLE_MOMENTS
+    {
+        vec4 color = texelFetch(color_texture, texel, 0);
+        float luminance = dot(color.rgb * color.a, vec3(0.2126, 0.7152, 0.0722));
+        OUT_RESULT = vec4(luminance, luminance * luminance, 0, 1);
+    }
+    #endif
+
+    #ifdef SAMPLE_ERROR
+    {
+        vec2 moments = texelFetch(moments_texture, texel, 0).xy;
+        float variance = max(moments.y - moments.x * moments.x, 0.0);
+        float error = sqrt(variance / float(sample_count));
+        OUT_RESULT = vec4(error, error > 1e-6 ? 1.0 : 0.0, 0, 1);
+    }
+    #endif
+}
+
+#endif //PIXEL_SHADER
@@ -0,0 +1,39 @@
+#include "Common.glsl"
+
+#ifdef VERTEX_SHADER
+void main()
+{
+    DEFAULT_SCREEN_VERTEX_SHADER();
+}
+#endif
+
+#ifdef PIXEL_SHADER
+
+// Each output pixel is the checksum of a tile_size x tile_size tile of the input texture.
+// Used by the Bridge viewports to read back only the tiles that changed since the last frame.
+
+uniform sampler2D input_texture;
+uniform int tile_size = 64;
+
+layout (location = 0) out uvec4 OUT_CHECKSUM;
+
+void main()
+{
+    ivec2 resolution = textureSize(input_texture, 0);
+    ivec2 tile_start = ivec2(gl_FragCoord.xy) * tile_size;
+    ivec2 tile_end = min(tile_start + tile_size, resolution);
+
+    // FNV-1a, one hash per channel
+    uvec4 checksum = uvec4(2166136261u);
+    for(int y = tile_start.y; y < tile_end.y; y++)
+    {
+        for(int x = tile_start.x; x < tile_end.x; x++)
+        {
+            uvec4 value = floatBitsToUint(texelFetch(input_texture, ivec2(x, y), 0));
+            checksum = (checksum ^ value) * 16777619u;
+        }
+    }
+    OUT_CHECKSUM = checksum;
+}
+
+#endif //PIXEL_SHADER
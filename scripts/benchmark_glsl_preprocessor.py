@@ -0,0 +1,134 @@
+# Compares the in-process GLSL preprocessor against mcpp on the shipped shader library.
+# Usage: python benchmark_glsl_preprocessor.py [path to mcpp executable]
+# The outputs are compared token by token, including the file and line each token maps to,
+# and the comments (mcpp moves trailing comments to their own line, so only their order is compared).
+
+import os, sys, glob, time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Malt.GL import GLSLPreprocessor
+from Malt.GL.GLSLPreprocessor import split_lines, COMMENT, _WHITESPACE
+
+MALT = os.path.join(os.path.dirname(__file__), '..', 'Malt')
+SHADERS = os.path.abspath(os.path.join(MALT, 'Shaders'))
+NPR_SHADERS = os.path.abspath(os.path.join(MALT, 'Pipelines', 'NPR_Pipeline', 'Shaders'))
+
+def run_mcpp(source, include_directories, definitions):
+    import subprocess, tempfile
+    mcpp = sys.argv[1] if len(sys.argv) > 1 else None
+    if mcpp is None:
+        from Malt.GL.Shader import mcpp_preprocessor
+        result = mcpp_preprocessor(source, include_directories, definitions)
+    else:
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        tmp.write((source + '\n').encode('utf-8'))
+        tmp.close()
+        command = [mcpp, '-C'] + ['-I' + d for d in include_directories] + ['-D' + d for d in definitions] + [tmp.name]
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        os.remove(tmp.name)
+        if process.returncode != 0:
+            raise Exception(process.stderr.decode('utf-8'))
+        result = process.stdout.decode('utf-8')
+    # mcpp reads the source from a temporary file, rename it to match the in-process preprocessor
+    root_path = result.split('\n', 1)[0].split('"')[1]
+    return result.replace(f'"{root_path}"', '"src"')
+
+def normalize(source):
+    code = []
+    comments = []
+    path = None
+    base_line = 1
+    base_number = 1
+    for line in split_lines(source):
+        if line.directive == 'line':
+            arguments = [t for t in line.arguments() if t.kind not in _WHITESPACE]
+            base_line = int(arguments[0].value)
+            base_number = line.number + 1
+            if len(arguments) > 1:
+                path = arguments[1].value.strip('"')
+            continue
+        line_number = base_line + line.number - base_number
+        for token in line.tokens:
+            if token.kind == COMMENT:
+                comments.append(' '.join(token.value.split()))
+            elif token.kind not in _WHITESPACE:
+                code.append((path, line_number, token.value))
+    return code, comments
+
+def get_cases():
+    cases = []
+    headers = {
+        'MESH' : ('NPR_MeshShader.glsl', ['PRE_PASS', 'MAIN_PASS', 'SHADOW_PASS']),
+        'SCREEN' : ('NPR_ScreenShader.glsl', ['SHADER']),
+        'LIGHT' : ('NPR_LightShader.glsl', ['SHADER']),
+    }
+    for name, (header, passes) in headers.items():
+        source = f'#include "{header}"\n#include "Node Utils 2/node_utils_2.glsl"\n#include "Node Utils/node_utils.glsl"\n'
+        for pass_name in passes:
+            for stage in ('VERTEX_SHADER', 'PIXEL_SHADER'):
+                cases.append((source, [SHADERS, NPR_SHADERS], [f'IS_{name}_SHADER', pass_name, stage]))
+        cases.append((source, [SHADERS, NPR_SHADERS], [f'IS_{name}_SHADER', 'VERTEX_SHADER', 'PIXEL_SHADER', 'REFLECTION']))
+    paths = glob.glob(os.path.join(SHADERS, '**', '*.glsl'), recursive=True)
+    paths += glob.glob(os.path.join(NPR_SHADERS, '**', '*.glsl'), recursive=True)
+    for path in sorted(paths):
+        for stage in ('VERTEX_SHADER', 'PIXEL_SHADER'):
+            cases.append((f'#include "{path}"\n', [SHADERS, NPR_SHADERS], [stage]))
+    return cases
+
+def main():
+    cases = get_cases()
+    mismatches = 0
+    mcpp_time = 0
+    cold_time = 0
+    warm_time = 0
+    for source, include_directories, definitions in cases:
+        start = time.perf_counter()
+        try:
+            reference = run_mcpp(source, include_directories, definitions)
+        except Exception as e:
+            reference = e
+        mcpp_time += time.perf_counter() - start
+
+        GLSLPreprocessor.FILE_CACHE.clear()
+        GLSLPreprocessor.HEADER_CACHE.clear()
+        start = time.perf_counter()
+        try:
+            result = GLSLPreprocessor.preprocess(source + '\n', include_directories, definitions)
+        except Exception as e:
+            result = e
+        cold_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            GLSLPreprocessor.preprocess(source + '\n', include_directories, definitions)
+        except:
+            pass
+        warm_time += time.perf_counter() - start
+
+        if isinstance(reference, Exception) or isinstance(result, Exception):
+            if isinstance(reference, Exception) != isinstance(result, Exception):
+                mismatches += 1
+                print('ERROR MISMATCH:', definitions, source.strip())
+                print('    mcpp:', reference if isinstance(reference, Exception) else 'OK')
+                print('    python:', result if isinstance(result, Exception) else 'OK')
+            continue
+
+        reference_code, reference_comments = normalize(reference)
+        code, comments = normalize(result)
+        if code != reference_code or comments != reference_comments:
+            mismatches += 1
+            print('MISMATCH:', definitions, source.strip())
+            for a, b in zip(reference_code, code):
+                if a != b:
+                    print('    mcpp:', a)
+                    print('    python:', b)
+                    break
+
+    print(f'{len(cases)} sources, {mismatches} mismatches')
+    print(f'mcpp : {mcpp_time:.3f} s')
+    print(f'python (cold cache) : {cold_time:.3f} s')
+    print(f'python (warm cache) : {warm_time:.3f} s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Compares the convergence of the Malt.Render.Sampling patterns.
+# Usage: python benchmark_sampling_patterns.py [grid size] [edges]
+# Each pattern integrates random edges over the sampling disk (the anti-aliasing case) and a smooth gradient.
+# Prints the RMS error of each prefix of the sample sequence against the analytic coverage, the lower the better.
+
+import os, sys, math, random
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Malt.Render import Sampling
+
+grid_size = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+edge_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+def edge_coverage(distance):
+    # Fraction of the unit disk on the far side of a line at the given signed distance from its center
+    distance = max(-1.0, min(1.0, distance))
+    return (math.acos(distance) - distance * math.sqrt(1.0 - distance * distance)) / math.pi
+
+rng = random.Random(0)
+edges = []
+for i in range(edge_count):
+    angle = rng.random() * math.pi * 2
+    edges.append((math.cos(angle), math.sin(angle), rng.random() * 2.0 - 1.0))
+
+def edge_error(samples):
+    error = 0
+    for nx, ny, distance in edges:
+        estimate = sum(1 for x, y in samples if x * nx + y * ny > distance) / len(samples)
+        error += (estimate - edge_coverage(distance)) ** 2
+    return math.sqrt(error / len(edges))
+
+def gradient_error(samples):
+    # The mean of x*x over the unit disk is 1/4
+    return abs(sum(x * x for x, y in samples) / len(samples) - 0.25)
+
+patterns = {pattern : Sampling.get_samples(pattern, grid_size) for pattern in Sampling.PATTERNS}
+sample_count = min(len(samples) for samples in patterns.values())
+prefixes = []
+prefix = 1
+while prefix < sample_count:
+    prefixes.append(prefix)
+    prefix *= 2
+prefixes.append(sample_count)
+
+print('Grid Size : {}  Samples : {}  Edges : {}'.format(grid_size, sample_count, edge_count))
+print()
+for name, error_function in (('EDGE RMS ERROR', edge_error), ('GRADIENT ERROR', gradient_error)):
+    print(name)
+    print('{:<14}'.format('Samples') + ''.join('{:>9}'.format(prefix) for prefix in prefixes))
+    for pattern, samples in patterns.items():
+        errors = [error_function(samples[:prefix]) for prefix in prefixes]
+        print('{:<14}'.format(pattern) + ''.join('{:>9.4f}'.format(error) for error in errors))
+    print()
@@ -0,0 +1,124 @@
+# Compares the UBO scene batches against Malt.Render.IndirectBatching.
+# Usage: python benchmark_scene_batching.py [unique meshes] [instances per mesh]
+# Needs glfw and an OpenGL 4.5 driver. Prints the batching time and the draws (objects) per ms for each engine.
+
+import os, sys, time, random
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import glfw
+
+glfw.init()
+glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 4)
+glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 5)
+glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+glfw.window_hint(glfw.VISIBLE, glfw.FALSE)
+window = glfw.create_window(256, 256, 'Malt Benchmark', None, None)
+glfw.make_context_current(window)
+
+from Malt.GL.GL import *
+from Malt.GL.Mesh import Mesh
+from Malt.GL.Shader import Shader, shader_preprocessor
+from Malt.GL.Texture import Texture
+from Malt.GL.RenderTarget import RenderTarget
+from Malt.Render.Common import CommonBuffer
+from Malt.Render.IndirectBatching import IndirectBatching, SHADER_DEFINE
+from Malt.Pipeline import Pipeline, SHADER_DIR
+from Malt import Scene
+
+SOURCE = '''
+#include "Common.glsl"
+#ifdef VERTEX_SHADER
+void main()
+{
+    DEFAULT_VERTEX_SHADER();
+    VERTEX_SETUP_OUTPUT();
+}
+#endif
+#ifdef PIXEL_SHADER
+layout (location = 0) out vec4 RESULT;
+void main()
+{
+    PIXEL_SETUP_INPUT();
+    RESULT = vec4(1);
+}
+#endif
+'''
+
+class BenchmarkPipeline(Pipeline):
+    # Only what build_scene_batches and draw_scene_pass need
+    def __init__(self, indirect):
+        self.indirect_batching = IndirectBatching() if indirect else None
+        self.batch_UBOs = []
+
+def make_cube(size):
+    positions = []
+    for x in (-size, size):
+        for y in (-size, size):
+            for z in (-size, size):
+                positions += [x, y, z]
+    indices = [
+        0,1,3, 0,3,2, 4,6,7, 4,7,5, 0,4,5, 0,5,1,
+        2,3,7, 2,7,6, 0,2,6, 0,6,4, 1,5,7, 1,7,3,
+    ]
+    normals = [0.0] * len(positions)
+    return Mesh(positions, indices, normals)
+
+def make_shader(defines):
+    vertex = shader_preprocessor(SOURCE, [SHADER_DIR], defines + ['VERTEX_SHADER'])
+    pixel = shader_preprocessor(SOURCE, [SHADER_DIR], defines + ['PIXEL_SHADER'])
+    return Shader(vertex, pixel)
+
+def make_scene(mesh_count, instances_per_mesh):
+    material = Scene.Material({})
+    objects = []
+    for m in range(mesh_count):
+        mesh = Scene.Mesh(make_cube(random.uniform(0.01, 0.05)), {'double_sided' : False, 'precomputed_tangents' : False})
+        for i in range(instances_per_mesh):
+            matrix = [1,0,0,0, 0,1,0,0, 0,0,1,0, random.uniform(-1,1), random.uniform(-1,1), random.uniform(0,1), 1]
+            objects.append(Scene.Object(matrix, mesh, material, {'ID' : len(objects)}))
+    scene = Scene.Scene()
+    scene.camera = Scene.Camera([1,0,0,0, 0,1,0,0, 0,0,1,0, 0,0,0,1], [1,0,0,0, 0,1,0,0, 0,0,1,0, 0,0,0,1])
+    scene.objects = objects
+    return scene, material
+
+def run(name, pipeline, scene, material, iterations):
+    # Each engine uses the shaders a pipeline with its settings would compile
+    material.shader = {'MAIN_PASS' : make_shader([SHADER_DEFINE] if pipeline.indirect_batching else [])}
+    start = time.perf_counter()
+    batches = pipeline.build_scene_batches(scene.objects)
+    batching_time = time.perf_counter() - start
+
+    resolution = (1024, 1024)
+    target = RenderTarget([Texture(resolution, GL_RGBA8)], Texture(resolution, GL_DEPTH_COMPONENT32F))
+    common_buffer = CommonBuffer()
+    common_buffer.load(scene, resolution)
+    resources = {'COMMON_UNIFORMS' : common_buffer}
+
+    # Warm up (Mesh VAOs, arenas and draw lists are built on first use)
+    pipeline.draw_scene_pass(target, batches, 'MAIN_PASS', material.shader['MAIN_PASS'], resources)
+    glFinish()
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        pipeline.draw_scene_pass(target, batches, 'MAIN_PASS', material.shader['MAIN_PASS'], resources)
+    glFinish()
+    draw_time = (time.perf_counter() - start) / iterations
+
+    print(f'{name}:')
+    print(f'    batching : {batching_time*1000:.3f} ms')
+    print(f'    scene pass : {draw_time*1000:.3f} ms')
+    print(f'    draws per ms : {len(scene.objects) / (draw_time*1000):.1f}')
+
+def main():
+    mesh_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    instances_per_mesh = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    random.seed(0)
+    scene, material = make_scene(mesh_count, instances_per_mesh)
+    print(f'{mesh_count} unique meshes, {len(scene.objects)} objects')
+    run('UBO batches', BenchmarkPipeline(False), scene, material, 20)
+    run('Indirect batches', BenchmarkPipeline(True), scene, material, 20)
+
+if __name__ == '__main__':
+    main()
+    glfw.terminate()